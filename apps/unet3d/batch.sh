@@ -58,6 +58,7 @@ s_pushd $ROOT_DIR/apps/unet3d
     BATCH_SIZE=2
     GRADIENT_ACCUMULATION_STEPS=1
     NUM_WORKERS=${NUM_WORKERS:-1}
+    LOADER_AUTOTUNE=${LOADER_AUTOTUNE:-0}
     SLEEP=${SLEEP:--1}
     OUTPUT_DIR=$OUTPUT
     PPN=$(num_accelerators)
@@ -74,6 +75,7 @@ s_pushd $ROOT_DIR/apps/unet3d
     BATCH_SIZE: ${BATCH_SIZE},
     GRADIENT_ACCUMULATION_STEPS: ${GRADIENT_ACCUMULATION_STEPS},
     NUM_WORKERS: ${NUM_WORKERS},
+    LOADER_AUTOTUNE: ${LOADER_AUTOTUNE},
     HOSTNAME: ${HOSTNAME},
     SLEEP: ${SLEEP},
     OUTPUT_DIR: ${OUTPUT_DIR},
@@ -105,6 +107,12 @@ s_pushd $ROOT_DIR/apps/unet3d
         log "- Batch size: ${BATCH_SIZE}" | tee -a $OUTPUT/output.log
         log "- Gradient accumulation steps: ${GRADIENT_ACCUMULATION_STEPS}" | tee -a $OUTPUT/output.log
         log "- Data loader workers: ${NUM_WORKERS}" | tee -a $OUTPUT/output.log
+        log "- Data loader autotune: ${LOADER_AUTOTUNE}" | tee -a $OUTPUT/output.log
+
+        EXTRA_ARGS=()
+        if is_truthy "$LOADER_AUTOTUNE"; then
+            EXTRA_ARGS+=(--loader_autotune)
+        fi
 
         log "Clearing MIOpen cache on compute nodes" | tee -a $OUTPUT/output.log
         flux run -N $NUM_NODES -o mpibind=off --exclusive rm -rf ${MIOPEN_USER_DB_PATH}
@@ -135,6 +143,7 @@ s_pushd $ROOT_DIR/apps/unet3d
             --output_dir ${OUTPUT_DIR} \
             --max-training-step ${MAX_TRAINING_STEP} \
             --sleep ${SLEEP} \
+            "${EXTRA_ARGS[@]}" \
             --verbose 2>&1 | tee -a $OUTPUT/output.log
         # end timing
         end=$(date +%s)
@@ -0,0 +1,313 @@
+"""
+Times Unet3D on random data: the training forward pass (model and
+DiceCELoss), the backward pass, and sliding-window inference over a whole
+volume, once per entry of --layouts. Inputs are created in the layout the
+loader would produce, so NDHWC includes the channels_last_3d views taken
+by the training and evaluation loops. With --compile the model and loss
+run through torch.compile, which compiles during the untimed warm-up.
+
+Every --checkpoint_configs entry (comma-separated levels, see
+--checkpoint_levels of train.py) is run per layout. Its memory is reported
+as the bytes autograd keeps for backward in one training step (eager only)
+and, on GPU, the peak allocated device memory of the training steps.
+
+--precisions repeats every run under autocast (see --precision of
+train.py) and reports training and inference throughput against the first
+entry, e.g. fp32 against bf16 on CPU. --sw_batch_size runs that many
+windows per inference call.
+
+--sw_skip_threshold skips the inference windows whose input stays below it
+and reports how many were skipped and the Dice difference to running all
+windows. --background fills that fraction of the volume depth with air, as
+in the padded KiTS volumes.
+
+    python3 benchmark_model.py --layouts NCDHW NDHWC --input_shape 128 128 128
+"""
+
+import json
+import time
+import argparse
+
+import numpy as np
+import torch
+
+from apps.unet3d.unet3d.model.unet3d import Unet3D, checkpoint_levels
+from apps.unet3d.unet3d.model.losses import DiceCELoss, DiceScore, FusedDiceCELoss
+from apps.unet3d.unet3d.model.layers import channels_first, memory_formats
+from apps.unet3d.unet3d.runtime.inference import (
+    WindowStats,
+    sliding_window_inference,
+)
+from apps.unet3d.unet3d.runtime.compilation import (
+    compiled_inference,
+    compiled_train_step,
+)
+from apps.unet3d.unet3d.runtime.precision import PRECISIONS, Precision
+
+
+def random_batch(layout, batch_size, shape, device, generator):
+    """Image and label batch shaped like the loader output for `layout`."""
+    if layout == "NDHWC":
+        size = (batch_size, *shape, 1)
+    else:
+        size = (batch_size, 1, *shape)
+    image = torch.randn(size, generator=generator)
+    label = torch.randint(0, 3, size, generator=generator, dtype=torch.uint8)
+    image, label = image.to(device), label.to(device)
+    return channels_first(image, layout), channels_first(label, layout)
+
+
+# normalized intensity of air, the clipped minimum of the preprocessing
+AIR = (-79.0 - 101.0) / 76.9
+
+
+def synchronize(device):
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+
+
+class SavedTensors:
+    """Counts the distinct storages autograd saves for backward in a block."""
+
+    def __init__(self):
+        self.nbytes = 0
+        self._storages = set()
+
+    def pack(self, tensor):
+        storage = tensor.untyped_storage()
+        if storage.data_ptr() not in self._storages:
+            self._storages.add(storage.data_ptr())
+            self.nbytes += storage.nbytes()
+        return tensor
+
+    def hooks(self):
+        return torch.autograd.graph.saved_tensors_hooks(self.pack, lambda t: t)
+
+
+def summarize(times):
+    times = np.array(times) * 1000
+    return {
+        "mean_ms": float(times.mean()),
+        "p50_ms": float(np.percentile(times, 50)),
+        "p90_ms": float(np.percentile(times, 90)),
+    }
+
+
+def benchmark(args, layout, levels, precision, device):
+    generator = torch.Generator().manual_seed(args.seed)
+    torch.manual_seed(args.seed)
+    model = Unet3D(1, 3, "instancenorm", "relu", layout=layout, checkpoint=levels).to(
+        device
+    )
+    loss_class = FusedDiceCELoss if args.fused_loss else DiceCELoss
+    loss_fn = loss_class(
+        to_onehot_y=True, use_softmax=True, layout=layout, include_background=False
+    )
+    train_step = compiled_train_step(args, model, loss_fn)
+    predict = compiled_inference(args, model)
+    precision = Precision(precision, device)
+
+    model.train()
+    saved = SavedTensors()
+    forward, backward = [], []
+    for step in range(args.warmup + args.steps):
+        image, label = random_batch(
+            layout, args.batch_size, args.input_shape, device, generator
+        )
+        if step == args.warmup and not args.compile:
+            # counted outside the timed steps, the hooks add overhead
+            with saved.hooks(), precision.autocast():
+                train_step(image, label)
+        synchronize(device)
+        t0 = time.perf_counter()
+        with precision.autocast():
+            _, loss = train_step(image, label)
+        synchronize(device)
+        t1 = time.perf_counter()
+        loss.backward()
+        synchronize(device)
+        t2 = time.perf_counter()
+        del loss
+        model.zero_grad(set_to_none=True)
+        if step + 1 == args.warmup and device.type == "cuda":
+            torch.cuda.reset_peak_memory_stats(device)
+        if step >= args.warmup:
+            forward.append(t1 - t0)
+            backward.append(t2 - t1)
+    peak = torch.cuda.max_memory_allocated(device) if device.type == "cuda" else None
+
+    model.eval()
+    inference = []
+    image, label = random_batch(layout, 1, args.volume_shape, device, generator)
+    air = int(args.background * image.shape[2])
+    image[:, :, :air] = AIR
+    label[:, :, :air] = 0
+
+    def infer(skip_threshold, stats=None):
+        return sliding_window_inference(
+            inputs=image,
+            labels=label,
+            roi_shape=args.input_shape,
+            model=predict,
+            overlap=args.overlap,
+            mode="gaussian",
+            padding_val=-2.2,
+            memory_format=memory_formats[layout],
+            sw_batch_size=args.sw_batch_size,
+            pad_batches=args.compile,
+            skip_threshold=skip_threshold,
+            stats=stats,
+            plan=args.sw_plan_windows,
+        )
+
+    with torch.no_grad(), precision.autocast():
+        for step in range(min(args.warmup, 1) + args.inference_steps):
+            synchronize(device)
+            t0 = time.perf_counter()
+            infer(args.sw_skip_threshold)
+            synchronize(device)
+            if step >= min(args.warmup, 1):
+                inference.append(time.perf_counter() - t0)
+        skipped = dice_delta = None
+        if args.sw_skip_threshold is not None:
+            score_fn = DiceScore(layout=layout)
+            stats = WindowStats()
+            dice = score_fn(*infer(args.sw_skip_threshold, stats))
+            dice_delta = (dice - score_fn(*infer(None))).tolist()
+            skipped = f"{stats.skipped}/{stats.windows}"
+
+    train_step_time = np.median(np.array(forward) + np.array(backward))
+    return {
+        "layout": layout,
+        "checkpoint": sorted(model.checkpoint),
+        "precision": precision.precision,
+        "train_samples_per_sec": args.batch_size / train_step_time,
+        "inference_volumes_per_sec": 1 / np.median(inference),
+        "saved_mib": saved.nbytes / 2**20 if saved.nbytes else None,
+        "peak_mib": peak / 2**20 if peak is not None else None,
+        "skipped_windows": skipped,
+        "skip_dice_delta": dice_delta,
+        "forward": summarize(forward),
+        "backward": summarize(backward),
+        "sliding_window": summarize(inference),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--layouts", nargs="+", choices=["NCDHW", "NDHWC"], default=["NCDHW", "NDHWC"]
+    )
+    parser.add_argument(
+        "--checkpoint_configs",
+        nargs="+",
+        default=["none"],
+        help="Checkpointed levels per run, e.g. none encoder down0,down1 all",
+    )
+    parser.add_argument("--precisions", nargs="+", choices=PRECISIONS, default=["fp32"])
+    parser.add_argument("--batch_size", type=int, default=2)
+    parser.add_argument("--input_shape", nargs="+", type=int, default=[128, 128, 128])
+    parser.add_argument(
+        "--volume_shape",
+        nargs="+",
+        type=int,
+        default=[256, 256, 256],
+        help="Volume shape for sliding-window inference",
+    )
+    parser.add_argument("--overlap", nargs="+", type=float, default=[0.5])
+    parser.add_argument(
+        "--sw_plan_windows",
+        action="store_true",
+        help="Fit the inference ROI and strides to --volume_shape",
+    )
+    parser.add_argument(
+        "--sw_batch_size", type=int, default=1, help="Windows per inference call"
+    )
+    parser.add_argument(
+        "--sw_skip_threshold",
+        type=float,
+        default=None,
+        help="Skip inference windows whose input maximum is at most this",
+    )
+    parser.add_argument(
+        "--background",
+        type=float,
+        default=0.0,
+        help="Fraction of the inference volume depth filled with air",
+    )
+    parser.add_argument("--steps", type=int, default=10, help="Timed training steps")
+    parser.add_argument(
+        "--inference_steps", type=int, default=2, help="Timed inference volumes"
+    )
+    parser.add_argument("--warmup", type=int, default=3, help="Untimed steps first")
+    parser.add_argument("--device", choices=["auto", "cpu", "cuda"], default="auto")
+    parser.add_argument("--fused_loss", action="store_true")
+    parser.add_argument("--compile", action="store_true")
+    parser.add_argument(
+        "--compile_mode",
+        choices=["default", "reduce-overhead", "max-autotune"],
+        default="default",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="", help="Write the results as JSON")
+    args = parser.parse_args()
+
+    if args.device == "auto":
+        args.device = "cuda" if torch.cuda.is_available() else "cpu"
+    device = torch.device(args.device)
+    torch.backends.cudnn.benchmark = True
+
+    configs = {config: config.split(",") for config in args.checkpoint_configs}
+    for levels in configs.values():
+        checkpoint_levels(levels)
+    variants = [
+        (layout, config, precision)
+        for layout in args.layouts
+        for config in configs
+        for precision in args.precisions
+    ]
+    results = [
+        benchmark(args, layout, configs[config], precision, device)
+        for layout, config, precision in variants
+    ]
+    base = results[0]
+    print(
+        f"{'layout':8} {'checkpoint':20} {'precision':9} {'saved MiB':>9} "
+        f"{'peak MiB':>9} {'forward ms':>17} {'backward ms':>17} "
+        f"{'train samples/s':>17} {'inference volumes/s':>21}"
+    )
+    for (layout, config, precision), r in zip(variants, results):
+        memory = [
+            f"{r[key]:9.0f}" if r[key] is not None else f"{'-':>9}"
+            for key in ("saved_mib", "peak_mib")
+        ]
+        times = [
+            f"{r[phase]['p50_ms']:9.1f} ({base[phase]['p50_ms'] / r[phase]['p50_ms']:.2f}x)"
+            for phase in ("forward", "backward")
+        ]
+        rates = [
+            f"{r[key]:{width}.3f} ({r[key] / base[key]:.2f}x)"
+            for key, width in (
+                ("train_samples_per_sec", 9),
+                ("inference_volumes_per_sec", 13),
+            )
+        ]
+        print(
+            f"{layout:8} {config:20} {precision:9} " + " ".join(memory + times + rates)
+        )
+        if r["skipped_windows"] is not None:
+            print(
+                f"{'':8} skipped {r['skipped_windows']} windows, Dice difference "
+                + ", ".join(f"{d:+.4f}" for d in r["skip_dice_delta"])
+            )
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(
+                {"device": str(device), "args": vars(args), "results": results},
+                f,
+                indent=2,
+            )
+
+
+if __name__ == "__main__":
+    main()
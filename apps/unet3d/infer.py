@@ -0,0 +1,100 @@
+"""
+Segments every volume of --data_dir matching --infer_pattern with a trained
+checkpoint (--load_ckpt_path) and writes the argmax masks to --mask_dir.
+Reading, sliding-window inference and writing run as overlapped stages,
+and the files are split across the MPI ranks by their estimated number of
+windows. The sliding-window flags of train.py (--val_input_shape,
+--overlap, --sw_*, --precision, --compile) apply.
+
+    mpirun -np 4 python3 infer.py --data_dir <DIR> --load_ckpt_path <CKPT>
+"""
+
+import os
+import json
+
+# LC HACK: work around so that "import torch" will not change CPU affinity
+# see https://rzlc.llnl.gov/jira/browse/ELCAP-386
+if "OMP_PLACES" in os.environ:
+    del os.environ["OMP_PLACES"]
+if "OMP_PROC_BIND" in os.environ:
+    del os.environ["OMP_PROC_BIND"]
+
+import torch
+
+from apps.unet3d.unet3d.model.unet3d import Unet3D
+from apps.unet3d.unet3d.data_loading.data_loader import load_data
+from apps.unet3d.unet3d.data_loading.storage import get_storage_backend
+from apps.unet3d.unet3d.runtime.engine import (
+    InferenceEngine,
+    report_throughput,
+    shard_files,
+)
+from apps.unet3d.unet3d.runtime.arguments import Args
+from apps.unet3d.unet3d.runtime.distributed_utils import get_device
+
+from src.mpi_utils import MPIUtils
+from src.logging import log0, configure_logging
+from dftracer.python import dftracer, ai
+
+
+@ai
+def _main(flags):
+    device = get_device(MPIUtils.local_rank())
+    storage = get_storage_backend(flags)
+    pattern = flags.infer_pattern or f"*_x.{flags.data_format}"
+    paths = load_data(flags.data_dir, pattern, storage=storage)
+    log0(f"Segmenting {len(paths)} volumes on {MPIUtils.size()} ranks")
+    paths = shard_files(flags, paths, storage)
+
+    model = Unet3D(
+        1,
+        3,
+        normalization=flags.normalization,
+        activation=flags.activation,
+        layout=flags.layout,
+    )
+    if flags.load_ckpt_path:
+        checkpoint = torch.load(flags.load_ckpt_path, map_location=device)
+        model.load_state_dict(checkpoint["best_model_state_dict"])
+    else:
+        log0("No --load_ckpt_path given, segmenting with untrained weights")
+
+    engine = InferenceEngine(
+        flags,
+        model,
+        device,
+        storage,
+        mask_dir=flags.mask_dir or os.path.join(flags.output_dir, "masks"),
+        mask_format=flags.mask_format,
+        queue_size=flags.infer_queue_size,
+        readers=flags.infer_readers,
+        writers=flags.infer_writers,
+    )
+    summary = report_throughput(engine.run(paths))
+    if MPIUtils.rank() == 0:
+        with open(os.path.join(flags.output_dir, "inference.json"), "w") as f:
+            json.dump(summary, f, indent=2)
+
+
+def main():
+    Args.parse()
+    flags = Args.get()
+    MPIUtils.initialize()
+    configure_logging(output_dir=flags.output_dir)
+    Args.print_args()
+    os.makedirs(flags.output_dir, exist_ok=True)
+    flags.data_dir = os.path.abspath(flags.data_dir)
+    log0(f"Data directory: {flags.data_dir}")
+    MPIUtils.barrier()
+    dft = dftracer.initialize_log(
+        logfile=f"{flags.output_dir}/trace-{MPIUtils.rank()}-of-{MPIUtils.size()}.pfw",
+        process_id=MPIUtils.rank(),
+        data_dir=flags.data_dir,
+    )
+    _main(flags)
+    dft.finalize()
+    MPIUtils.finalize()
+
+
+if __name__ == "__main__":
+    main()
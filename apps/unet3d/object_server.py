@@ -0,0 +1,174 @@
+"""
+Stand-in for an S3-style object store that serves a local dataset directory,
+so the s3 storage backend can be developed and benchmarked offline.
+
+Supports what the backend uses: HEAD, GET with a single byte range
+(206 Partial Content) and ListObjectsV2 (GET /<bucket>?list-type=2&prefix=).
+Connections are kept alive (HTTP/1.1).
+
+    python3 object_server.py --root <DIR> --bucket unet3d &
+    python3 train.py --data_dir <DIR> --storage s3 --s3_bucket unet3d ...
+"""
+
+import os
+import re
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlsplit
+from xml.sax.saxutils import escape
+
+RANGE_RE = re.compile(r"bytes=(\d*)-(\d*)$")
+MAX_KEYS = 1000
+
+
+class ObjectHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    server_version = "unet3d-object-server"
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _resolve(self):
+        parts = urlsplit(self.path)
+        path = unquote(parts.path).lstrip("/")
+        bucket, _, key = path.partition("/")
+        if bucket != self.server.bucket:
+            return None, None, parts
+        local = os.path.normpath(os.path.join(self.server.root, key))
+        if local != self.server.root and not local.startswith(
+            self.server.root + os.sep
+        ):
+            return None, None, parts
+        return key, local, parts
+
+    def _send(self, status, body=b"", headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if self.command != "HEAD":
+            self.wfile.write(body)
+
+    def do_HEAD(self):
+        key, local, _ = self._resolve()
+        if not key or not os.path.isfile(local):
+            self._send(404)
+            return
+        self.send_response(200)
+        self.send_header("Content-Length", str(os.path.getsize(local)))
+        self.send_header("Accept-Ranges", "bytes")
+        self.end_headers()
+
+    def do_GET(self):
+        key, local, parts = self._resolve()
+        if local is None:
+            self._send(404)
+            return
+        if not key:
+            self._list(parse_qs(parts.query))
+            return
+        if not os.path.isfile(local):
+            self._send(404)
+            return
+
+        size = os.path.getsize(local)
+        start, end, status = 0, size, 200
+        match = RANGE_RE.match(self.headers.get("Range", ""))
+        if match:
+            first, last = match.groups()
+            if first:
+                start = int(first)
+                end = min(size, int(last) + 1) if last else size
+            elif last:
+                start = max(0, size - int(last))
+            if start >= size:
+                self._send(416, headers={"Content-Range": f"bytes */{size}"})
+                return
+            status = 206
+        with open(local, "rb") as f:
+            f.seek(start)
+            body = f.read(end - start)
+        self.server.bytes_sent += len(body)
+        headers = {"Accept-Ranges": "bytes"}
+        if status == 206:
+            headers["Content-Range"] = f"bytes {start}-{end - 1}/{size}"
+        self._send(status, body, headers)
+
+    def _list(self, query):
+        prefix = query.get("prefix", [""])[0]
+        token = query.get("continuation-token", [""])[0]
+        keys = []
+        for dirpath, _, filenames in os.walk(self.server.root):
+            for name in filenames:
+                key = os.path.relpath(os.path.join(dirpath, name), self.server.root)
+                if key.startswith(prefix) and key > token:
+                    keys.append(key)
+        keys.sort()
+        truncated = len(keys) > MAX_KEYS
+        keys = keys[:MAX_KEYS]
+
+        items = "".join(
+            f"<Contents><Key>{escape(k)}</Key>"
+            f"<Size>{os.path.getsize(os.path.join(self.server.root, k))}</Size>"
+            f"</Contents>"
+            for k in keys
+        )
+        next_token = (
+            f"<NextContinuationToken>{escape(keys[-1])}</NextContinuationToken>"
+            if truncated
+            else ""
+        )
+        body = (
+            '<?xml version="1.0" encoding="UTF-8"?>'
+            '<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+            f"<Name>{escape(self.server.bucket)}</Name>"
+            f"<Prefix>{escape(prefix)}</Prefix><KeyCount>{len(keys)}</KeyCount>"
+            f"<IsTruncated>{'true' if truncated else 'false'}</IsTruncated>"
+            f"{next_token}{items}</ListBucketResult>"
+        ).encode()
+        self._send(200, body, {"Content-Type": "application/xml"})
+
+
+class ObjectServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, root, bucket, verbose=False):
+        super().__init__(address, ObjectHandler)
+        self.root = os.path.abspath(root)
+        self.bucket = bucket
+        self.verbose = verbose
+        self.bytes_sent = 0
+
+
+def serve_in_background(root, bucket="unet3d", host="127.0.0.1", port=0):
+    """Starts a server on a daemon thread and returns it; port 0 picks one."""
+    server = ObjectServer((host, port), root, bucket)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--root", type=str, required=True, help="Dataset directory")
+    parser.add_argument("--bucket", type=str, default="unet3d")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9000)
+    parser.add_argument("--verbose", action="store_true", default=False)
+    args = parser.parse_args()
+
+    server = ObjectServer((args.host, args.port), args.root, args.bucket, args.verbose)
+    print(
+        f"Serving {server.root} as bucket {args.bucket} on "
+        f"http://{args.host}:{server.server_address[1]}"
+    )
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,254 @@
+# Writes a synthetic dataset laid out like the output of preprocess-dataset.py:
+# case_XXXXX_x (float32, normalized CT) and case_XXXXX_y (uint8, 0 = background,
+# 1 = kidney, 2 = tumor) volumes of shape (1, D, H, W).
+
+import os
+import time
+import argparse
+import zipfile
+from multiprocessing import Pool
+
+import numpy as np
+from scipy.ndimage import gaussian_filter, zoom
+
+# same as preprocess-dataset.py
+MEAN_VAL = 101.0
+STDDEV_VAL = 76.9
+MIN_CLIP_VAL = -79.0
+MAX_CLIP_VAL = 304.0
+TARGET_SHAPE = [128, 128, 128]
+
+# Hounsfield units of the tissue classes in contrast-enhanced abdominal CT
+BODY_HU, KIDNEY_HU, TUMOR_HU = 30.0, 180.0, 90.0
+TISSUE_NOISE_HU = 25.0
+
+# Shapes of KiTS19 after resampling to 1.6 x 1.2 x 1.2 mm: axial slices of
+# 300-400 voxels and a long-tailed number of slices
+DEPTH_MEDIAN, DEPTH_SIGMA, DEPTH_RANGE = 190, 0.35, (128, 600)
+PLANE_MEAN, PLANE_STD, PLANE_RANGE = 330, 30, (256, 420)
+
+
+def normalize(hu):
+    return (np.clip(hu, MIN_CLIP_VAL, MAX_CLIP_VAL) - MEAN_VAL) / STDDEV_VAL
+
+
+class Stats:
+    def __init__(self):
+        self.mean = []
+        self.std = []
+        self.shapes = []
+        self.foreground = []
+        self.nbytes = 0
+
+    def append(self, mean, std, shape, foreground, nbytes):
+        self.mean.append(mean)
+        self.std.append(std)
+        self.shapes.append(shape)
+        self.foreground.append(foreground)
+        self.nbytes += nbytes
+
+    def get_string(self):
+        d, h, w = np.median(np.array(self.shapes), axis=0)
+        return (
+            f"Mean value: {np.median(self.mean):.2f}, std: {np.median(self.std):.2f}, "
+            f"d: {d}, h: {h}, w: {w}, foreground: {np.median(self.foreground):.4f}, "
+            f"total: {self.nbytes / 2**30:.2f} GiB"
+        )
+
+
+def read_shapes(data_dir):
+    """Volume shapes of an existing (real) dataset, read from the headers."""
+    shapes = []
+    for name in sorted(os.listdir(data_dir)):
+        path = os.path.join(data_dir, name)
+        if name.endswith("_x.npy"):
+            with open(path, "rb") as f:
+                shapes.append(read_header_shape(f))
+        elif name.endswith("_x.npz"):
+            with zipfile.ZipFile(path) as zf, zf.open("data.npy") as f:
+                shapes.append(read_header_shape(f))
+    assert shapes, f"Found no volumes in {data_dir}"
+    return [s[1:] for s in shapes]
+
+
+def read_header_shape(f):
+    version = np.lib.format.read_magic(f)
+    if version == (1, 0):
+        return np.lib.format.read_array_header_1_0(f)[0]
+    return np.lib.format.read_array_header_2_0(f)[0]
+
+
+def sample_shape(rng, shapes=None):
+    if shapes:
+        return tuple(shapes[rng.integers(len(shapes))])
+    d = rng.lognormal(np.log(DEPTH_MEDIAN), DEPTH_SIGMA)
+    h = rng.normal(PLANE_MEAN, PLANE_STD)
+    w = h + rng.normal(0, 8)
+    bounds = [DEPTH_RANGE, PLANE_RANGE, PLANE_RANGE]
+    return tuple(int(np.clip(v, *b)) for v, b in zip((d, h, w), bounds))
+
+
+def smooth_field(rng, shape, coarse=4):
+    """Low-frequency noise in [-1, 1] of the given shape."""
+    field = rng.uniform(-1, 1, size=(coarse,) * len(shape))
+    field = zoom(field, [s / coarse for s in shape], order=1)
+    return field[tuple(slice(0, s) for s in shape)]
+
+
+def blob(rng, shape, center, radii, roughness=0.25):
+    """
+    Boolean mask of an ellipsoid whose radius is perturbed by smooth noise.
+    The perturbation only depends on the position, so every ray from the
+    center crosses the boundary once and the blob stays one connected
+    component. Returns the mask and the slices it covers.
+    """
+    reach = [r * (1 + roughness) for r in radii]
+    box = tuple(
+        slice(max(0, int(c - r)), min(s, int(np.ceil(c + r)) + 1))
+        for c, r, s in zip(center, reach, shape)
+    )
+    grids = np.ogrid[box]
+    dist = sum(((g - c) / r) ** 2 for g, c, r in zip(grids, center, radii))
+    sub_shape = tuple(sl.stop - sl.start for sl in box)
+    limit = (1 + roughness * smooth_field(rng, sub_shape)) ** 2
+    return dist <= limit, box
+
+
+def generate_case(rng, shape):
+    d, h, w = shape
+    label = np.zeros(shape, dtype=np.uint8)
+    hu = np.full(shape, -1000.0, dtype=np.float32)
+
+    # body cross section: an elliptic cylinder along the depth axis
+    yy, xx = np.ogrid[:h, :w]
+    body_r = (h * rng.uniform(0.32, 0.4), w * rng.uniform(0.4, 0.47))
+    body = ((yy - h / 2) / body_r[0]) ** 2 + ((xx - w / 2) / body_r[1]) ** 2 <= 1
+    hu[:, body] = BODY_HU
+
+    # two kidneys left and right of the spine, some cases lose one to surgery
+    kidney_center_d = rng.uniform(0.3, 0.7) * d
+    for side in (-1, 1) if rng.random() > 0.05 else (rng.choice([-1, 1]),):
+        center = (
+            kidney_center_d + rng.normal(0, 0.04 * d),
+            h / 2 + body_r[0] * rng.uniform(0.15, 0.35),
+            w / 2 + side * body_r[1] * rng.uniform(0.35, 0.5),
+        )
+        radii = (rng.uniform(25, 40), rng.uniform(15, 22), rng.uniform(18, 26))
+        mask, box = blob(rng, shape, center, radii)
+        label[box][mask] = 1
+
+    # one or two tumors, grown from inside a kidney and allowed to bulge out
+    kidney = np.argwhere(label == 1)
+    for _ in range(rng.integers(1, 3) if len(kidney) else 0):
+        center = kidney[rng.integers(len(kidney))]
+        radius = rng.lognormal(np.log(10), 0.5)
+        radii = tuple(
+            np.clip(radius * rng.uniform(0.8, 1.2, size=3), 3, 45) * [0.75, 1, 1]
+        )
+        mask, box = blob(rng, shape, center, radii, roughness=0.35)
+        label[box][mask] = 2
+
+    hu[label == 1] = KIDNEY_HU
+    hu[label == 2] = TUMOR_HU
+    noise = gaussian_filter(rng.standard_normal(shape, dtype=np.float32), 1.0)
+    hu += noise * (TISSUE_NOISE_HU / noise.std())
+    hu[:, ~body] = -1000.0
+    image = normalize(hu).astype(np.float32)
+    return image[np.newaxis], label[np.newaxis]
+
+
+def pad_to_min_shape(image, label):
+    current_shape = image.shape[1:]
+    bounds = [max(0, TARGET_SHAPE[i] - current_shape[i]) for i in range(3)]
+    paddings = [(0, 0)]
+    paddings.extend([(bounds[i] // 2, bounds[i] - bounds[i] // 2) for i in range(3)])
+    return np.pad(image, paddings, mode="edge"), np.pad(label, paddings, mode="edge")
+
+
+def save(path, array, data_format):
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "wb") as f:
+        if data_format == "npy":
+            np.save(f, array, allow_pickle=False)
+        else:
+            # stored (np.savez) like convert_to_npz.sh, so range reads work
+            np.savez(f, data=array)
+    os.replace(tmp_path, path)
+    return array.nbytes
+
+
+def write_case(job):
+    case_id, args, shapes = job
+    case = f"case_{case_id:05d}"
+    x_path = os.path.join(args.results_dir, f"{case}_x.{args.format}")
+    y_path = os.path.join(args.results_dir, f"{case}_y.{args.format}")
+    if not args.overwrite and os.path.exists(x_path) and os.path.exists(y_path):
+        return None
+    rng = np.random.default_rng((args.seed, case_id))
+    image, label = generate_case(rng, sample_shape(rng, shapes))
+    image, label = pad_to_min_shape(image, label)
+    nbytes = save(x_path, image, args.format) + save(y_path, label, args.format)
+    return (
+        float(image.mean()),
+        float(image.std()),
+        image.shape[1:],
+        float((label > 0).mean()),
+        nbytes,
+    )
+
+
+def num_cases_for_size(total_size, shapes, seed, samples=256):
+    rng = np.random.default_rng(seed)
+    # float32 image plus uint8 label per voxel, after padding to TARGET_SHAPE
+    case_bytes = np.mean(
+        [
+            np.prod(np.maximum(sample_shape(rng, shapes), TARGET_SHAPE)) * 5
+            for _ in range(samples)
+        ]
+    )
+    return max(1, int(round(total_size * 2**30 / case_bytes)))
+
+
+if __name__ == "__main__":
+    PARSER = argparse.ArgumentParser()
+    PARSER.add_argument("--results_dir", dest="results_dir", required=True)
+    PARSER.add_argument("--num_cases", dest="num_cases", type=int, default=210)
+    PARSER.add_argument(
+        "--total_size",
+        dest="total_size",
+        type=float,
+        default=0.0,
+        help="Target dataset size in GiB, overrides --num_cases",
+    )
+    PARSER.add_argument(
+        "--format", dest="format", choices=["npy", "npz"], default="npz"
+    )
+    PARSER.add_argument(
+        "--shapes_from",
+        dest="shapes_from",
+        default="",
+        help="Sample volume shapes from an existing preprocessed dataset",
+    )
+    PARSER.add_argument("--jobs", dest="jobs", type=int, default=os.cpu_count())
+    PARSER.add_argument("--seed", dest="seed", type=int, default=0)
+    PARSER.add_argument("--overwrite", dest="overwrite", action="store_true")
+
+    args = PARSER.parse_args()
+    os.makedirs(args.results_dir, exist_ok=True)
+    shapes = read_shapes(args.shapes_from) if args.shapes_from else None
+    num_cases = args.num_cases
+    if args.total_size > 0:
+        num_cases = num_cases_for_size(args.total_size, shapes, args.seed)
+    print(f"Writing {num_cases} {args.format} cases to {args.results_dir}")
+
+    stats = Stats()
+    t0 = time.time()
+    jobs = [(case_id, args, shapes) for case_id in range(num_cases)]
+    with Pool(args.jobs) as pool:
+        for done, result in enumerate(pool.imap_unordered(write_case, jobs), 1):
+            if result is not None:
+                stats.append(*result)
+            if done % max(1, num_cases // 20) == 0 or done == num_cases:
+                print(f"{done}/{num_cases} cases, {time.time() - t0:.1f} s")
+    if stats.shapes:
+        print(stats.get_string())
@@ -0,0 +1,340 @@
+"""
+Replays the file accesses recorded in the dftracer traces of a training run
+(trace-{rank}-of-{size}.pfw[.gz]) against a data directory, without PyTorch.
+
+Every (process, thread) of a traced rank becomes one replay thread that
+issues the recorded open/read/pread/lseek/stat/close calls at their recorded
+offsets from the start of the trace, stretched by --time_scale (0.1 = 10x
+faster). With --ranks larger than the number of traces, traces are reused
+and every copy is shifted to different files of the data directory, so ten
+copies of a 4-rank trace look like a 40-rank job.
+
+File names and sizes are only in traces recorded with
+DFTRACER_INC_METADATA=1.
+
+    python3 replay_trace.py --traces <OUTPUT_DIR> --data_dir <DIR> --ranks 40
+    flux run -N 10 --tasks-per-node 4 python3 replay_trace.py ...
+"""
+
+import os
+import re
+import glob
+import gzip
+import json
+import time
+import argparse
+import threading
+from collections import defaultdict
+from multiprocessing import Pool
+
+import numpy as np
+
+from src.mpi_utils import MPIUtils
+
+REPLAYED_CATEGORIES = {"POSIX", "STDIO"}
+REPLAYED_OPS = {"open", "read", "pread", "seek", "stat", "close"}
+TRACE_RE = re.compile(r"trace-(\d+)-of-(\d+)\.pfw(\.gz)?$")
+
+
+def _normalize(name):
+    """open64 -> open, __xstat64 -> stat, fopen -> open, ..."""
+    name = name.lstrip("_").rstrip("64")
+    if name.startswith("f") and name[1:] in ("open", "read", "close", "seek"):
+        name = name[1:]
+    if name.endswith("stat"):
+        return "stat"
+    return {"lseek": "seek", "preadv": "pread", "readv": "read"}.get(name, name)
+
+
+def read_trace(path):
+    """
+    Returns the replayable events of one trace file grouped by (pid, tid), as
+    (ts seconds, op, file, size, offset) sorted by time.
+    """
+    opener = gzip.open if path.endswith(".gz") else open
+    hashes = {}
+    raw = []
+    with opener(path, "rt") as f:
+        for line in f:
+            line = line.strip().rstrip(",")
+            if not line.startswith("{"):
+                continue
+            try:
+                event = json.loads(line)
+            except ValueError:
+                continue
+            args = event.get("args", {})
+            if event.get("ph") == "M" and event.get("name") == "FH":
+                # newer dftracer writes file names once and hashes after that
+                hashes[args.get("value")] = args.get("name")
+            elif event.get("cat") in REPLAYED_CATEGORIES:
+                raw.append(event)
+
+    streams = defaultdict(list)
+    for event in raw:
+        args = event.get("args", {})
+        fname = args.get("fname") or hashes.get(args.get("fhash"))
+        op = _normalize(event["name"])
+        if fname is None or op not in REPLAYED_OPS:
+            continue
+        size = args.get("ret", args.get("size", args.get("count", 0)))
+        offset = args.get("offset", args.get("whence_offset"))
+        streams[(event.get("pid"), event.get("tid"))].append(
+            (
+                float(event["ts"]) / 1e6,
+                op,
+                fname,
+                max(0, int(size or 0)),
+                int(offset) if offset is not None else None,
+            )
+        )
+    return {key: sorted(events) for key, events in streams.items()}
+
+
+def find_traces(path):
+    paths = [path] if os.path.isfile(path) else glob.glob(os.path.join(path, "*.pfw*"))
+    traces = sorted(
+        (int(m.group(1)), p) for p in paths if (m := TRACE_RE.search(p)) is not None
+    )
+    assert traces, f"Found no trace-<rank>-of-<size>.pfw files in {path}"
+    return [p for _, p in traces]
+
+
+class PathMapper:
+    """
+    Maps recorded paths into `data_dir`. Copy `shift` > 0 of a trace moves
+    every file to the file `shift` positions later in the sorted listing of
+    its directory, keeping _x/_y pairs together.
+    """
+
+    def __init__(self, data_dir, prefix_map=None, shift=0):
+        self.data_dir = data_dir
+        self.prefix_map = prefix_map
+        self.shift = shift
+        self._listings = {}
+
+    def _shifted(self, path):
+        directory, name = os.path.split(path)
+        if directory not in self._listings:
+            cases = sorted(
+                {n.rsplit("_", 1)[0] for n in os.listdir(directory) if "_" in n}
+            )
+            self._listings[directory] = (cases, {c: i for i, c in enumerate(cases)})
+        cases, index = self._listings[directory]
+        case, _, suffix = name.rpartition("_")
+        if case not in index:
+            return path
+        return os.path.join(
+            directory, f"{cases[(index[case] + self.shift) % len(cases)]}_{suffix}"
+        )
+
+    def __call__(self, path):
+        if self.prefix_map and path.startswith(self.prefix_map[0]):
+            path = self.prefix_map[1] + path[len(self.prefix_map[0]) :]
+        elif self.data_dir:
+            path = os.path.join(self.data_dir, os.path.basename(path))
+        return self._shifted(path) if self.shift else path
+
+
+class StreamReplayer(threading.Thread):
+    def __init__(self, events, t0, start, time_scale, mapper, chunk_size):
+        super().__init__(daemon=True)
+        self.events = events
+        self.t0 = t0
+        self.start_time = start
+        self.time_scale = time_scale
+        self.mapper = mapper
+        self.chunk_size = chunk_size
+        self.latencies = defaultdict(list)
+        self.bytes_read = 0
+        self.lateness = []
+        self.errors = 0
+        self._files = {}
+
+    def _fd(self, path):
+        if path not in self._files:
+            self._files[path] = [os.open(path, os.O_RDONLY), 0]
+        return self._files[path]
+
+    def _read(self, handle, size, offset):
+        buffer = bytearray(min(size, self.chunk_size))
+        done = 0
+        while done < size:
+            view = memoryview(buffer)[: min(len(buffer), size - done)]
+            n = os.preadv(handle[0], [view], offset + done)
+            if n == 0:
+                break
+            done += n
+        self.bytes_read += done
+        return done
+
+    def _issue(self, op, path, size, offset):
+        if op == "open":
+            self._fd(path)
+        elif op == "stat":
+            os.stat(path)
+        elif op == "close":
+            handle = self._files.pop(path, None)
+            if handle is not None:
+                os.close(handle[0])
+        elif op == "seek":
+            self._fd(path)[1] = offset or 0
+        else:
+            handle = self._fd(path)
+            if op == "pread" and offset is not None:
+                self._read(handle, size, offset)
+            else:
+                handle[1] += self._read(handle, size, handle[1])
+
+    def run(self):
+        for ts, op, fname, size, offset in self.events:
+            if self.time_scale > 0:
+                target = self.start_time + (ts - self.t0) * self.time_scale
+                delay = target - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+                else:
+                    self.lateness.append(-delay)
+            path = self.mapper(fname)
+            t0 = time.perf_counter()
+            try:
+                self._issue(op, path, size, offset)
+            except OSError:
+                self.errors += 1
+                continue
+            self.latencies[op].append(time.perf_counter() - t0)
+        for fd, _ in self._files.values():
+            os.close(fd)
+
+
+def replay_rank(job):
+    """Replays one trace file as virtual rank `rank`; returns its stats."""
+    rank, trace_path, args, start = job
+    streams = read_trace(trace_path)
+    if not streams:
+        return {"rank": rank, "trace": trace_path, "ops": 0}
+    t0 = min(events[0][0] for events in streams.values())
+    shift = (rank // args.num_traces) * args.shift_stride
+    prefix_map = args.map.split("=", 1) if args.map else None
+    replayers = [
+        StreamReplayer(
+            events,
+            t0,
+            start,
+            args.time_scale,
+            PathMapper(args.data_dir, prefix_map, shift),
+            args.chunk_size * 2**20,
+        )
+        for events in streams.values()
+    ]
+    # all virtual ranks begin together, also when replaying untimed
+    time.sleep(max(0.0, start - time.time()))
+    for replayer in replayers:
+        replayer.start()
+    for replayer in replayers:
+        replayer.join()
+    elapsed = time.time() - start
+
+    latencies = defaultdict(list)
+    for replayer in replayers:
+        for op, values in replayer.latencies.items():
+            latencies[op].extend(values)
+    lateness = [v for r in replayers for v in r.lateness]
+    return {
+        "rank": rank,
+        "trace": os.path.basename(trace_path),
+        "elapsed": elapsed,
+        "bytes_read": sum(r.bytes_read for r in replayers),
+        "errors": sum(r.errors for r in replayers),
+        "ops": {op: len(values) for op, values in latencies.items()},
+        "latency_ms": {
+            op: {
+                "p50": float(np.percentile(values, 50) * 1e3),
+                "p99": float(np.percentile(values, 99) * 1e3),
+            }
+            for op, values in latencies.items()
+        },
+        "late_events": len(lateness),
+        "max_lateness_s": max(lateness, default=0.0),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument(
+        "--traces", required=True, help="Trace file or directory of .pfw[.gz] files"
+    )
+    parser.add_argument(
+        "--data_dir", default="", help="Directory the recorded files are read from"
+    )
+    parser.add_argument(
+        "--map", default="", help="OLD=NEW path prefix rewrite, wins over --data_dir"
+    )
+    parser.add_argument(
+        "--ranks", type=int, default=0, help="Virtual ranks (default: one per trace)"
+    )
+    parser.add_argument(
+        "--time_scale",
+        type=float,
+        default=1.0,
+        help="Multiplier on recorded times, 0 replays as fast as possible",
+    )
+    parser.add_argument(
+        "--shift_stride",
+        type=int,
+        default=1,
+        help="Files each extra copy of a trace is shifted by",
+    )
+    parser.add_argument(
+        "--chunk_size", type=int, default=16, help="Largest single read [MiB]"
+    )
+    parser.add_argument("--output", default="", help="Write the summary as JSON")
+    args = parser.parse_args()
+
+    MPIUtils.initialize()
+    traces = find_traces(args.traces)
+    args.num_traces = len(traces)
+    num_ranks = args.ranks or len(traces)
+    my_ranks = list(range(MPIUtils.rank(), num_ranks, MPIUtils.size()))
+
+    MPIUtils.barrier()
+    start = MPIUtils.comm_world().bcast(time.time() + 1.0, root=0)
+    jobs = [(r, traces[r % len(traces)], args, start) for r in my_ranks]
+    if len(jobs) > 1:
+        with Pool(len(jobs)) as pool:
+            results = pool.map(replay_rank, jobs)
+    else:
+        results = [replay_rank(job) for job in jobs]
+
+    gathered = MPIUtils.comm_world().gather(results, root=0)
+    if MPIUtils.rank() == 0:
+        results = sorted(
+            (r for part in gathered for r in part), key=lambda r: r["rank"]
+        )
+        for r in results:
+            print(json.dumps(r))
+        elapsed = max(r.get("elapsed", 0.0) for r in results)
+        total_bytes = sum(r.get("bytes_read", 0) for r in results)
+        summary = {
+            "ranks": num_ranks,
+            "traces": len(traces),
+            "time_scale": args.time_scale,
+            "elapsed": elapsed,
+            "bytes_read": total_bytes,
+            "mib_per_sec": total_bytes / 2**20 / elapsed if elapsed > 0 else 0.0,
+            "errors": sum(r.get("errors", 0) for r in results),
+            "per_rank": results,
+        }
+        print(
+            f"Replayed {len(traces)} traces as {num_ranks} ranks in {elapsed:.2f} s: "
+            f"{total_bytes / 2**30:.2f} GiB, {summary['mib_per_sec']:.1f} MiB/s, "
+            f"{summary['errors']} errors"
+        )
+        if args.output:
+            with open(args.output, "w") as f:
+                json.dump(summary, f, indent=2)
+    MPIUtils.finalize()
+
+
+if __name__ == "__main__":
+    main()
@@ -11,12 +11,17 @@ if "OMP_PROC_BIND" in os.environ:
 from math import ceil
 
 from apps.unet3d.unet3d.model.unet3d import Unet3D
-from apps.unet3d.unet3d.model.losses import DiceCELoss, DiceScore
+from apps.unet3d.unet3d.model.losses import DiceCELoss, DiceScore, FusedDiceCELoss
 
 from apps.unet3d.unet3d.data_loading.data_loader import get_data_loaders
+from apps.unet3d.unet3d.data_loading.storage import (
+    flush_storage_stats,
+    summarize_storage_stats,
+)
 
 from apps.unet3d.unet3d.runtime.training import train
 from apps.unet3d.unet3d.runtime.inference import evaluate
+from apps.unet3d.unet3d.runtime.io_benchmark import io_benchmark
 from apps.unet3d.unet3d.runtime.arguments import Args
 from apps.unet3d.unet3d.runtime.distributed_utils import (
     init_distributed,
@@ -36,6 +41,20 @@ from dftracer.python import dftracer, ai
 DATASET_SIZE = 168
 
 
+def report_storage_stats(flags):
+    """
+    Merges the hedged-read stats of all ranks and loader workers. Call it once
+    the data loaders are released, so that their workers have written theirs.
+    """
+    if not flags.storage_stats_dir:
+        return
+    flush_storage_stats()
+    MPIUtils.barrier()
+    if MPIUtils.rank() == 0:
+        stats = summarize_storage_stats(flags.storage_stats_dir, flags.storage_run_id)
+        log0(f"Storage read stats: {stats}")
+
+
 @ai
 def _main(flags):
     dllogger = get_dllogger(flags)
@@ -48,13 +67,32 @@ def _main(flags):
     worker_seed = worker_seeds[local_rank]
     seed_everything(worker_seed)
 
+    if flags.exec_mode == "io_benchmark":
+        flags.seed = worker_seed
+        flags.shuffling_seed = shuffling_seeds[0]
+        train_dataloader, val_dataloader = get_data_loaders(
+            flags, num_shards=world_size, rank=local_rank, device=device
+        )
+        io_benchmark(flags, train_dataloader)
+        del train_dataloader, val_dataloader
+        report_storage_stats(flags)
+        deinit_distributed()
+        return
+
     callbacks = get_callbacks(flags, dllogger, local_rank, world_size)
     flags.seed = worker_seed
     flags.shuffling_seed = shuffling_seeds[0]
-    model = Unet3D(1, 3, normalization=flags.normalization, activation=flags.activation)
+    model = Unet3D(
+        1,
+        3,
+        normalization=flags.normalization,
+        activation=flags.activation,
+        layout=flags.layout,
+        checkpoint=flags.checkpoint_levels,
+    )
 
     train_dataloader, val_dataloader = get_data_loaders(
-        flags, num_shards=world_size, rank=local_rank
+        flags, num_shards=world_size, rank=local_rank, device=device
     )
     samples_per_epoch = world_size * len(train_dataloader) * flags.batch_size
     flags.evaluate_every = flags.evaluate_every or ceil(
@@ -64,7 +102,8 @@ def _main(flags):
         1000 * DATASET_SIZE / samples_per_epoch
     )
 
-    loss_fn = DiceCELoss(
+    loss_class = FusedDiceCELoss if flags.fused_loss else DiceCELoss
+    loss_fn = loss_class(
         to_onehot_y=True,
         use_softmax=True,
         layout=flags.layout,
@@ -123,6 +162,9 @@ def _main(flags):
     else:
         run()
 
+    # shutting the loader workers down makes them write their stats
+    del train_dataloader, val_dataloader
+    report_storage_stats(flags)
     deinit_distributed()
 
 
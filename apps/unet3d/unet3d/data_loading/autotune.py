@@ -0,0 +1,283 @@
+import os
+import re
+import json
+import time
+import random
+import socket
+import hashlib
+import itertools
+import logging
+
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+from src.mpi_utils import MPIUtils
+from src.logging import log0
+from src.utils import get_cluster_name
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CACHE_PATH = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+    "ml-workloads",
+    "unet3d-loader-autotune.json",
+)
+
+
+def host_type():
+    """
+    Host type used as the first half of the cache key, e.g. "corona" or
+    "tuolumne". Unknown machines fall back to the hostname without its node
+    number so that every node of the same cluster shares one entry.
+    """
+    cluster = get_cluster_name()
+    if cluster is None:
+        cluster = re.sub(r"\d+$", "", socket.gethostname().split(".")[0])
+    devices = torch.cuda.device_count() if torch.cuda.is_available() else 0
+    return f"{cluster}-cpu{os.cpu_count()}-dev{devices}"
+
+
+def dataset_fingerprint(files, flags, max_files=64):
+    """
+    Fingerprint of the training set and of the loader parameters that change
+    the per-sample cost. Only an evenly spaced subset of the files is stat'ed
+    to keep the number of metadata operations bounded on large datasets.
+    """
+    h = hashlib.sha1()
+    h.update(f"n={len(files)}".encode())
+    h.update(f"patch={list(flags.input_shape)}".encode())
+    h.update(f"batch={flags.batch_size}".encode())
+    h.update(f"world={MPIUtils.size()}".encode())
+    step = max(1, len(files) // max_files)
+    for path in files[::step]:
+        try:
+            size = os.stat(path).st_size
+        except OSError:
+            size = -1
+        h.update(f"{os.path.basename(path)}:{size}".encode())
+    return h.hexdigest()[:16]
+
+
+def load_cache(path):
+    if not os.path.exists(path):
+        return {}
+    try:
+        with open(path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        log.warning(f"Ignoring unreadable loader autotune cache {path}")
+        return {}
+
+
+def save_cache(path, key, entry):
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    cache = load_cache(path)
+    cache[key] = entry
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(cache, f, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+
+def measure_config(dataset, sampler, flags, config, steps, warmup, step_time):
+    """
+    Runs one calibration window over `dataset` with the given loader config.
+
+    :return: (samples/s, data-wait fraction), both measured after `warmup`
+        batches so that worker start-up is not part of the window.
+    """
+    num_workers = config["num_workers"]
+    loader = DataLoader(
+        dataset,
+        batch_size=flags.batch_size,
+        shuffle=sampler is None,
+        sampler=sampler,
+        num_workers=num_workers,
+        pin_memory=config["pin_memory"],
+        prefetch_factor=config["prefetch_factor"] if num_workers > 0 else None,
+        persistent_workers=False,
+        drop_last=True,
+        worker_init_fn=dataset.worker_init,
+    )
+    total_batches = min(len(loader), warmup + steps)
+    if total_batches == 0:
+        return 0.0, 1.0
+    warmup = min(warmup, total_batches - 1)
+    it = iter(loader)
+    for _ in range(warmup):
+        next(it)
+
+    measured = 0
+    wait = 0.0
+    t_start = time.perf_counter()
+    for _ in range(total_batches - warmup):
+        t0 = time.perf_counter()
+        next(it)
+        wait += time.perf_counter() - t0
+        measured += 1
+        if step_time > 0:
+            time.sleep(step_time)
+    elapsed = time.perf_counter() - t_start
+    del it, loader
+
+    samples_per_sec = measured * flags.batch_size / elapsed if elapsed > 0 else 0.0
+    wait_fraction = wait / elapsed if elapsed > 0 else 1.0
+    return samples_per_sec, wait_fraction
+
+
+def _candidates(flags):
+    workers = sorted(set(flags.autotune_workers))
+    prefetch = sorted(set(flags.autotune_prefetch))
+    pin = [True, False] if flags.autotune_pin_memory else [flags.pin_memory]
+    return workers, prefetch, pin
+
+
+def _measure_all_ranks(dataset, sampler, flags, config, step_time):
+    samples_per_sec, wait_fraction = measure_config(
+        dataset,
+        sampler,
+        flags,
+        config,
+        steps=flags.autotune_steps,
+        warmup=flags.autotune_warmup,
+        step_time=step_time,
+    )
+    # the slowest rank sets the pace of a DDP step, so score by the minimum
+    results = MPIUtils.comm_world().allgather((samples_per_sec, wait_fraction))
+    samples_per_sec = min(r[0] for r in results)
+    wait_fraction = max(r[1] for r in results)
+    log0(
+        f"Loader autotune: workers={config['num_workers']} "
+        f"prefetch={config['prefetch_factor']} pin={config['pin_memory']} -> "
+        f"{samples_per_sec:.2f} samples/s, data wait {wait_fraction * 100:.1f}%"
+    )
+    return samples_per_sec, wait_fraction
+
+
+def _better(candidate, best, tolerance=0.05):
+    """
+    Higher throughput wins; within `tolerance` of each other the config with
+    fewer workers wins since it leaves cores and memory to the trainer.
+    """
+    if best is None:
+        return True
+    if candidate["samples_per_sec"] > best["samples_per_sec"] * (1 + tolerance):
+        return True
+    if candidate["samples_per_sec"] >= best["samples_per_sec"] * (1 - tolerance):
+        return candidate["num_workers"] < best["num_workers"]
+    return False
+
+
+def grid_search(dataset, sampler, flags, step_time):
+    workers, prefetch, pin = _candidates(flags)
+    best = None
+    for num_workers, prefetch_factor, pin_memory in itertools.product(
+        workers, prefetch, pin
+    ):
+        config = {
+            "num_workers": num_workers,
+            "prefetch_factor": prefetch_factor,
+            "pin_memory": pin_memory,
+        }
+        sps, wait = _measure_all_ranks(dataset, sampler, flags, config, step_time)
+        result = {**config, "samples_per_sec": sps, "data_wait_fraction": wait}
+        if _better(result, best):
+            best = result
+    return best
+
+
+def hill_climb(dataset, sampler, flags, step_time):
+    """
+    Coordinate-wise hill climb over the (workers, prefetch, pin) grid starting
+    from the middle of the worker range. Measures far fewer points than the
+    full grid, which matters when each window takes tens of seconds.
+    """
+    axes = _candidates(flags)
+    position = [len(axes[0]) // 2, 0, 0]
+    measured = {}
+
+    def evaluate(pos):
+        pos = tuple(pos)
+        if pos not in measured:
+            config = {
+                "num_workers": axes[0][pos[0]],
+                "prefetch_factor": axes[1][pos[1]],
+                "pin_memory": axes[2][pos[2]],
+            }
+            sps, wait = _measure_all_ranks(dataset, sampler, flags, config, step_time)
+            measured[pos] = {
+                **config,
+                "samples_per_sec": sps,
+                "data_wait_fraction": wait,
+            }
+        return measured[pos]
+
+    best = evaluate(position)
+    improved = True
+    while improved:
+        improved = False
+        for axis in range(len(axes)):
+            for delta in (-1, 1):
+                neighbour = list(position)
+                neighbour[axis] += delta
+                if not 0 <= neighbour[axis] < len(axes[axis]):
+                    continue
+                result = evaluate(neighbour)
+                if _better(result, best):
+                    best, position, improved = result, neighbour, True
+    return best
+
+
+def autotune_loader(flags, dataset, sampler):
+    """
+    Picks num_workers, prefetch_factor and pin_memory for the training loader
+    by timing short calibration windows over the real dataset, and stores the
+    choice keyed by host type and dataset fingerprint so later runs on the
+    same kind of node skip the calibration.
+
+    Updates `flags` in place and returns the chosen config.
+    """
+    cache_path = flags.autotune_cache or DEFAULT_CACHE_PATH
+    key = f"{host_type()}/{dataset_fingerprint(dataset.images, flags)}"
+
+    entry = None
+    if MPIUtils.rank() == 0 and not flags.autotune_refresh:
+        entry = load_cache(cache_path).get(key)
+    entry = MPIUtils.comm_world().bcast(entry, root=0)
+
+    if entry is not None:
+        log0(f"Loader autotune: reusing cached config for {key} from {cache_path}")
+    else:
+        step_time = flags.sleep if flags.sleep >= 0 else flags.autotune_step_time
+        log0(
+            f"Loader autotune: calibrating {key} with strategy "
+            f"{flags.autotune_strategy} ({flags.autotune_steps} batches per window)"
+        )
+        # keep calibration from shifting the RNG streams of the real run
+        py_state = random.getstate()
+        torch_state = torch.get_rng_state()
+        np_state = np.random.get_state()
+        t0 = time.perf_counter()
+        if flags.autotune_strategy == "hill":
+            entry = hill_climb(dataset, sampler, flags, step_time)
+        else:
+            entry = grid_search(dataset, sampler, flags, step_time)
+        entry["calibration_time"] = time.perf_counter() - t0
+        entry["timestamp"] = time.time()
+        random.setstate(py_state)
+        torch.set_rng_state(torch_state)
+        np.random.set_state(np_state)
+        if MPIUtils.rank() == 0:
+            save_cache(cache_path, key, entry)
+
+    flags.num_workers = entry["num_workers"]
+    flags.prefetch_factor = entry["prefetch_factor"]
+    flags.pin_memory = entry["pin_memory"]
+    log0(
+        f"Loader autotune: using workers={flags.num_workers} "
+        f"prefetch={flags.prefetch_factor} pin={flags.pin_memory} "
+        f"({entry['samples_per_sec']:.2f} samples/s, "
+        f"data wait {entry['data_wait_fraction'] * 100:.1f}%)"
+    )
+    return entry
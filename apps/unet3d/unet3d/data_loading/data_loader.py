@@ -1,17 +1,23 @@
 import os
 import glob
+import heapq
 import logging
+from functools import partial
 
 import numpy as np
-import torch
-from torch.utils.data import Dataset, DataLoader
+from torch.utils.data import DataLoader
 from torch.utils.data.distributed import DistributedSampler
 
-from dftracer.python import ai
-
 from src.logging import log0
+from src.mpi_utils import MPIUtils
 
 from apps.unet3d.unet3d.data_loading.pytorch_loader import PytVal, PytTrain
+from apps.unet3d.unet3d.data_loading.autotune import autotune_loader
+from apps.unet3d.unet3d.data_loading.storage import get_storage_backend
+from apps.unet3d.unet3d.data_loading.synthetic_loader import get_synthetic_datasets
+from apps.unet3d.unet3d.data_loading.warm_loader import WarmEpochLoader
+from apps.unet3d.unet3d.data_loading.resident_loader import ResidentValLoader
+from apps.unet3d.unet3d.runtime.inference import count_windows
 
 log = logging.getLogger(__name__)
 
@@ -22,8 +28,11 @@ def list_files_with_pattern(path, files_pattern):
     return data
 
 
-def load_data(path, files_pattern):
-    data = sorted(glob.glob(os.path.join(path, files_pattern)))
+def load_data(path, files_pattern, storage=None):
+    if storage is not None:
+        data = storage.glob(path, files_pattern)
+    else:
+        data = sorted(glob.glob(os.path.join(path, files_pattern)))
     assert len(data) > 0, f"Found no data at {path}"
     return data
 
@@ -34,10 +43,55 @@ def get_split(data, train_idx, val_idx):
     return train, val
 
 
-def split_eval_data(x_val, y_val, num_shards, shard_id):
-    x = [a.tolist() for a in np.array_split(x_val, num_shards)]
-    y = [a.tolist() for a in np.array_split(y_val, num_shards)]
-    return x[shard_id], y[shard_id]
+def eval_costs(x_val, roi_shape, overlap, storage, plan=False):
+    """
+    Estimated evaluation cost per validation case: the number of sliding
+    window forward passes, with the voxel count as a tie breaker for the
+    decode and transfer cost. Headers are read on rank 0 only.
+    """
+    costs = None
+    if MPIUtils.rank() == 0:
+        costs = []
+        for path in x_val:
+            shape = storage.shape(path)[1:]
+            windows = count_windows(list(shape), roi_shape, overlap, plan=plan)
+            costs.append(windows + np.prod(shape) / np.prod(roi_shape) * 1e-3)
+    return MPIUtils.comm_world().bcast(costs, root=0)
+
+
+def lpt_assignment(costs, num_shards):
+    """
+    Longest-processing-time-first assignment: cases sorted by decreasing cost
+    go to the currently least loaded shard. Returns the case indices of every
+    shard in their original order and the per-shard load.
+    """
+    heap = [(0.0, shard) for shard in range(num_shards)]
+    shards = [[] for _ in range(num_shards)]
+    for idx in sorted(range(len(costs)), key=lambda i: (-costs[i], i)):
+        load, shard = heapq.heappop(heap)
+        shards[shard].append(idx)
+        heapq.heappush(heap, (load + costs[idx], shard))
+    loads = [sum(costs[i] for i in shard) for shard in shards]
+    return [sorted(shard) for shard in shards], loads
+
+
+def split_eval_data(x_val, y_val, num_shards, shard_id, costs=None):
+    if costs is None:
+        x = [a.tolist() for a in np.array_split(x_val, num_shards)]
+        y = [a.tolist() for a in np.array_split(y_val, num_shards)]
+        return x[shard_id], y[shard_id]
+
+    shards, loads = lpt_assignment(costs, num_shards)
+    counts = [
+        sum(costs[i] for i in a.tolist())
+        for a in np.array_split(np.arange(len(costs)), num_shards)
+    ]
+    log0(
+        f"Eval shard cost (max/mean): by count "
+        f"{max(counts) / max(np.mean(counts), 1e-9):.2f}, by size "
+        f"{max(loads) / max(np.mean(loads), 1e-9):.2f}"
+    )
+    return [x_val[i] for i in shards[shard_id]], [y_val[i] for i in shards[shard_id]]
 
 
 # def get_data_split(path: str, num_shards: int, shard_id: int):
@@ -62,12 +116,19 @@ def split_eval_data(x_val, y_val, num_shards, shard_id):
 #     return imgs_train, imgs_val, lbls_train, lbls_val
 
 # @ray: this is for npz
-def get_data_split(path: str, num_shards: int, shard_id: int):
+def get_data_split(
+    path: str,
+    num_shards: int,
+    shard_id: int,
+    eval_cost_fn=None,
+    data_format="npz",
+    storage=None,
+):
     with open("evaluation_cases.txt", "r") as f:
         val_cases_list = f.readlines()
     val_cases_list = [case.rstrip("\n") for case in val_cases_list]
-    imgs = load_data(path, "*_x.npz")
-    lbls = load_data(path, "*_y.npz")
+    imgs = load_data(path, f"*_x.{data_format}", storage=storage)
+    lbls = load_data(path, f"*_y.{data_format}", storage=storage)
     assert len(imgs) == len(lbls), (
         f"Found {len(imgs)} volumes but {len(lbls)} corresponding masks"
     )
@@ -80,77 +141,51 @@ def get_data_split(path: str, num_shards: int, shard_id: int):
             imgs_train.append(case_img)
             lbls_train.append(case_lbl)
     log0(f"Training samples: {len(imgs_train)}, Validation samples: {len(imgs_val)}")
-    imgs_val, lbls_val = split_eval_data(imgs_val, lbls_val, num_shards, shard_id)
+    costs = eval_cost_fn(imgs_val) if eval_cost_fn is not None else None
+    imgs_val, lbls_val = split_eval_data(
+        imgs_val, lbls_val, num_shards, shard_id, costs=costs
+    )
     return imgs_train, imgs_val, lbls_train, lbls_val
 
-class SyntheticDataset(Dataset):
-    def __init__(
-        self,
-        channels_in=1,
-        channels_out=3,
-        shape=(128, 128, 128),
-        device="cpu",
-        layout="NCDHW",
-        scalar=False,
-    ):
-        shape = tuple(shape)
-        x_shape = (
-            (channels_in,) + shape if layout == "NCDHW" else shape + (channels_in,)
-        )
-        self.x = torch.rand(
-            (32, *x_shape), dtype=torch.float32, device=device, requires_grad=False
-        )
-        if scalar:
-            self.y = torch.randint(
-                low=0,
-                high=channels_out - 1,
-                size=(32, *shape),
-                dtype=torch.int32,
-                device=device,
-                requires_grad=False,
-            )
-            self.y = torch.unsqueeze(self.y, dim=1 if layout == "NCDHW" else -1)
-        else:
-            y_shape = (
-                (channels_out,) + shape
-                if layout == "NCDHW"
-                else shape + (channels_out,)
-            )
-            self.y = torch.rand(
-                (32, *y_shape), dtype=torch.float32, device=device, requires_grad=False
-            )
 
-    @ai.data.derive("worker.init")
-    def worker_init(self, worker_id):
-        pass
-
-    def __len__(self):
-        return 64
-
-    def __getitem__(self, idx):
-        return self.x[idx % 32], self.y[idx % 32]
-
-
-def get_data_loaders(flags, num_shards, rank):
+def get_data_loaders(flags, num_shards, rank, device=None):
     if flags.loader == "synthetic":
-        train_dataset = SyntheticDataset(
-            scalar=True, shape=flags.input_shape, layout=flags.layout
-        )
-        val_dataset = SyntheticDataset(
-            scalar=True, shape=flags.val_input_shape, layout=flags.layout
-        )
+        storage = get_storage_backend(flags)
+        train_dataset, val_dataset = get_synthetic_datasets(flags, storage)
 
     elif flags.loader == "pytorch":
+        storage = get_storage_backend(flags)
+        # with --sw_distributed every rank evaluates every case
+        eval_shards, eval_shard = num_shards, rank
+        if flags.sw_distributed != "none":
+            eval_shards, eval_shard = 1, 0
+        eval_cost_fn = None
+        if flags.eval_balance == "size" and eval_shards > 1:
+            eval_cost_fn = partial(
+                eval_costs,
+                roi_shape=flags.val_input_shape,
+                overlap=flags.overlap,
+                storage=storage,
+                plan=flags.sw_plan_windows,
+            )
         x_train, x_val, y_train, y_val = get_data_split(
-            flags.data_dir, num_shards, shard_id=rank
+            flags.data_dir,
+            eval_shards,
+            shard_id=eval_shard,
+            eval_cost_fn=eval_cost_fn,
+            data_format=flags.data_format,
+            storage=storage,
         )
         train_data_kwargs = {
             "patch_size": flags.input_shape,
             "oversampling": flags.oversampling,
             "seed": flags.seed,
+            "storage": storage,
+            "crop_aware": flags.crop_aware_reads,
+            "layout": flags.layout,
         }
         train_dataset = PytTrain(x_train, y_train, **train_data_kwargs)
-        val_dataset = PytVal(x_val, y_val)
+        val_dataset = PytVal(x_val, y_val, storage=storage, layout=flags.layout)
     else:
         raise ValueError(
             f"Loader {flags.loader} unknown. Valid loaders are: synthetic, pytorch"
@@ -164,27 +199,46 @@ def get_data_loaders(flags, num_shards, rank):
     )
     val_sampler = None
 
+    if flags.loader_autotune and flags.loader == "pytorch":
+        autotune_loader(flags, train_dataset, train_sampler)
+    prefetch_factor = flags.prefetch_factor if flags.num_workers > 0 else None
+
     train_dataloader = DataLoader(
         train_dataset,
         batch_size=flags.batch_size,
         shuffle=not flags.benchmark and train_sampler is None,
         sampler=train_sampler,
         num_workers=flags.num_workers,
-        pin_memory=True,
-        persistent_workers=True,
+        pin_memory=flags.pin_memory,
+        prefetch_factor=prefetch_factor,
+        persistent_workers=flags.num_workers > 0,
         drop_last=True,
         worker_init_fn=train_dataset.worker_init,
     )
+    train_dataloader = WarmEpochLoader(
+        train_dataloader, enabled=flags.epoch_prefetch, last_epoch=flags.epochs
+    )
     val_dataloader = DataLoader(
         val_dataset,
         batch_size=1,
-        shuffle=not flags.benchmark and val_sampler is None,
+        # ranks splitting the windows of a case have to agree on the order
+        shuffle=not flags.benchmark
+        and val_sampler is None
+        and flags.sw_distributed == "none",
         sampler=val_sampler,
         num_workers=flags.num_workers,
-        persistent_workers=True,
-        pin_memory=True,
+        persistent_workers=flags.num_workers > 0,
+        pin_memory=flags.pin_memory,
+        prefetch_factor=prefetch_factor,
         drop_last=False,
         worker_init_fn=val_dataset.worker_init,
     )
+    if flags.val_resident != "off":
+        val_dataloader = ResidentValLoader(
+            val_dataloader, placement=flags.val_resident, device=device
+        )
+        if flags.exec_mode == "train":
+            # overlap the first read of the validation shard with training
+            val_dataloader.start()
 
     return train_dataloader, val_dataloader
@@ -0,0 +1,284 @@
+import os
+import fnmatch
+import logging
+import threading
+import http.client
+import xml.etree.ElementTree as ET
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import quote, urlencode, urlsplit
+
+from apps.unet3d.unet3d.data_loading.storage import StorageBackend
+
+log = logging.getLogger(__name__)
+
+S3_NS = "{http://s3.amazonaws.com/doc/2006-03-01/}"
+
+
+class ConnectionPool:
+    """
+    Keep-alive HTTP connections to one endpoint, shared by the threads of a
+    single process. Connections are not carried across fork, so every
+    DataLoader worker builds its own pool on first use.
+    """
+
+    def __init__(self, endpoint, max_size=8, timeout=60.0):
+        parts = urlsplit(endpoint)
+        self.host = parts.hostname
+        self.port = parts.port
+        self.https = parts.scheme == "https"
+        self.max_size = max_size
+        self.timeout = timeout
+        self.created = 0
+        self._idle = []
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        self.created += 1
+        cls = http.client.HTTPSConnection if self.https else http.client.HTTPConnection
+        return cls(self.host, self.port, timeout=self.timeout)
+
+    def request(self, method, url, headers=None):
+        """
+        Sends one request and returns (status, headers, body). A connection
+        that the server closed while idle is replaced and the request resent
+        once.
+        """
+        for attempt in range(2):
+            with self._lock:
+                conn = self._idle.pop() if self._idle else None
+            fresh = conn is None
+            if fresh:
+                conn = self._connect()
+            try:
+                conn.request(method, url, headers=headers or {})
+                response = conn.getresponse()
+                body = response.read()
+            except (http.client.HTTPException, ConnectionError, OSError):
+                conn.close()
+                if fresh or attempt == 1:
+                    raise
+                continue
+            with self._lock:
+                if len(self._idle) < self.max_size and not response.will_close:
+                    self._idle.append(conn)
+                else:
+                    conn.close()
+            return response.status, response.headers, body
+
+    def close(self):
+        with self._lock:
+            for conn in self._idle:
+                conn.close()
+            self._idle = []
+
+
+class HttpRangeBackend(StorageBackend):
+    """
+    Reads volumes from an S3-style HTTP endpoint. Local paths under `data_dir`
+    map to keys in `bucket`, so the rest of the loader keeps working with the
+    same file names.
+
+    Whole-file reads are split into `chunk_size` range requests issued
+    `concurrency` at a time over pooled keep-alive connections. Smaller range
+    reads (headers, crop slabs) go through a chunk-level LRU cache of
+    `cache_size` bytes and schedule `readahead` following chunks in the
+    background.
+    """
+
+    name = "s3"
+
+    def __init__(
+        self,
+        endpoint,
+        bucket,
+        data_dir="",
+        chunk_size=8 * 2**20,
+        concurrency=4,
+        readahead=2,
+        cache_size=256 * 2**20,
+        pool_size=8,
+    ):
+        super().__init__()
+        self.endpoint = endpoint.rstrip("/")
+        self.bucket = bucket
+        self.data_dir = data_dir.rstrip("/")
+        self.chunk_size = chunk_size
+        self.concurrency = concurrency
+        self.readahead = readahead
+        self.cache_size = cache_size
+        self.pool_size = pool_size
+        self.requests = 0
+        self.cache_hits = 0
+        self._sizes = {}
+        self._reset()
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._pool = ConnectionPool(self.endpoint, max_size=self.pool_size)
+        self._executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        self._cache = OrderedDict()
+        self._cached_bytes = 0
+        self._inflight = {}
+        self._lock = threading.Lock()
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        for key in ("_pool", "_executor", "_cache", "_inflight", "_lock"):
+            state.pop(key)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._reset()
+
+    def _check_fork(self):
+        if self._pid != os.getpid():
+            self._reset()
+
+    def key(self, path):
+        if self.data_dir and path.startswith(self.data_dir + "/"):
+            return path[len(self.data_dir) + 1 :]
+        return path.lstrip("/")
+
+    def _url(self, path):
+        return f"/{self.bucket}/{quote(self.key(path))}"
+
+    def _get(self, path, start, end):
+        """Fetches bytes [start, end) of `path`."""
+        status, _, body = self._pool.request(
+            "GET", self._url(path), {"Range": f"bytes={start}-{end - 1}"}
+        )
+        self.requests += 1
+        if status not in (200, 206):
+            raise OSError(f"GET {self._url(path)} returned HTTP {status}")
+        if status == 200:
+            body = body[start:end]
+        return body
+
+    def size(self, path):
+        self._check_fork()
+        if path not in self._sizes:
+            status, headers, _ = self._pool.request("HEAD", self._url(path))
+            self.meta_ops += 1
+            if status != 200:
+                raise FileNotFoundError(
+                    f"HEAD {self._url(path)} returned HTTP {status}"
+                )
+            self._sizes[path] = int(headers["Content-Length"])
+        return self._sizes[path]
+
+    def glob(self, path, pattern):
+        self._check_fork()
+        prefix = self.key(path.rstrip("/") + "/x")[:-1] if path else ""
+        keys, token = [], None
+        while True:
+            query = {"list-type": "2", "prefix": prefix}
+            if token:
+                query["continuation-token"] = token
+            status, _, body = self._pool.request(
+                "GET", f"/{self.bucket}?{urlencode(query)}"
+            )
+            self.meta_ops += 1
+            if status != 200:
+                raise OSError(f"Listing {self.bucket}/{prefix} returned HTTP {status}")
+            root = ET.fromstring(body)
+            for item in root.iter(f"{S3_NS}Contents"):
+                key = item.find(f"{S3_NS}Key").text
+                self._sizes[os.path.join(self.data_dir, key)] = int(
+                    item.find(f"{S3_NS}Size").text
+                )
+                keys.append(key)
+            truncated = root.find(f"{S3_NS}IsTruncated")
+            token_el = root.find(f"{S3_NS}NextContinuationToken")
+            if truncated is None or truncated.text != "true" or token_el is None:
+                break
+            token = token_el.text
+        names = [k[len(prefix) :] for k in keys if "/" not in k[len(prefix) :]]
+        return sorted(
+            os.path.join(path, n) for n in names if fnmatch.fnmatch(n, pattern)
+        )
+
+    def read(self, path):
+        self._check_fork()
+        size = self.size(path)
+        buffer = bytearray(size)
+        ranges = [
+            (start, min(size, start + self.chunk_size))
+            for start in range(0, size, self.chunk_size)
+        ]
+
+        def fetch(r):
+            start, end = r
+            buffer[start:end] = self._get(path, start, end)
+
+        list(self._executor.map(fetch, ranges))
+        self.bytes_read += size
+        self.reads += 1
+        return buffer
+
+    def _chunk(self, path, index):
+        key = (path, index)
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                self.cache_hits += 1
+                return self._cache[key]
+            future = self._inflight.get(key)
+            if future is None:
+                future = self._executor.submit(self._fetch_chunk, path, index)
+                self._inflight[key] = future
+        return future.result()
+
+    def _fetch_chunk(self, path, index):
+        start = index * self.chunk_size
+        end = min(self.size(path), start + self.chunk_size)
+        key = (path, index)
+        try:
+            data = self._get(path, start, end)
+        finally:
+            # a failed fetch must not stay in flight, or every later read of
+            # the chunk would get its exception
+            with self._lock:
+                self._inflight.pop(key, None)
+        with self._lock:
+            # fetched bytes, read-ahead included, like the POSIX backends
+            self.bytes_read += len(data)
+            self._cache[key] = data
+            self._cached_bytes += len(data)
+            while self._cached_bytes > self.cache_size and len(self._cache) > 1:
+                _, evicted = self._cache.popitem(last=False)
+                self._cached_bytes -= len(evicted)
+        return data
+
+    def _prefetch(self, path, index):
+        key = (path, index)
+        with self._lock:
+            if key in self._cache or key in self._inflight:
+                return
+            self._inflight[key] = self._executor.submit(self._fetch_chunk, path, index)
+
+    def read_range(self, path, offset, length):
+        self._check_fork()
+        size = self.size(path)
+        end = min(size, offset + length)
+        if end <= offset:
+            return b""
+        first, last = offset // self.chunk_size, (end - 1) // self.chunk_size
+        for index in range(
+            last + 1, min(last + 1 + self.readahead, -(-size // self.chunk_size))
+        ):
+            self._prefetch(path, index)
+        chunks = [self._chunk(path, i) for i in range(first, last + 1)]
+        data = b"".join(chunks)
+        base = first * self.chunk_size
+        self.reads += 1
+        return data[offset - base : end - base]
+
+    def stats(self):
+        return {
+            **super().stats(),
+            "requests": self.requests,
+            "cache_hits": self.cache_hits,
+            "connections": self._pool.created,
+        }
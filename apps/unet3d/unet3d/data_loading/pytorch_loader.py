@@ -11,14 +11,18 @@ from dftracer.python import dftracer, ai
 from src.mpi_utils import MPIUtils
 from src.logging import log0
 
+from apps.unet3d.unet3d.data_loading.storage import PosixBackend
 
-def get_train_transforms():
+
+def get_train_transforms(layout="NCDHW"):
     rand_flip = RandFlip()
     cast = Cast(types=(np.float32, np.uint8))
     rand_scale = RandomBrightnessAugmentation(factor=0.3, prob=0.1)
     rand_noise = GaussianNoise(mean=0.0, std=0.1, prob=0.1)
-    train_transforms = transforms.Compose([rand_flip, cast, rand_scale, rand_noise])
-    return train_transforms
+    train_transforms = [rand_flip, cast, rand_scale, rand_noise]
+    if layout != "NCDHW":
+        train_transforms.append(ToLayout(layout))
+    return transforms.Compose(train_transforms)
 
 
 class RandBalancedCrop:
@@ -35,6 +39,25 @@ class RandBalancedCrop:
         data.update({"image": image, "label": label})
         return data
 
+    def load_cropped(self, storage, image_path, label_path):
+        """
+        Same crops and random stream as `__call__`, but a plain random crop
+        only reads the depth slab it covers instead of the whole volume. The
+        foreground crop needs the full label, so it still loads everything.
+        """
+        if random.random() < self.oversampling:
+            image, label, _ = self.rand_foreg_cropd(
+                storage.load(image_path), storage.load(label_path)
+            )
+        else:
+            shape = storage.shape(image_path)
+            low_x, high_x, low_y, high_y, low_z, high_z = self._crop_cords(shape)
+            image = storage.load_slab(image_path, low_x, high_x)
+            label = storage.load_slab(label_path, low_x, high_x)
+            image = image[:, :, low_y:high_y, low_z:high_z]
+            label = label[:, :, low_y:high_y, low_z:high_z]
+        return {"image": image, "label": label}
+
     @staticmethod
     def randrange(max_range):
         return 0 if max_range == 0 else random.randrange(max_range)
@@ -42,12 +65,16 @@ class RandBalancedCrop:
     def get_cords(self, cord, idx):
         return cord[idx], cord[idx] + self.patch_size[idx]
 
-    def _rand_crop(self, image, label):
-        ranges = [s - p for s, p in zip(image.shape[1:], self.patch_size)]
+    def _crop_cords(self, shape):
+        ranges = [s - p for s, p in zip(shape[1:], self.patch_size)]
         cord = [self.randrange(x) for x in ranges]
         low_x, high_x = self.get_cords(cord, 0)
         low_y, high_y = self.get_cords(cord, 1)
         low_z, high_z = self.get_cords(cord, 2)
+        return low_x, high_x, low_y, high_y, low_z, high_z
+
+    def _rand_crop(self, image, label):
+        low_x, high_x, low_y, high_y, low_z, high_z = self._crop_cords(image.shape)
         image = image[:, low_x:high_x, low_y:high_y, low_z:high_z]
         label = label[:, low_x:high_x, low_y:high_y, low_z:high_z]
         return image, label, [low_x, high_x, low_y, high_y, low_z, high_z]
@@ -116,6 +143,19 @@ class Cast:
         return data
 
 
+class ToLayout:
+    """Moves the channel axis of (C, D, H, W) volumes last for NDHWC."""
+
+    def __init__(self, layout):
+        self.layout = layout
+
+    def __call__(self, data):
+        if self.layout == "NDHWC":
+            for key in ("image", "label"):
+                data[key] = np.ascontiguousarray(np.moveaxis(data[key], 0, -1))
+        return data
+
+
 class RandomBrightnessAugmentation:
     def __init__(self, factor, prob):
         self.prob = prob
@@ -163,9 +203,11 @@ class PytTrain(PytDataset):
     def __init__(self, images, labels, **kwargs):
         super().__init__()
         self.images, self.labels = images, labels
-        self.train_transforms = get_train_transforms()
+        self.storage = kwargs.get("storage") or PosixBackend()
+        self.train_transforms = get_train_transforms(kwargs.get("layout", "NCDHW"))
         patch_size, oversampling = kwargs["patch_size"], kwargs["oversampling"]
         self.patch_size = patch_size
+        self.crop_aware = kwargs.get("crop_aware", False)
         self.rand_crop = RandBalancedCrop(
             patch_size=patch_size, oversampling=oversampling
         )
@@ -194,9 +236,17 @@ class PytTrain(PytDataset):
         #     data = self.train_transforms(data)
         # return data["image"], data["label"]
 
+        if self.crop_aware:
+            data = self.rand_crop.load_cropped(
+                self.storage, self.images[idx], self.labels[idx]
+            )
+            with ai.data.preprocess:
+                data = self.train_transforms(data)
+            return data["image"], data["label"]
+
         data = {
-            "image": np.load(self.images[idx])['data'],
-            "label": np.load(self.labels[idx])['data'],
+            "image": self.storage.load(self.images[idx]),
+            "label": self.storage.load(self.labels[idx]),
         }
         with ai.data.preprocess:
             data = self.rand_crop(data)
@@ -206,9 +256,11 @@ class PytTrain(PytDataset):
 
 
 class PytVal(PytDataset):
-    def __init__(self, images, labels):
+    def __init__(self, images, labels, storage=None, layout="NCDHW"):
         super().__init__()
         self.images, self.labels = images, labels
+        self.storage = storage or PosixBackend()
+        self.to_layout = ToLayout(layout)
 
     @ai.data.derive("worker.init")
     def worker_init(self, worker_id):
@@ -228,8 +280,9 @@ class PytVal(PytDataset):
 
         # @ray: this is npz, we can directly load without worrying about memmap
         data = {
-            "image": np.load(self.images[idx])['data'],
-            "label": np.load(self.labels[idx])['data'],
+            "image": self.storage.load(self.images[idx]),
+            "label": self.storage.load(self.labels[idx]),
         }
+        data = self.to_layout(data)
         return data["image"], data["label"]
 
@@ -0,0 +1,130 @@
+import time
+import logging
+import threading
+
+import torch
+
+from src.logging import log0
+
+log = logging.getLogger(__name__)
+
+
+def _batch_nbytes(batch):
+    return sum(t.numel() * t.element_size() for t in batch)
+
+
+class ResidentValLoader:
+    """
+    Keeps this rank's validation shard resident after the first pass so later
+    evaluations iterate it from memory instead of re-reading every volume.
+
+    `placement` is "host" (pinned host memory when a GPU is present) or
+    "device". Device placement falls back to host when the shard does not fit
+    in the free device memory with some headroom left for inference.
+
+    `start()` loads the shard on a background thread so the first load
+    overlaps with training; iterating before it finishes waits for it.
+    The current CUDA device is a per-thread setting, so a "cuda" device
+    without an index is pinned to the constructing thread's device.
+    """
+
+    def __init__(self, loader, placement="host", device=None, headroom=0.5):
+        self.loader = loader
+        self.placement = placement
+        if device is not None:
+            device = torch.device(device)
+            if device.type == "cuda" and device.index is None:
+                device = torch.device("cuda", torch.cuda.current_device())
+        self.device = device
+        self.headroom = headroom
+        self.batches = []
+        self.nbytes = 0
+        self.load_time = None
+        self._thread = None
+        self._error = None
+        self._reported = False
+
+    @property
+    def dataset(self):
+        return self.loader.dataset
+
+    def __len__(self):
+        return len(self.loader)
+
+    def start(self):
+        if self._thread is None and self.load_time is None:
+            self._thread = threading.Thread(
+                target=self._load, name="resident-val-loader", daemon=True
+            )
+            self._thread.start()
+        return self
+
+    def _fits_on_device(self, nbytes):
+        if self.device is None or not torch.cuda.is_available():
+            return False
+        free, _ = torch.cuda.mem_get_info(self.device)
+        return nbytes < free * (1.0 - self.headroom)
+
+    def _load(self):
+        if self.device is not None and self.device.type == "cuda":
+            with torch.cuda.device(self.device):
+                self._load_shard()
+        else:
+            self._load_shard()
+
+    def _load_shard(self):
+        try:
+            t0 = time.perf_counter()
+            batches = []
+            pin = torch.cuda.is_available()
+            for batch in self.loader:
+                batch = [
+                    t.pin_memory() if pin and not t.is_pinned() else t for t in batch
+                ]
+                batches.append(batch)
+            nbytes = sum(_batch_nbytes(b) for b in batches)
+            if self.placement == "device":
+                if self._fits_on_device(nbytes):
+                    batches = [
+                        [t.to(self.device, non_blocking=True) for t in b]
+                        for b in batches
+                    ]
+                    torch.cuda.synchronize(self.device)
+                else:
+                    log.warning(
+                        f"Validation shard ({nbytes / 2**20:.1f} MiB) does not fit "
+                        f"on device, keeping it in host memory"
+                    )
+                    self.placement = "host"
+            self.batches, self.nbytes = batches, nbytes
+            self.load_time = time.perf_counter() - t0
+        except Exception as e:  # re-raised on the main thread in wait()
+            self._error = e
+
+    def wait(self):
+        if self.load_time is None:
+            if self._thread is None:
+                self._load()
+            else:
+                self._thread.join()
+                self._thread = None
+        if self._error is not None:
+            raise self._error
+
+    def __iter__(self):
+        t0 = time.perf_counter()
+        self.wait()
+        stall = time.perf_counter() - t0
+        if not self._reported:
+            log0(
+                f"Resident validation set: {len(self.batches)} volumes, "
+                f"{self.nbytes / 2**20:.1f} MiB in {self.placement} memory, "
+                f"loaded in {self.load_time:.2f} s (waited {stall:.2f} s)"
+            )
+            self._reported = True
+        else:
+            log0(
+                f"Resident validation set: skipped {self.load_time:.2f} s of "
+                f"reads for this evaluation"
+            )
+        return iter(self.batches)
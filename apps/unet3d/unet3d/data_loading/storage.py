@@ -0,0 +1,815 @@
+import io
+import os
+import glob
+import json
+import mmap
+import time
+import random
+import struct
+import logging
+import threading
+import weakref
+import zipfile
+from abc import ABC, abstractmethod
+from collections import OrderedDict, deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from multiprocessing.util import Finalize
+
+import numpy as np
+import torch
+
+from src.mpi_utils import MPIUtils
+
+log = logging.getLogger(__name__)
+
+# O_DIRECT needs buffer address, file offset and length aligned to the
+# logical block size of the device; 4 KiB covers every filesystem we run on.
+DIRECT_IO_ALIGNMENT = 4096
+
+
+class _BufferFile(io.RawIOBase):
+    """Seekable read-only file over a buffer, without copying it."""
+
+    def __init__(self, buffer):
+        super().__init__()
+        self._buffer = memoryview(buffer).cast("B")
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_CUR:
+            self._pos += offset
+        else:
+            self._pos = len(self._buffer) + offset
+        return self._pos
+
+    def readinto(self, b):
+        n = max(0, min(len(b), len(self._buffer) - self._pos))
+        b[:n] = self._buffer[self._pos : self._pos + n]
+        self._pos += n
+        return n
+
+
+def read_npy_header(f):
+    """Returns (shape, fortran_order, dtype) and leaves `f` at the payload."""
+    version = np.lib.format.read_magic(f)
+    if version == (1, 0):
+        return np.lib.format.read_array_header_1_0(f)
+    return np.lib.format.read_array_header_2_0(f)
+
+
+def decode_npy(buffer):
+    """
+    Decodes an .npy image held in `buffer` into an array that shares memory
+    with the buffer.
+    """
+    f = _BufferFile(buffer)
+    shape, fortran_order, dtype = read_npy_header(f)
+    count = int(np.prod(shape))
+    array = np.frombuffer(buffer, dtype=dtype, count=count, offset=f.tell())
+    return array.reshape(shape, order="F" if fortran_order else "C")
+
+
+def decode_npz(buffer, key="data"):
+    """
+    Decodes member `key` of an .npz image held in `buffer`. Stored members
+    (np.savez) are decoded in place; compressed ones are inflated first.
+    """
+    with zipfile.ZipFile(_BufferFile(buffer)) as zf:
+        info = zf.getinfo(f"{key}.npy")
+        if info.compress_type != zipfile.ZIP_STORED:
+            return decode_npy(bytearray(zf.read(info)))
+    view = memoryview(buffer).cast("B")
+    # local file header: 30 fixed bytes, then file name and extra field
+    name_len, extra_len = struct.unpack(
+        "<HH", view[info.header_offset + 26 : info.header_offset + 30]
+    )
+    start = info.header_offset + 30 + name_len + extra_len
+    return decode_npy(view[start : start + info.file_size])
+
+
+def decode_volume(buffer, path):
+    if path.endswith(".npz"):
+        return decode_npz(buffer)
+    return decode_npy(buffer)
+
+
+class _RangeFile(io.RawIOBase):
+    """Seekable file over `backend.read_range`, used to parse headers."""
+
+    def __init__(self, backend, path, size):
+        super().__init__()
+        self._backend = backend
+        self._path = path
+        self._size = size
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_CUR:
+            self._pos += offset
+        else:
+            self._pos = self._size + offset
+        return self._pos
+
+    def readinto(self, b):
+        length = max(0, min(len(b), self._size - self._pos))
+        if length == 0:
+            return 0
+        data = self._backend.read_range(self._path, self._pos, length)
+        b[: len(data)] = data
+        self._pos += len(data)
+        return len(data)
+
+
+class StorageBackend(ABC):
+    """
+    How `PytTrain`/`PytVal` get volumes off storage. Backends read whole files
+    (or byte ranges) into a buffer; decoding is shared. Every backend counts
+    the bytes it read and the metadata operations (open/stat) it issued.
+    """
+
+    name = ""
+
+    def __init__(self):
+        self.bytes_read = 0
+        self.reads = 0
+        self.meta_ops = 0
+
+    @abstractmethod
+    def read(self, path):
+        """Returns a writable buffer with the full contents of `path`."""
+
+    def read_range(self, path, offset, length):
+        with open(path, "rb") as f:
+            self.meta_ops += 1
+            f.seek(offset)
+            data = f.read(length)
+        self.bytes_read += len(data)
+        self.reads += 1
+        return data
+
+    def size(self, path):
+        self.meta_ops += 1
+        return os.stat(path).st_size
+
+    def glob(self, path, pattern):
+        self.meta_ops += 1
+        return sorted(glob.glob(os.path.join(path, pattern)))
+
+    def load(self, path):
+        return decode_volume(self.read(path), path)
+
+    def layout(self, path):
+        """
+        (payload offset, shape, dtype, fortran order) of the array stored in
+        `path`, read from its headers with range reads. The payload offset is
+        None for compressed npz members, which cannot be read by range.
+        """
+        cache = self.__dict__.setdefault("_layouts", {})
+        if path not in cache:
+            f = _RangeFile(self, path, self.size(path))
+            start = 0
+            if path.endswith(".npz"):
+                with zipfile.ZipFile(f) as zf:
+                    info = zf.getinfo("data.npy")
+                header = self.read_range(path, info.header_offset + 26, 4)
+                name_len, extra_len = struct.unpack("<HH", header)
+                start = info.header_offset + 30 + name_len + extra_len
+                if info.compress_type != zipfile.ZIP_STORED:
+                    start = None
+            if start is None:
+                with zipfile.ZipFile(f) as zf, zf.open("data.npy") as member:
+                    shape, fortran_order, dtype = read_npy_header(member)
+                cache[path] = (None, shape, dtype, fortran_order)
+            else:
+                f.seek(start)
+                shape, fortran_order, dtype = read_npy_header(f)
+                cache[path] = (f.tell(), shape, dtype, fortran_order)
+        return cache[path]
+
+    def shape(self, path):
+        return self.layout(path)[1]
+
+    def load_slab(self, path, low, high):
+        """
+        Loads `volume[:, low:high]` of a (1, D, H, W) volume by reading only
+        the bytes of that slab. Falls back to a full load where the slab is not
+        contiguous on storage.
+        """
+        offset, shape, dtype, fortran_order = self.layout(path)
+        if offset is None or fortran_order or shape[0] != 1:
+            return np.ascontiguousarray(self.load(path)[:, low:high])
+        row = int(np.prod(shape[2:])) * dtype.itemsize
+        data = self.read_range(path, offset + low * row, (high - low) * row)
+        slab = np.frombuffer(bytearray(data), dtype=dtype)
+        return slab.reshape((1, high - low, *shape[2:]))
+
+    def stats(self):
+        return {
+            "bytes_read": self.bytes_read,
+            "reads": self.reads,
+            "meta_ops": self.meta_ops,
+        }
+
+
+class PosixBackend(StorageBackend):
+    """Plain buffered read of the whole file, the baseline behaviour."""
+
+    name = "posix"
+
+    def read(self, path):
+        with open(path, "rb", buffering=0) as f:
+            size = os.fstat(f.fileno()).st_size
+            self.meta_ops += 2
+            buffer = bytearray(size)
+            view = memoryview(buffer)
+            pos = 0
+            while pos < size:
+                n = f.readinto(view[pos:])
+                if not n:
+                    break
+                pos += n
+        self.bytes_read += pos
+        self.reads += 1
+        return buffer
+
+
+class MmapBackend(StorageBackend):
+    """
+    Copy-on-write mapping of the file; pages are read on first touch, so a
+    random crop only faults in the slabs it covers.
+    """
+
+    name = "mmap"
+
+    def read(self, path):
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            self.meta_ops += 2
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_COPY)
+        # an upper bound; the kernel only reads the pages that get touched
+        self.bytes_read += size
+        self.reads += 1
+        return buffer
+
+
+class MemoryBackend(StorageBackend):
+    """
+    Keeps file contents in a per-process LRU cache of `capacity` bytes on top
+    of `inner`. Each DataLoader worker holds its own cache. Loaded arrays are
+    copies so the pipeline can never modify the cached bytes.
+    """
+
+    name = "memory"
+
+    def __init__(self, inner=None, capacity=16 * 2**30):
+        super().__init__()
+        self.inner = inner or PosixBackend()
+        self.capacity = capacity
+        self.hits = 0
+        self._cache = OrderedDict()
+        self._cached_bytes = 0
+
+    def read(self, path):
+        if path in self._cache:
+            self._cache.move_to_end(path)
+            self.hits += 1
+            return self._cache[path]
+        buffer = self.inner.read(path)
+        self.bytes_read += len(buffer)
+        self.reads += 1
+        self.meta_ops = self.inner.meta_ops
+        if len(buffer) <= self.capacity:
+            self._cache[path] = buffer
+            self._cached_bytes += len(buffer)
+            while self._cached_bytes > self.capacity:
+                _, evicted = self._cache.popitem(last=False)
+                self._cached_bytes -= len(evicted)
+        return buffer
+
+    def load(self, path):
+        return decode_volume(self.read(path), path).copy()
+
+    def stats(self):
+        return {**super().stats(), "hits": self.hits}
+
+
+class DirectBackend(StorageBackend):
+    """
+    Reads with O_DIRECT into page-aligned buffers in `block_size` chunks,
+    bypassing the page cache so repeated epochs measure the storage rather
+    than host memory. Falls back to buffered reads where the filesystem
+    rejects O_DIRECT (e.g. tmpfs).
+    """
+
+    name = "direct"
+
+    def __init__(self, block_size=4 * 2**20):
+        super().__init__()
+        if not hasattr(os, "O_DIRECT"):
+            raise RuntimeError("O_DIRECT is not supported on this platform")
+        self.block_size = max(
+            DIRECT_IO_ALIGNMENT, block_size - block_size % DIRECT_IO_ALIGNMENT
+        )
+        self._fallback = None
+
+    def read(self, path):
+        try:
+            fd = os.open(path, os.O_RDONLY | os.O_DIRECT)
+        except OSError:
+            return self._read_fallback(path)
+        try:
+            size = os.fstat(fd).st_size
+            self.meta_ops += 2
+            padded = max(
+                DIRECT_IO_ALIGNMENT,
+                -(-size // DIRECT_IO_ALIGNMENT) * DIRECT_IO_ALIGNMENT,
+            )
+            # anonymous mappings are page aligned, as O_DIRECT requires
+            buffer = mmap.mmap(-1, padded)
+            view = memoryview(buffer)
+            pos = 0
+            while pos < size:
+                try:
+                    n = os.readv(fd, [view[pos : pos + self.block_size]])
+                except OSError:
+                    view.release()
+                    buffer.close()
+                    return self._read_fallback(path)
+                if n == 0:
+                    break
+                pos += n
+        finally:
+            os.close(fd)
+        self.bytes_read += pos
+        self.reads += 1
+        return view[:size]
+
+    def _read_fallback(self, path):
+        if self._fallback is None:
+            log.warning(f"O_DIRECT read of {path} failed, using buffered reads")
+            self._fallback = PosixBackend()
+        buffer = self._fallback.read(path)
+        self.bytes_read += len(buffer)
+        self.reads += 1
+        self.meta_ops += 2
+        return buffer
+
+
+class EmulatedBackend(StorageBackend):
+    """
+    Wraps `inner` and stretches every read to what a remote filesystem with
+    the given characteristics would take: a fixed per-request latency, a
+    bandwidth cap and exponentially distributed jitter (mean `jitter_ms`),
+    which gives the long right tail seen on busy Lustre OSTs.
+
+    Jitter is drawn from a generator seeded by `seed`, the rank and the
+    DataLoader worker id, so runs are reproducible.
+    """
+
+    name = "emulated"
+
+    def __init__(
+        self, inner=None, latency_ms=0.0, bandwidth_mbps=0.0, jitter_ms=0.0, seed=0
+    ):
+        super().__init__()
+        self.inner = inner or PosixBackend()
+        self.latency = latency_ms / 1000.0
+        self.bandwidth = bandwidth_mbps * 2**20
+        self.jitter = jitter_ms / 1000.0
+        self.seed = seed
+        self._rng = None
+
+    def _delay(self, nbytes):
+        if self._rng is None:
+            worker = torch.utils.data.get_worker_info()
+            worker_id = worker.id if worker is not None else -1
+            self._rng = random.Random(hash((self.seed, MPIUtils.rank(), worker_id)))
+        delay = self.latency
+        if self.bandwidth > 0:
+            delay += nbytes / self.bandwidth
+        if self.jitter > 0:
+            delay += self._rng.expovariate(1.0 / self.jitter)
+        return delay
+
+    def _emulate(self, read_fn, *args):
+        t0 = time.perf_counter()
+        data = read_fn(*args)
+        remaining = self._delay(len(data)) - (time.perf_counter() - t0)
+        if remaining > 0:
+            time.sleep(remaining)
+        self.bytes_read += len(data)
+        self.reads += 1
+        self.meta_ops = self.inner.meta_ops
+        return data
+
+    def sleep(self, nbytes):
+        """Waits as long as a read of `nbytes` would take, without reading."""
+        delay = self._delay(nbytes)
+        if delay > 0:
+            time.sleep(delay)
+
+    def read(self, path):
+        return self._emulate(self.inner.read, path)
+
+    def read_range(self, path, offset, length):
+        return self._emulate(self.inner.read_range, path, offset, length)
+
+
+class LatencyHistogram:
+    """
+    Log-spaced latency histogram (bucket `i` holds latencies up to
+    `base_ms * growth**i` ms) that can be merged across workers and ranks.
+    """
+
+    def __init__(self, base_ms=0.0625, growth=2**0.5, num_buckets=48, counts=None):
+        self.base_ms = base_ms
+        self.growth = growth
+        self.counts = list(counts) if counts is not None else [0] * num_buckets
+
+    @property
+    def edges_ms(self):
+        return [self.base_ms * self.growth**i for i in range(len(self.counts))]
+
+    def add(self, seconds):
+        ms = seconds * 1000.0
+        i = 0
+        if ms > self.base_ms:
+            i = int(np.ceil(np.log(ms / self.base_ms) / np.log(self.growth)))
+        self.counts[min(i, len(self.counts) - 1)] += 1
+
+    def merge(self, other):
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        return self
+
+    def total(self):
+        return sum(self.counts)
+
+    def percentile(self, q):
+        """Upper bucket edge below which `q` percent of the samples fall [ms]."""
+        total = self.total()
+        if total == 0:
+            return 0.0
+        target = q / 100.0 * total
+        seen = 0
+        for edge, count in zip(self.edges_ms, self.counts):
+            seen += count
+            if seen >= target:
+                return edge
+        return self.edges_ms[-1]
+
+    def to_dict(self):
+        return {"base_ms": self.base_ms, "growth": self.growth, "counts": self.counts}
+
+    @staticmethod
+    def from_dict(d):
+        return LatencyHistogram(
+            base_ms=d["base_ms"], growth=d["growth"], counts=d["counts"]
+        )
+
+
+class HedgedBackend(StorageBackend):
+    """
+    Cuts the storage tail for a DDP step, which waits for the slowest read on
+    the slowest rank.
+
+    Latencies of recent reads are kept in a rolling window, one for whole
+    files and one for ranges. Once a read takes longer than the `percentile`
+    of its window, a duplicate read of the same file or range is issued
+    against `replica_dir` (a second copy of the dataset or a node-local cache
+    tier) and whichever finishes first wins; a losing read that has not
+    started is cancelled. Failed reads are retried up to `max_retries` times
+    with capped exponential backoff.
+
+    Losing reads that hang keep their thread, so the thread pool is replaced
+    by a larger one once all its threads are busy, instead of queueing new
+    reads behind the stuck ones.
+
+    Per-read latency histograms and hedge/retry counters are written to
+    `stats_dir` every `flush_every` reads, one file per process tagged with
+    `run_id`. A process that reads also writes its file when it exits, and
+    `flush_storage_stats` writes the files of the calling process.
+    """
+
+    name = "hedged"
+
+    def __init__(
+        self,
+        primary,
+        secondary=None,
+        data_dir="",
+        replica_dir="",
+        percentile=95.0,
+        window=256,
+        min_samples=16,
+        max_retries=3,
+        backoff_ms=50.0,
+        max_backoff_ms=2000.0,
+        stats_dir="",
+        flush_every=64,
+        run_id="",
+        min_threads=4,
+    ):
+        super().__init__()
+        self.primary = primary
+        self.secondary = secondary
+        self.data_dir = data_dir.rstrip("/")
+        self.replica_dir = replica_dir.rstrip("/")
+        self.percentile = percentile
+        self.window = window
+        self.min_samples = min_samples
+        self.max_retries = max_retries
+        self.backoff = backoff_ms / 1000.0
+        self.max_backoff = max_backoff_ms / 1000.0
+        self.stats_dir = stats_dir
+        self.flush_every = flush_every
+        self.run_id = run_id
+        self.min_threads = min_threads
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.retries = 0
+        self.failures = 0
+        self.histogram = LatencyHistogram()
+        self._recent = {
+            "read": deque(maxlen=window),
+            "read_range": deque(maxlen=window),
+        }
+        self._pool = None
+        self._pool_size = 0
+        self._busy = 0
+        self._pid = None
+        self._lock = threading.Lock()
+        self._flush_pid = None
+        _hedged_backends.add(self)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state["_pool"], state["_pid"], state["_lock"] = None, None, None
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.Lock()
+        _hedged_backends.add(self)
+
+    def _submit(self, fn, *args):
+        # thread pools and locks do not survive the fork into DataLoader workers
+        if self._pid != os.getpid():
+            self._pool, self._pool_size, self._busy = None, 0, 0
+            self._lock = threading.Lock()
+            self._pid = os.getpid()
+        with self._lock:
+            if self._busy >= self._pool_size:
+                if self._pool is not None:
+                    self._pool.shutdown(wait=False)
+                self._pool_size = max(self.min_threads, 2 * (self._busy + 1))
+                self._pool = ThreadPoolExecutor(max_workers=self._pool_size)
+            self._busy += 1
+            future = self._pool.submit(fn, *args)
+        future.add_done_callback(self._release)
+        return future
+
+    def _release(self, future):
+        with self._lock:
+            self._busy -= 1
+
+    def _track_process(self):
+        if self._flush_pid == os.getpid():
+            return
+        if self._flush_pid is not None:
+            # a forked worker starts from the counters of its parent, which
+            # the parent reports itself
+            self.bytes_read = self.reads = 0
+            self.hedges = self.hedge_wins = self.retries = self.failures = 0
+            self.histogram = LatencyHistogram()
+        self._flush_pid = os.getpid()
+        if self.stats_dir:
+            # DataLoader workers leave through os._exit, which skips atexit
+            # handlers but still runs the multiprocessing finalizers
+            Finalize(self, self.flush_stats, exitpriority=10)
+
+    def _replica_path(self, path):
+        if not self.replica_dir or self.secondary is None:
+            return None
+        if self.data_dir and path.startswith(self.data_dir + "/"):
+            return self.replica_dir + path[len(self.data_dir) :]
+        return os.path.join(self.replica_dir, os.path.basename(path))
+
+    def _threshold(self, method):
+        recent = self._recent[method]
+        if len(recent) < self.min_samples:
+            return None
+        return float(np.percentile(recent, self.percentile))
+
+    def _hedged_read(self, method, path, *args):
+        primary = self._submit(getattr(self.primary, method), path, *args)
+        replica = self._replica_path(path)
+        threshold = self._threshold(method)
+        if replica is None or threshold is None:
+            return primary.result()
+
+        done, _ = wait([primary], timeout=threshold)
+        if done:
+            return primary.result()
+
+        self.hedges += 1
+        hedge = self._submit(getattr(self.secondary, method), replica, *args)
+        pending = {primary, hedge}
+        error = None
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is hedge:
+                        self.hedge_wins += 1
+                    # a started loser keeps running in the pool and is dropped
+                    for loser in pending:
+                        loser.cancel()
+                    return future.result()
+                error = future.exception()
+        raise error
+
+    def _read(self, method, path, *args):
+        """Retried and hedged `method` of the backends, recorded in the stats."""
+        self._track_process()
+        t0 = time.perf_counter()
+        for attempt in range(self.max_retries + 1):
+            try:
+                data = self._hedged_read(method, path, *args)
+                break
+            except OSError:
+                if attempt == self.max_retries:
+                    self.failures += 1
+                    raise
+                self.retries += 1
+                delay = min(self.max_backoff, self.backoff * 2**attempt)
+                time.sleep(delay * random.uniform(0.5, 1.0))
+        latency = time.perf_counter() - t0
+        self._recent[method].append(latency)
+        self.histogram.add(latency)
+        self.bytes_read += len(data)
+        self.reads += 1
+        self.meta_ops = self.primary.meta_ops + (
+            self.secondary.meta_ops if self.secondary is not None else 0
+        )
+        if self.stats_dir and self.reads % self.flush_every == 0:
+            self.flush_stats()
+        return data
+
+    def read(self, path):
+        return self._read("read", path)
+
+    def read_range(self, path, offset, length):
+        return self._read("read_range", path, offset, length)
+
+    def size(self, path):
+        return self.primary.size(path)
+
+    def glob(self, path, pattern):
+        return self.primary.glob(path, pattern)
+
+    def stats(self):
+        return {
+            **super().stats(),
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "retries": self.retries,
+            "failures": self.failures,
+            "p50_ms": self.histogram.percentile(50),
+            "p99_ms": self.histogram.percentile(99),
+            "histogram": self.histogram.to_dict(),
+        }
+
+    def flush_stats(self):
+        os.makedirs(self.stats_dir, exist_ok=True)
+        path = os.path.join(
+            self.stats_dir,
+            f"storage-{self.run_id}-rank{MPIUtils.rank()}-pid{os.getpid()}.json",
+        )
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(self.stats(), f)
+        os.replace(f"{path}.tmp", path)
+
+
+# hedged backends alive in this process, see flush_storage_stats
+_hedged_backends = weakref.WeakSet()
+
+
+def flush_storage_stats():
+    """Writes the stats of every hedged backend of this process that read."""
+    for backend in list(_hedged_backends):
+        if backend.stats_dir and backend.reads:
+            backend.flush_stats()
+
+
+def summarize_storage_stats(stats_dir, run_id=""):
+    """Merges the per-process files written by `HedgedBackend.flush_stats`."""
+    histogram = LatencyHistogram()
+    totals = {"reads": 0, "hedges": 0, "hedge_wins": 0, "retries": 0, "failures": 0}
+    pattern = f"storage-{run_id}-rank*-pid*.json"
+    for path in glob.glob(os.path.join(stats_dir, pattern)):
+        with open(path, "r") as f:
+            stats = json.load(f)
+        histogram.merge(LatencyHistogram.from_dict(stats["histogram"]))
+        for key in totals:
+            totals[key] += stats[key]
+    return {
+        **totals,
+        "p50_ms": histogram.percentile(50),
+        "p90_ms": histogram.percentile(90),
+        "p99_ms": histogram.percentile(99),
+        "p999_ms": histogram.percentile(99.9),
+    }
+
+
+storage_backends = {
+    "posix": PosixBackend,
+    "mmap": MmapBackend,
+    "memory": MemoryBackend,
+    "direct": DirectBackend,
+    "emulated": EmulatedBackend,
+}
+
+
+def get_storage_backend(flags):
+    backend = _make_backend(flags)
+    if not flags.storage_hedge and flags.storage_retries == 0:
+        return backend
+    if flags.storage_hedge and not flags.storage_replica_dir:
+        raise ValueError(
+            "--storage_hedge needs --storage_replica_dir, the copy of "
+            "--data_dir that slow reads are duplicated against"
+        )
+    if not flags.storage_stats_dir:
+        flags.storage_stats_dir = os.path.join(flags.output_dir, "storage-stats")
+    if not flags.storage_run_id:
+        # one tag for all ranks so that the stats of earlier runs are not merged
+        run_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"
+        flags.storage_run_id = MPIUtils.comm_world().bcast(run_id, root=0)
+    return HedgedBackend(
+        backend,
+        secondary=_make_backend(flags) if flags.storage_hedge else None,
+        data_dir=flags.data_dir,
+        replica_dir=flags.storage_replica_dir,
+        percentile=flags.storage_hedge_percentile,
+        max_retries=flags.storage_retries,
+        backoff_ms=flags.storage_retry_backoff_ms,
+        stats_dir=flags.storage_stats_dir,
+        run_id=flags.storage_run_id,
+    )
+
+
+def _make_backend(flags):
+    if flags.storage == "s3":
+        from apps.unet3d.unet3d.data_loading.object_store import HttpRangeBackend
+
+        return HttpRangeBackend(
+            flags.s3_endpoint,
+            flags.s3_bucket,
+            data_dir=flags.data_dir,
+            chunk_size=int(flags.s3_chunk_size * 2**20),
+            concurrency=flags.s3_concurrency,
+            readahead=flags.s3_readahead,
+            cache_size=int(flags.s3_cache_size * 2**20),
+            pool_size=flags.s3_pool_size,
+        )
+    if flags.storage not in storage_backends:
+        raise ValueError(
+            f"Storage backend {flags.storage} unknown. Valid backends are: "
+            f"{', '.join(storage_backends)}"
+        )
+    if flags.storage == "memory":
+        return MemoryBackend(capacity=int(flags.storage_memory_capacity * 2**30))
+    if flags.storage == "direct":
+        return DirectBackend(block_size=flags.storage_block_size * 2**10)
+    if flags.storage == "emulated":
+        inner = storage_backends[flags.storage_emulated_inner]()
+        return EmulatedBackend(
+            inner,
+            latency_ms=flags.storage_latency_ms,
+            bandwidth_mbps=flags.storage_bandwidth_mbps,
+            jitter_ms=flags.storage_jitter_ms,
+            seed=flags.seed,
+        )
+    return storage_backends[flags.storage]()
@@ -0,0 +1,211 @@
+import os
+import logging
+
+import numpy as np
+from torch.utils.data import Dataset
+
+from dftracer.python import ai
+
+from src.mpi_utils import MPIUtils
+from src.logging import log0
+
+from apps.unet3d.unet3d.data_loading.storage import EmulatedBackend
+
+log = logging.getLogger(__name__)
+
+
+class SyntheticDataset(Dataset):
+    """
+    Random samples of a fixed shape, generated on access from a generator
+    seeded by (`seed`, index), so the same index always yields the same
+    sample in every worker and on every rank and nothing is held in memory.
+
+    `shapes` optionally cycles the sample shape per index, e.g. to mirror the
+    varying volume sizes of a validation set.
+
+    I/O can be emulated per sample:
+    - `io_mode="file"` reads `io_bytes` from `io_path` through `storage`, at
+      an offset derived from the index
+    - `io_mode="sleep"` sleeps for the time `latency_model` (an
+      `EmulatedBackend`) assigns to a read of `io_bytes`
+    """
+
+    def __init__(
+        self,
+        channels_in=1,
+        channels_out=3,
+        shape=(128, 128, 128),
+        device="cpu",
+        layout="NCDHW",
+        scalar=False,
+        length=64,
+        seed=0,
+        image_dtype=np.float32,
+        label_dtype=np.uint8,
+        shapes=None,
+        io_mode="none",
+        io_bytes=0,
+        io_path="",
+        storage=None,
+        latency_model=None,
+    ):
+        self.channels_in = channels_in
+        self.channels_out = channels_out
+        self.shapes = [tuple(s) for s in shapes] if shapes else [tuple(shape)]
+        self.layout = layout
+        self.scalar = scalar
+        self.length = length
+        self.seed = seed
+        self.image_dtype = np.dtype(image_dtype)
+        self.label_dtype = np.dtype(label_dtype)
+        self.io_mode = io_mode
+        self.io_bytes = io_bytes
+        self.io_path = io_path
+        self.storage = storage
+        self.latency_model = latency_model
+        self.io_size = os.path.getsize(io_path) if io_mode == "file" else 0
+        if device != "cpu":
+            log.warning("SyntheticDataset generates samples on the host")
+
+    @ai.data.derive("worker.init")
+    def worker_init(self, worker_id):
+        log0(f"Initializing synthetic worker {worker_id} in rank {MPIUtils.rank()}")
+
+    def __len__(self):
+        return self.length
+
+    def _with_channels(self, shape, channels):
+        if self.layout == "NCDHW":
+            return (channels,) + shape
+        return shape + (channels,)
+
+    def _emulate_io(self, rng):
+        if self.io_mode == "file" and self.io_bytes > 0:
+            length = min(self.io_bytes, self.io_size)
+            offset = int(rng.integers(0, self.io_size - length + 1))
+            # keep offsets page aligned so every read touches fresh pages
+            offset -= offset % 4096
+            self.storage.read_range(self.io_path, offset, length)
+        elif self.io_mode == "sleep":
+            self.latency_model.sleep(self.io_bytes)
+
+    @ai.data.item
+    def __getitem__(self, idx):
+        rng = np.random.default_rng((self.seed, idx))
+        self._emulate_io(rng)
+        shape = self.shapes[idx % len(self.shapes)]
+        image = rng.random(
+            self._with_channels(shape, self.channels_in), dtype=np.float32
+        )
+        if self.image_dtype != np.float32:
+            image = image.astype(self.image_dtype)
+        if self.scalar:
+            label = rng.integers(
+                0, self.channels_out, size=self._with_channels(shape, 1), dtype=np.uint8
+            ).astype(self.label_dtype, copy=False)
+        else:
+            label = rng.random(
+                self._with_channels(shape, self.channels_out), dtype=np.float32
+            )
+        return image, label
+
+
+def real_data_profile(storage, data_dir, data_format, max_files=16):
+    """
+    Dtypes, channel count, volume shapes and mean on-storage bytes per case
+    of the dataset in `data_dir`, read from the headers of up to `max_files`
+    cases.
+    """
+    images = storage.glob(data_dir, f"*_x.{data_format}")
+    assert len(images) > 0, f"Found no data at {data_dir}"
+    step = max(1, len(images) // max_files)
+    shapes, nbytes = [], []
+    for path in images[::step][:max_files]:
+        label_path = path.replace(f"_x.{data_format}", f"_y.{data_format}")
+        _, shape, image_dtype, _ = storage.layout(path)
+        _, _, label_dtype, _ = storage.layout(label_path)
+        shapes.append(shape[1:])
+        nbytes.append(storage.size(path) + storage.size(label_path))
+    return {
+        "channels_in": shape[0],
+        "image_dtype": image_dtype,
+        "label_dtype": label_dtype,
+        "shapes": shapes,
+        "case_bytes": int(np.mean(nbytes)),
+    }
+
+
+def ensure_scratch_file(path, size, chunk_size=64 * 2**20):
+    """
+    Creates `path` with `size` bytes of random data if it is missing or too
+    small. Random rather than sparse so that reads hit the device.
+    """
+    if os.path.exists(path) and os.path.getsize(path) >= size:
+        return
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+    rng = np.random.default_rng(0)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        written = 0
+        while written < size:
+            n = min(chunk_size, size - written)
+            f.write(rng.integers(0, 256, size=n, dtype=np.uint8).tobytes())
+            written += n
+    os.replace(tmp_path, path)
+
+
+def get_synthetic_datasets(flags, storage):
+    """Train and validation `SyntheticDataset`s configured from `flags`."""
+    train_kwargs = {"channels_in": 1, "shape": flags.input_shape}
+    val_kwargs = {"channels_in": 1, "shape": flags.val_input_shape}
+    # one patch of the default pipeline: float32 image and uint8 label
+    io_bytes = int(np.prod(flags.input_shape)) * 5
+    if flags.synthetic_like_data:
+        profile = None
+        if MPIUtils.rank() == 0:
+            profile = real_data_profile(storage, flags.data_dir, flags.data_format)
+        profile = MPIUtils.comm_world().bcast(profile, root=0)
+        # training patches are cast by the transforms, evaluation volumes are not
+        train_kwargs["channels_in"] = profile["channels_in"]
+        val_kwargs.update(
+            channels_in=profile["channels_in"],
+            image_dtype=profile["image_dtype"],
+            label_dtype=profile["label_dtype"],
+            shapes=profile["shapes"],
+        )
+        io_bytes = profile["case_bytes"]
+        log0(
+            f"Synthetic data shaped like {flags.data_dir}: "
+            f"{len(profile['shapes'])} volume shapes, "
+            f"{profile['case_bytes'] / 2**20:.1f} MiB per case"
+        )
+    if flags.synthetic_io_bytes > 0:
+        io_bytes = int(flags.synthetic_io_bytes * 2**20)
+
+    io_kwargs = {"io_mode": flags.synthetic_io, "io_bytes": io_bytes}
+    if flags.synthetic_io == "file":
+        io_path = flags.synthetic_io_file or os.path.join(
+            flags.output_dir, "synthetic-io.bin"
+        )
+        if MPIUtils.rank() == 0:
+            ensure_scratch_file(io_path, int(flags.synthetic_io_file_size * 2**30))
+        MPIUtils.barrier()
+        io_kwargs.update(io_path=io_path, storage=storage)
+    elif flags.synthetic_io == "sleep":
+        io_kwargs["latency_model"] = EmulatedBackend(
+            latency_ms=flags.storage_latency_ms,
+            bandwidth_mbps=flags.storage_bandwidth_mbps,
+            jitter_ms=flags.storage_jitter_ms,
+            seed=flags.seed,
+        )
+
+    # flags.seed differs per rank, the shuffling seed is shared by all of them
+    seed = flags.shuffling_seed
+    common = {"scalar": True, "layout": flags.layout, **io_kwargs}
+    train_dataset = SyntheticDataset(
+        length=flags.synthetic_length, seed=seed, **train_kwargs, **common
+    )
+    val_dataset = SyntheticDataset(
+        length=flags.synthetic_val_length, seed=seed + 1, **val_kwargs, **common
+    )
+    return train_dataset, val_dataset
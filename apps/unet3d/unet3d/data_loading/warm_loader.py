@@ -0,0 +1,82 @@
+import time
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class WarmEpochLoader:
+    """
+    Wraps the training DataLoader so that the next epoch starts warm.
+
+    As soon as the last batch of an epoch is handed out, the sampler is moved
+    to the next epoch and a new iterator is created. The workers then fetch the
+    first `prefetch_factor * num_workers` batches of the next epoch while the
+    trainer is still busy with the tail step, the LR scheduler and any
+    evaluation. With `enabled=False` the wrapper only measures.
+
+    The time from the start of an epoch to its first batch (the startup
+    stall) is recorded in `startup_stalls` either way.
+    """
+
+    def __init__(self, loader, enabled=True, last_epoch=None):
+        self.loader = loader
+        self.enabled = enabled
+        self.last_epoch = last_epoch
+        self.startup_stalls = []
+        self._epoch = 0
+        self._iterator = None
+        self._iterator_epoch = None
+
+    @property
+    def sampler(self):
+        return self.loader.sampler
+
+    @property
+    def dataset(self):
+        return self.loader.dataset
+
+    @property
+    def batch_size(self):
+        return self.loader.batch_size
+
+    def __len__(self):
+        return len(self.loader)
+
+    def set_epoch(self, epoch):
+        self._epoch = epoch
+        if self._iterator_epoch != epoch:
+            self._set_sampler_epoch(epoch)
+
+    def _set_sampler_epoch(self, epoch):
+        if hasattr(self.loader.sampler, "set_epoch"):
+            self.loader.sampler.set_epoch(epoch)
+
+    def _prepare(self, epoch):
+        # the sample order is drawn in iter(), so the sampler must be moved first
+        self._set_sampler_epoch(epoch)
+        self._iterator = iter(self.loader)
+        self._iterator_epoch = epoch
+
+    def __iter__(self):
+        epoch = self._epoch
+        t0 = time.perf_counter()
+        if self._iterator is None or self._iterator_epoch != epoch:
+            self._prepare(epoch)
+        it, self._iterator, self._iterator_epoch = self._iterator, None, None
+
+        num_batches = len(self.loader)
+        can_prefetch = self.enabled and (
+            self.last_epoch is None or epoch < self.last_epoch
+        )
+        # with persistent workers iter(loader) resets and returns the same
+        # iterator object, so never call next() past the last batch here
+        for i in range(num_batches):
+            try:
+                batch = next(it)
+            except StopIteration:
+                return
+            if i == 0:
+                self.startup_stalls.append(time.perf_counter() - t0)
+            if i == num_batches - 1 and can_prefetch:
+                self._prepare(epoch + 1)
+            yield batch
@@ -18,6 +18,28 @@ normalizations = {
 
 convolutions = {"transpose": nn.ConvTranspose3d, "regular": nn.Conv3d}
 
+memory_formats = {
+    "NCDHW": torch.contiguous_format,
+    "NDHWC": torch.channels_last_3d,
+}
+
+
+def channels_first(tensor, layout):
+    """
+    Batch from the loader as the (N, C, D, H, W) shape the model takes. An
+    NDHWC batch becomes a channels_last_3d view of the same memory.
+    """
+    if layout == "NDHWC":
+        return tensor.permute(0, 4, 1, 2, 3)
+    return tensor
+
+
+def channels_last(tensor, layout):
+    """Inverse of `channels_first`, a contiguous view for channels_last_3d."""
+    if layout == "NDHWC":
+        return tensor.permute(0, 2, 3, 4, 1)
+    return tensor
+
 
 def _normalization(norm_type, num_features, num_groups=16):
     if norm_type in normalizations:
@@ -2,6 +2,8 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from apps.unet3d.unet3d.model.layers import channels_last
+
 
 class Dice:
     def __init__(
@@ -71,13 +73,19 @@ def to_one_hot(array, layout, channel_axis):
         array = torch.squeeze(array, dim=channel_axis)
     array = F.one_hot(array.long(), num_classes=3)
     if layout == "NCDHW":
-        array = array.permute(0, 4, 1, 2, 3).float()
-    return array
+        array = array.permute(0, 4, 1, 2, 3)
+    return array.float()
 
 
 class DiceCELoss(nn.Module):
+    """
+    Takes (N, C, D, H, W) model outputs. With layout NDHWC they are
+    channels_last_3d, and the Dice term runs on their NDHWC view.
+    """
+
     def __init__(self, to_onehot_y, use_softmax, layout, include_background):
         super(DiceCELoss, self).__init__()
+        self.layout = layout
         self.dice = Dice(
             to_onehot_y=to_onehot_y,
             use_softmax=use_softmax,
@@ -87,12 +95,200 @@ class DiceCELoss(nn.Module):
         self.cross_entropy = nn.CrossEntropyLoss()
 
     def forward(self, y_pred, y_true):
+        # softmax and the Dice sums need fp32 under bf16/fp16 autocast
+        y_pred = y_pred.float()
         cross_entropy = self.cross_entropy(y_pred, torch.squeeze(y_true, dim=1).long())
-        dice = torch.mean(1.0 - self.dice(y_pred, y_true))
+        dice = torch.mean(
+            1.0
+            - self.dice(
+                channels_last(y_pred, self.layout), channels_last(y_true, self.layout)
+            )
+        )
         return (dice + cross_entropy) / 2
 
 
+def _per_sample(values, ndim):
+    """(N,) -> (N, 1, 1, ...) to broadcast against (N, 1, D, H, W)."""
+    return values.view(-1, *([1] * (ndim - 1)))
+
+
+class _FusedDiceCE(torch.autograd.Function):
+    """
+    Dice + cross-entropy from one softmax pass. The class statistics are
+    reduced per class from masks of the integer labels, so no one-hot target
+    is built, and only the probabilities and the labels are kept for the
+    analytic backward.
+    """
+
+    @staticmethod
+    def forward(ctx, logits, label, first_class, smooth_nr, smooth_dr):
+        dims = tuple(range(2, logits.dim()))
+        lse = torch.logsumexp(logits, dim=1, keepdim=True)
+        probs = torch.exp(logits - lse)
+        cross_entropy = torch.mean(lse - logits.gather(1, label.long()))
+
+        intersection, total = [], []
+        for c in range(first_class, logits.shape[1]):
+            mask = label == c
+            prob = probs[:, c : c + 1]
+            intersection.append(torch.sum(prob * mask, dim=dims))
+            total.append(torch.sum(mask, dim=dims) + torch.sum(prob, dim=dims))
+        intersection = torch.cat(intersection, dim=1)
+        total = torch.cat(total, dim=1)
+        dice = (2.0 * intersection + smooth_nr) / (total + smooth_dr)
+
+        ctx.save_for_backward(probs, label, intersection, total)
+        ctx.first_class = first_class
+        ctx.smooth = (smooth_nr, smooth_dr)
+        return (torch.mean(1.0 - dice) + cross_entropy) / 2
+
+    @staticmethod
+    def backward(ctx, grad_output):
+        probs, label, intersection, total = ctx.saved_tensors
+        smooth_nr, smooth_dr = ctx.smooth
+        first_class, ndim = ctx.first_class, probs.dim()
+        ce_scale = grad_output / (2 * label.numel())
+        dice_scale = grad_output / (2 * intersection.numel())
+        # d dice[n, c] / d probs[n, c, s] = a[n, c] * [label == c] - b[n, c]
+        a = 2.0 / (total + smooth_dr)
+        b = (2.0 * intersection + smooth_nr) / (total + smooth_dr) ** 2
+
+        def dice_grad(c):
+            j = c - first_class
+            mask = label == c
+            return _per_sample(a[:, j], ndim) * mask - _per_sample(b[:, j], ndim)
+
+        # softmax backward: probs * (g - sum_c probs_c * g_c)
+        weighted = torch.zeros_like(probs[:, :1])
+        for c in range(first_class, probs.shape[1]):
+            weighted += probs[:, c : c + 1] * dice_grad(c)
+
+        grad = torch.empty_like(probs)
+        for c in range(probs.shape[1]):
+            prob = probs[:, c : c + 1]
+            dice_term = dice_grad(c) - weighted if c >= first_class else -weighted
+            target = (label == c).to(prob.dtype)
+            grad[:, c : c + 1] = ce_scale * (prob - target) - dice_scale * (
+                prob * dice_term
+            )
+        return grad, None, None, None, None
+
+
+class FusedDiceCELoss(nn.Module):
+    """
+    Same value and gradients as `DiceCELoss`, computed by `_FusedDiceCE`.
+    Works on (N, C, D, H, W) outputs in either memory format, so `layout`
+    needs no views here.
+    """
+
+    def __init__(self, to_onehot_y, use_softmax, layout, include_background):
+        super(FusedDiceCELoss, self).__init__()
+        assert to_onehot_y and use_softmax, (
+            "FusedDiceCELoss takes integer labels and applies the softmax itself"
+        )
+        self.layout = layout
+        self.first_class = 0 if include_background else 1
+        self.smooth_nr = 1e-6
+        self.smooth_dr = 1e-6
+
+    def forward(self, y_pred, y_true):
+        return _FusedDiceCE.apply(
+            y_pred.float(), y_true, self.first_class, self.smooth_nr, self.smooth_dr
+        )
+
+
+class DiceCEStats:
+    """
+    `DiceCELoss` of one volume from non-overlapping (1, C, D, H, W) tiles:
+    accumulates the cross-entropy sum and the per-class softmax Dice sums
+    of every tile, so the full output never has to exist at once.
+    """
+
+    def __init__(self, first_class=1, smooth_nr=1e-6, smooth_dr=1e-6):
+        self.first_class = first_class
+        self.smooth_nr = smooth_nr
+        self.smooth_dr = smooth_dr
+        self.cross_entropy = 0.0
+        self.voxels = 0
+        self.intersection = None
+        self.total = None
+
+    def update(self, logits, target):
+        logits = logits.float()
+        dims = tuple(range(2, logits.dim()))
+        lse = torch.logsumexp(logits, dim=1, keepdim=True)
+        probs = torch.exp(logits - lse)
+        target = target.long()
+        self.cross_entropy += torch.sum(lse - logits.gather(1, target)).double()
+        self.voxels += target.numel()
+
+        intersection, total = [], []
+        for c in range(self.first_class, logits.shape[1]):
+            mask = target == c
+            prob = probs[:, c : c + 1]
+            intersection.append(torch.sum(prob * mask, dim=dims))
+            total.append(torch.sum(mask, dim=dims) + torch.sum(prob, dim=dims))
+        intersection = torch.cat(intersection, dim=1).double()
+        total = torch.cat(total, dim=1).double()
+        if self.intersection is None:
+            self.intersection, self.total = intersection, total
+        else:
+            self.intersection += intersection
+            self.total += total
+
+    def value(self):
+        dice = (2.0 * self.intersection + self.smooth_nr) / (
+            self.total + self.smooth_dr
+        )
+        cross_entropy = self.cross_entropy / self.voxels
+        return ((torch.mean(1.0 - dice) + cross_entropy) / 2).float()
+
+
+class ConfusionMatrix:
+    """
+    Per-sample counts[n, target class, predicted class] of the argmax of
+    (N, C, D, H, W) logits against (N, 1, D, H, W) labels, from a `bincount`
+    over `chunk_voxels` voxels at a time, so the extra memory does not grow
+    with the volume. `update` can be called once per tile of a volume (e.g.
+    streamed sliding-window outputs) as long as the tiles do not overlap.
+    """
+
+    def __init__(self, num_classes=3, chunk_voxels=2**22):
+        self.num_classes = num_classes
+        self.chunk_voxels = chunk_voxels
+        self.counts = None
+
+    def update(self, logits, target):
+        n, c = logits.shape[:2]
+        assert c == self.num_classes, f"Expected {self.num_classes} classes, got {c}"
+        plane = n * logits[0, 0, 0].numel()
+        step = max(1, self.chunk_voxels // max(1, plane))
+        offsets = torch.arange(n, device=logits.device).view(n, 1) * c * c
+        counts = torch.zeros(n * c * c, dtype=torch.int64, device=logits.device)
+        for d0 in range(0, logits.shape[2], step):
+            prediction = logits[:, :, d0 : d0 + step].argmax(dim=1).reshape(n, -1)
+            true = target[:, 0, d0 : d0 + step].reshape(n, -1).long()
+            counts += torch.bincount(
+                (offsets + true * c + prediction).flatten(), minlength=n * c * c
+            )
+        counts = counts.view(n, c, c)
+        self.counts = counts if self.counts is None else self.counts + counts
+
+    def dice(self, first_class=1, smooth_nr=1e-6, smooth_dr=1e-6):
+        """(N, C - first_class) Dice of the accumulated counts."""
+        counts = self.counts.double()
+        intersection = torch.diagonal(counts, dim1=1, dim2=2)
+        total = counts.sum(dim=2) + counts.sum(dim=1)
+        dice = (2.0 * intersection + smooth_nr) / (total + smooth_dr)
+        return dice[:, first_class:].float()
+
+
 class DiceScore:
+    """
+    With one-hot targets and argmax predictions (the evaluation setting) the
+    score comes from a `ConfusionMatrix`, without one-hot volumes.
+    """
+
     def __init__(
         self,
         to_onehot_y: bool = True,
@@ -100,6 +296,9 @@ class DiceScore:
         layout: str = "NCDHW",
         include_background: bool = False,
     ):
+        self.layout = layout
+        self.use_confusion = to_onehot_y and use_argmax
+        self.first_class = 0 if include_background else 1
         self.dice = Dice(
             to_onehot_y=to_onehot_y,
             to_onehot_x=True,
@@ -110,4 +309,18 @@ class DiceScore:
         )
 
     def __call__(self, y_pred, y_true):
-        return torch.mean(self.dice(y_pred, y_true), dim=0)
+        if self.use_confusion:
+            confusion = ConfusionMatrix(num_classes=y_pred.shape[1])
+            confusion.update(y_pred, y_true)
+            return torch.mean(
+                confusion.dice(
+                    self.first_class, self.dice.smooth_nr, self.dice.smooth_dr
+                ),
+                dim=0,
+            )
+        return torch.mean(
+            self.dice(
+                channels_last(y_pred, self.layout), channels_last(y_true, self.layout)
+            ),
+            dim=0,
+        )
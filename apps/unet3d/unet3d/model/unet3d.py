@@ -1,16 +1,51 @@
+import torch
 import torch.nn as nn
+import torch.utils.checkpoint
 
 from apps.unet3d.unet3d.model.layers import (
     DownsampleBlock,
     InputBlock,
     OutputLayer,
     UpsampleBlock,
+    memory_formats,
 )
 
+ENCODER_LEVELS = ["input", "down0", "down1", "down2", "down3", "bottleneck"]
+DECODER_LEVELS = ["up0", "up1", "up2", "up3", "up4"]
+CHECKPOINT_GROUPS = {
+    "none": [],
+    "encoder": ENCODER_LEVELS,
+    "decoder": DECODER_LEVELS,
+    "all": ENCODER_LEVELS + DECODER_LEVELS,
+}
+
+
+def checkpoint_levels(names):
+    """Expands level names and the encoder/decoder/all/none groups."""
+    levels = set()
+    for name in names or []:
+        if name in CHECKPOINT_GROUPS:
+            levels.update(CHECKPOINT_GROUPS[name])
+        elif name in ENCODER_LEVELS or name in DECODER_LEVELS:
+            levels.add(name)
+        else:
+            raise ValueError(
+                f"Unknown checkpoint level {name}. Valid levels are: "
+                + ", ".join(list(CHECKPOINT_GROUPS) + ENCODER_LEVELS + DECODER_LEVELS)
+            )
+    return levels
+
 
 class Unet3D(nn.Module):
     def __init__(
-        self, in_channels, n_class, normalization, activation, weights_init_scale=1.0
+        self,
+        in_channels,
+        n_class,
+        normalization,
+        activation,
+        weights_init_scale=1.0,
+        layout="NCDHW",
+        checkpoint=None,
     ):
         super(Unet3D, self).__init__()
 
@@ -50,18 +85,33 @@ class Unet3D(nn.Module):
             if "weight" in name or "bias" in name:
                 v.data *= float(weights_init_scale)
 
+        # NDHWC runs every convolution on channels_last_3d weights and
+        # activations; the input is expected as a channels_last_3d view
+        self.layout = layout
+        self.to(memory_format=memory_formats[layout])
+        # blocks of these levels keep only their input for backward and
+        # recompute their convolutions from it
+        self.checkpoint = checkpoint_levels(checkpoint)
+
+    def _run(self, level, block, *inputs):
+        if level in self.checkpoint and self.training and torch.is_grad_enabled():
+            return torch.utils.checkpoint.checkpoint(
+                block, *inputs, use_reentrant=False
+            )
+        return block(*inputs)
+
     def forward(self, x):
-        x = self.input_block(x)
+        x = self._run("input", self.input_block, x)
         outputs = [x]
 
-        for downsample in self.downsample:
-            x = downsample(x)
+        for idx, downsample in enumerate(self.downsample):
+            x = self._run(f"down{idx}", downsample, x)
             outputs.append(x)
 
-        x = self.bottleneck(x)
+        x = self._run("bottleneck", self.bottleneck, x)
 
-        for upsample, skip in zip(self.upsample, reversed(outputs)):
-            x = upsample(x, skip)
+        for idx, (upsample, skip) in enumerate(zip(self.upsample, reversed(outputs))):
+            x = self._run(f"up{idx}", upsample, x, skip)
 
         x = self.output(x)
 
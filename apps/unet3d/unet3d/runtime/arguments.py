@@ -27,6 +27,197 @@ class UNet3DArguments(Arguments, GroupedArguments):
             "--load_ckpt_path", dest="load_ckpt_path", type=str, default=""
         )
         parser.add_argument("--loader", dest="loader", default="pytorch", type=str)
+        parser.add_argument(
+            "--synthetic_length",
+            dest="synthetic_length",
+            type=int,
+            default=64,
+            help="Training samples of the synthetic loader",
+        )
+        parser.add_argument(
+            "--synthetic_val_length",
+            dest="synthetic_val_length",
+            type=int,
+            default=64,
+            help="Validation samples of the synthetic loader",
+        )
+        parser.add_argument(
+            "--synthetic_like_data",
+            dest="synthetic_like_data",
+            action="store_true",
+            default=False,
+            help="Take dtypes, volume shapes and bytes per case from --data_dir",
+        )
+        parser.add_argument(
+            "--synthetic_io",
+            dest="synthetic_io",
+            choices=["none", "file", "sleep"],
+            default="none",
+            help="Per-sample I/O of the synthetic loader: read from a scratch "
+            "file through --storage, or sleep per the --storage_latency_ms/"
+            "--storage_bandwidth_mbps/--storage_jitter_ms model",
+        )
+        parser.add_argument(
+            "--synthetic_io_bytes",
+            dest="synthetic_io_bytes",
+            type=float,
+            default=0.0,
+            help="Bytes per sample [MiB] (default: one patch, or one case "
+            "with --synthetic_like_data)",
+        )
+        parser.add_argument(
+            "--synthetic_io_file",
+            dest="synthetic_io_file",
+            type=str,
+            default="",
+            help="Scratch file (default: <output_dir>/synthetic-io.bin)",
+        )
+        parser.add_argument(
+            "--synthetic_io_file_size",
+            dest="synthetic_io_file_size",
+            type=float,
+            default=1.0,
+            help="Size the scratch file is created with [GiB]",
+        )
+        parser.add_argument(
+            "--data_format", dest="data_format", choices=["npz", "npy"], default="npz"
+        )
+        parser.add_argument(
+            "--storage",
+            dest="storage",
+            choices=["posix", "mmap", "memory", "direct", "emulated", "s3"],
+            default="posix",
+            help="Storage backend used by the pytorch loader to read volumes",
+        )
+        parser.add_argument(
+            "--storage_memory_capacity",
+            dest="storage_memory_capacity",
+            type=float,
+            default=16.0,
+            help="Per-worker cache size of the memory backend [GiB]",
+        )
+        parser.add_argument(
+            "--storage_block_size",
+            dest="storage_block_size",
+            type=int,
+            default=4096,
+            help="Read size of the direct backend [KiB]",
+        )
+        parser.add_argument(
+            "--storage_emulated_inner",
+            dest="storage_emulated_inner",
+            choices=["posix", "mmap", "direct"],
+            default="posix",
+            help="Backend the emulated backend reads through",
+        )
+        parser.add_argument(
+            "--storage_latency_ms", dest="storage_latency_ms", type=float, default=0.0
+        )
+        parser.add_argument(
+            "--storage_bandwidth_mbps",
+            dest="storage_bandwidth_mbps",
+            type=float,
+            default=0.0,
+            help="Per-reader bandwidth cap of the emulated backend [MiB/s], 0 = none",
+        )
+        parser.add_argument(
+            "--storage_jitter_ms", dest="storage_jitter_ms", type=float, default=0.0
+        )
+        parser.add_argument(
+            "--storage_hedge",
+            dest="storage_hedge",
+            action="store_true",
+            default=False,
+            help="Duplicate slow reads against --storage_replica_dir",
+        )
+        parser.add_argument(
+            "--storage_replica_dir",
+            dest="storage_replica_dir",
+            type=str,
+            default="",
+            help="Second copy of --data_dir (replica or node-local cache tier)",
+        )
+        parser.add_argument(
+            "--storage_hedge_percentile",
+            dest="storage_hedge_percentile",
+            type=float,
+            default=95.0,
+        )
+        parser.add_argument(
+            "--storage_retries", dest="storage_retries", type=int, default=0
+        )
+        parser.add_argument(
+            "--storage_retry_backoff_ms",
+            dest="storage_retry_backoff_ms",
+            type=float,
+            default=50.0,
+        )
+        parser.add_argument(
+            "--storage_stats_dir",
+            dest="storage_stats_dir",
+            type=str,
+            default="",
+            help="Where hedged reads dump latency histograms "
+            "(default: <output_dir>/storage-stats)",
+        )
+        parser.add_argument(
+            "--storage_run_id",
+            dest="storage_run_id",
+            type=str,
+            default="",
+            help="Tag of this run's files in --storage_stats_dir "
+            "(default: start time of rank 0)",
+        )
+        parser.add_argument(
+            "--s3_endpoint",
+            dest="s3_endpoint",
+            type=str,
+            default="http://127.0.0.1:9000",
+            help="Endpoint of the s3 backend, e.g. apps/unet3d/object_server.py",
+        )
+        parser.add_argument("--s3_bucket", dest="s3_bucket", type=str, default="unet3d")
+        parser.add_argument(
+            "--s3_chunk_size",
+            dest="s3_chunk_size",
+            type=float,
+            default=8.0,
+            help="Size of one range request [MiB]",
+        )
+        parser.add_argument(
+            "--s3_concurrency",
+            dest="s3_concurrency",
+            type=int,
+            default=4,
+            help="Range requests in flight per loader process",
+        )
+        parser.add_argument(
+            "--s3_pool_size",
+            dest="s3_pool_size",
+            type=int,
+            default=8,
+            help="Keep-alive connections kept per loader process",
+        )
+        parser.add_argument(
+            "--s3_readahead",
+            dest="s3_readahead",
+            type=int,
+            default=2,
+            help="Chunks prefetched after a range read",
+        )
+        parser.add_argument(
+            "--s3_cache_size",
+            dest="s3_cache_size",
+            type=float,
+            default=256.0,
+            help="Per-process chunk cache for range reads [MiB]",
+        )
+        parser.add_argument(
+            "--crop_aware_reads",
+            dest="crop_aware_reads",
+            action="store_true",
+            default=False,
+            help="Read only the depth slab a random crop covers",
+        )
         parser.add_argument(
             "--local_rank", default=os.environ.get("LOCAL_RANK", 0), type=int
         )
@@ -38,7 +229,12 @@ class UNet3DArguments(Arguments, GroupedArguments):
         parser.add_argument("--warmup_steps", dest="warmup_steps", type=int, default=4)
         parser.add_argument("--batch_size", dest="batch_size", type=int, default=2)
         parser.add_argument(
-            "--layout", dest="layout", type=str, choices=["NCDHW"], default="NCDHW"
+            "--layout",
+            dest="layout",
+            type=str,
+            choices=["NCDHW", "NDHWC"],
+            default="NCDHW",
+            help="NDHWC loads channels-last batches and runs the model in channels_last_3d",
         )
         parser.add_argument(
             "--input_shape", nargs="+", type=int, default=[128, 128, 128]
@@ -48,16 +244,165 @@ class UNet3DArguments(Arguments, GroupedArguments):
         )
         parser.add_argument("--seed", dest="seed", default=-1, type=int)
         parser.add_argument("--num_workers", dest="num_workers", type=int, default=8)
+        parser.add_argument(
+            "--prefetch_factor", dest="prefetch_factor", type=int, default=2
+        )
+        parser.add_argument(
+            "--no_pin_memory", dest="pin_memory", action="store_false", default=True
+        )
+        parser.add_argument(
+            "--loader_autotune",
+            dest="loader_autotune",
+            action="store_true",
+            default=False,
+            help="Calibrate num_workers/prefetch_factor/pin_memory before training",
+        )
+        parser.add_argument(
+            "--autotune_strategy",
+            dest="autotune_strategy",
+            choices=["grid", "hill"],
+            default="hill",
+        )
+        parser.add_argument(
+            "--autotune_workers", nargs="+", type=int, default=[1, 2, 4, 8, 16]
+        )
+        parser.add_argument(
+            "--autotune_prefetch", nargs="+", type=int, default=[2, 4, 8]
+        )
+        parser.add_argument(
+            "--autotune_pin_memory",
+            dest="autotune_pin_memory",
+            action="store_true",
+            default=False,
+            help="Also try both pin_memory settings",
+        )
+        parser.add_argument(
+            "--autotune_steps", dest="autotune_steps", type=int, default=20
+        )
+        parser.add_argument(
+            "--autotune_warmup", dest="autotune_warmup", type=int, default=4
+        )
+        parser.add_argument(
+            "--autotune_step_time",
+            dest="autotune_step_time",
+            type=float,
+            default=0.0,
+            help="Emulated compute per batch during calibration (--sleep wins if set)",
+        )
+        parser.add_argument(
+            "--autotune_cache", dest="autotune_cache", type=str, default=""
+        )
+        parser.add_argument(
+            "--autotune_refresh",
+            dest="autotune_refresh",
+            action="store_true",
+            default=False,
+            help="Ignore the cached config and calibrate again",
+        )
+        parser.add_argument(
+            "--epoch_prefetch",
+            dest="epoch_prefetch",
+            action="store_true",
+            default=False,
+            help="Start fetching the next epoch while the current one finishes",
+        )
+        parser.add_argument(
+            "--val_resident",
+            dest="val_resident",
+            choices=["off", "host", "device"],
+            default="off",
+            help="Keep the validation shard in (pinned) host or device memory",
+        )
+        parser.add_argument(
+            "--eval_balance",
+            dest="eval_balance",
+            choices=["count", "size"],
+            default="count",
+            help="Split validation cases across ranks by count or by estimated cost",
+        )
         parser.add_argument(
             "--exec_mode",
             dest="exec_mode",
-            choices=["train", "evaluate"],
+            choices=["train", "evaluate", "io_benchmark"],
             default="train",
         )
+        parser.add_argument(
+            "--mask_dir",
+            dest="mask_dir",
+            type=str,
+            default="",
+            help="Where infer.py writes the masks (default: <output_dir>/masks)",
+        )
+        parser.add_argument(
+            "--mask_format", dest="mask_format", choices=["npz", "npy"], default="npz"
+        )
+        parser.add_argument(
+            "--infer_pattern",
+            dest="infer_pattern",
+            type=str,
+            default="",
+            help="Volumes of --data_dir segmented by infer.py "
+            "(default: *_x.<data_format>)",
+        )
+        parser.add_argument(
+            "--infer_queue_size",
+            dest="infer_queue_size",
+            type=int,
+            default=2,
+            help="Volumes queued between the read, inference and write stages",
+        )
+        parser.add_argument(
+            "--infer_readers", dest="infer_readers", type=int, default=2
+        )
+        parser.add_argument(
+            "--infer_writers", dest="infer_writers", type=int, default=2
+        )
+        parser.add_argument(
+            "--io_stage",
+            dest="io_stage",
+            choices=["read", "decode", "crop", "full"],
+            default="full",
+            help="Last per-sample stage run by --exec_mode io_benchmark",
+        )
         parser.add_argument(
             "--benchmark", dest="benchmark", action="store_true", default=False
         )
-        parser.add_argument("--amp", dest="amp", action="store_true", default=False)
+        parser.add_argument(
+            "--amp",
+            dest="amp",
+            action="store_true",
+            default=False,
+            help="Mixed precision: fp16 on CUDA, bf16 on the host",
+        )
+        parser.add_argument(
+            "--precision",
+            dest="precision",
+            type=str,
+            choices=["fp32", "fp16", "bf16"],
+            default=None,
+            help="Autocast precision of training and evaluation, overrides --amp",
+        )
+        parser.add_argument(
+            "--fused_loss",
+            dest="fused_loss",
+            action="store_true",
+            default=False,
+            help="Dice + cross-entropy from one softmax, without one-hot targets",
+        )
+        parser.add_argument(
+            "--compile",
+            dest="compile",
+            action="store_true",
+            default=False,
+            help="Run the model and loss through torch.compile, eager on failure",
+        )
+        parser.add_argument(
+            "--compile_mode",
+            dest="compile_mode",
+            type=str,
+            choices=["default", "reduce-overhead", "max-autotune"],
+            default="default",
+        )
         parser.add_argument(
             "--optimizer",
             dest="optimizer",
@@ -110,11 +455,117 @@ class UNet3DArguments(Arguments, GroupedArguments):
             choices=["relu", "leaky_relu"],
             default="relu",
         )
+        parser.add_argument(
+            "--checkpoint_levels",
+            dest="checkpoint_levels",
+            nargs="*",
+            type=str,
+            default=[],
+            help="Unet3D levels to recompute in backward: input, down0-3, "
+            "bottleneck, up0-4, or the groups encoder, decoder, all",
+        )
         parser.add_argument(
             "--oversampling", dest="oversampling", type=float, default=0.4
         )
         parser.add_argument("--sleep", dest="sleep", type=float, default=-1.0)
-        parser.add_argument("--overlap", dest="overlap", type=float, default=0.5)
+        parser.add_argument(
+            "--record_compute_profile",
+            dest="record_compute_profile",
+            type=str,
+            default="",
+            help="Record per-phase step times of this run into the given profile",
+        )
+        parser.add_argument(
+            "--emulate_compute",
+            dest="emulate_compute",
+            type=str,
+            default="",
+            help="Replace the model step with times sampled from the given profile",
+        )
+        parser.add_argument(
+            "--compute_profile_key",
+            dest="compute_profile_key",
+            type=str,
+            default="",
+            help="Profile entry to emulate (default: <device>/bs<batch>/patch<DxHxW>)",
+        )
+        parser.add_argument(
+            "--emulate_allreduce",
+            dest="emulate_allreduce",
+            action="store_true",
+            default=False,
+            help="Run a real gradient-sized all-reduce during emulated backward",
+        )
+        parser.add_argument(
+            "--overlap",
+            dest="overlap",
+            nargs="+",
+            type=float,
+            default=[0.5],
+            help="Sliding-window overlap, one value or one per axis",
+        )
+        parser.add_argument(
+            "--sw_distributed",
+            dest="sw_distributed",
+            choices=["none", "stats", "reduce"],
+            default="none",
+            help="Split the sliding windows of every validation volume across "
+            "ranks instead of the volumes: all-reduce the partial outputs "
+            "(reduce) or only the Dice statistics of each rank's rows (stats)",
+        )
+        parser.add_argument(
+            "--sw_plan_windows",
+            dest="sw_plan_windows",
+            action="store_true",
+            help="Fit the ROI and strides to every volume, with "
+            "--val_input_shape as the voxel budget and --overlap as the minimum",
+        )
+        parser.add_argument(
+            "--sw_batch_size",
+            dest="sw_batch_size",
+            type=int,
+            default=1,
+            help="Sliding-window ROIs per model call during evaluation",
+        )
+        parser.add_argument(
+            "--sw_volumes",
+            dest="sw_volumes",
+            type=int,
+            default=1,
+            help="Validation volumes whose windows share sliding-window batches",
+        )
+        parser.add_argument(
+            "--sw_plan_cache_mb",
+            dest="sw_plan_cache_mb",
+            type=float,
+            default=256.0,
+            help="Device memory of cached sliding-window importance maps and "
+            "normalization profiles [MiB], 0 = no cache",
+        )
+        parser.add_argument(
+            "--sw_stream",
+            dest="sw_stream",
+            choices=["none", "host", "reduce"],
+            default="none",
+            help="Stream sliding-window outputs slab by slab to the host, "
+            "or reduce them to loss and score on the device",
+        )
+        parser.add_argument(
+            "--sw_skip_threshold",
+            dest="sw_skip_threshold",
+            type=float,
+            default=None,
+            help="Predict background without the model for sliding windows "
+            "whose input maximum is at most this, e.g. -2.0 for air and padding",
+        )
+        parser.add_argument(
+            "--sw_skip_check",
+            dest="sw_skip_check",
+            type=int,
+            default=0,
+            help="Also run every sliding window of the first N validation cases "
+            "per rank and log the Dice difference of --sw_skip_threshold",
+        )
         parser.add_argument(
             "--include_background",
             dest="include_background",
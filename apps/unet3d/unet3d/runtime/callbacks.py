@@ -65,6 +65,9 @@ class BaseCallback:
     def on_batch_start(self, **kwargs):
         pass
 
+    def on_compile(self, **kwargs):
+        pass
+
     def on_epoch_end(self, **kwargs):
         pass
 
@@ -79,6 +82,7 @@ class PerformanceCallback(BaseCallback):
         self._warmup_steps = warmup_steps
         self._step = 0
         self._timestamps = []
+        self._compile_steps = set()
         self._mode = mode
 
     def on_batch_start(self, *args, **kwargs):
@@ -86,11 +90,17 @@ class PerformanceCallback(BaseCallback):
         if self._step >= self._warmup_steps:
             self._timestamps.append(time.time())
 
+    def on_compile(self, *args, **kwargs):
+        # the current step compiled a new graph, leave it out of the stats
+        if self._step >= self._warmup_steps:
+            self._compile_steps.add(len(self._timestamps) - 1)
+
     def on_fit_end(self, *args, **kwargs):
         deltas = np.array(
             [
                 self._timestamps[i + 1] - self._timestamps[i]
                 for i in range(len(self._timestamps) - 1)
+                if i not in self._compile_steps
             ]
         )
         stats = process_performance_stats(deltas, self._batch_size, self._mode)
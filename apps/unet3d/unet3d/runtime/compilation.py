@@ -0,0 +1,90 @@
+import time
+import logging
+
+import torch
+
+from src.logging import log0
+
+log = logging.getLogger(__name__)
+
+
+class CompiledStep:
+    """
+    Calls `fn` through `torch.compile`, or eagerly when `enabled` is false.
+
+    Shapes are compiled statically (`dynamic=False`). Every new input shape,
+    grad mode or train/eval mode compiles once, and the call that did it sets
+    `compiled_last_call` so callers can leave it out of their timings. If
+    compilation or the compiled call fails, the error is logged and `fn` runs
+    eagerly from then on.
+    """
+
+    def __init__(self, fn, name, enabled=True, mode="default", training=None):
+        self.fn = fn
+        self.name = name
+        self.training = training
+        self.compiled = None
+        self.compiled_last_call = False
+        self._seen = set()
+        if enabled:
+            try:
+                self.compiled = torch.compile(
+                    fn, mode=None if mode == "default" else mode, dynamic=False
+                )
+            except Exception as e:
+                log0(f"torch.compile of {name} unavailable, running eager: {e}")
+
+    def _key(self, args):
+        shapes = tuple(tuple(a.shape) for a in args if isinstance(a, torch.Tensor))
+        training = self.training.training if self.training is not None else None
+        return shapes, torch.is_grad_enabled(), training
+
+    def __call__(self, *args):
+        self.compiled_last_call = False
+        if self.compiled is None:
+            return self.fn(*args)
+        key = self._key(args)
+        first = key not in self._seen
+        t0 = time.perf_counter()
+        try:
+            result = self.compiled(*args)
+        except Exception as e:
+            log0(f"torch.compile of {self.name} failed, running eager: {e}")
+            log.debug("torch.compile failure", exc_info=True)
+            self.compiled = None
+            return self.fn(*args)
+        if first:
+            self._seen.add(key)
+            self.compiled_last_call = True
+            log0(
+                f"Compiled {self.name} for shapes {key[0]} "
+                f"in {time.perf_counter() - t0:.1f} s"
+            )
+        return result
+
+
+def compiled_train_step(flags, model, loss_fn):
+    """Model forward and DiceCELoss as one compiled graph for training patches."""
+
+    def forward_loss(image, label):
+        output = model(image)
+        return output, loss_fn(output, label)
+
+    return CompiledStep(
+        forward_loss,
+        "train step",
+        enabled=flags.compile,
+        mode=flags.compile_mode,
+        training=model,
+    )
+
+
+def compiled_inference(flags, model):
+    """Model forward for the sliding-window shape, compiled apart from training."""
+    return CompiledStep(
+        model,
+        "inference",
+        enabled=flags.compile,
+        mode=flags.compile_mode,
+        training=model,
+    )
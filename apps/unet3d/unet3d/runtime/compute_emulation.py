@@ -0,0 +1,250 @@
+import os
+import json
+import time
+import logging
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+import torch.distributed as dist
+
+from dftracer.python import ai
+
+from src.mpi_utils import MPIUtils
+from src.logging import log0
+
+log = logging.getLogger(__name__)
+
+# the gradient all-reduce of DDP runs inside backward and is recorded there,
+# loss_reduce is the all-reduce of the scalar loss that ends every step
+PHASES = ["forward", "backward", "loss_reduce"]
+
+
+def device_type(device):
+    if torch.device(device).type == "cuda":
+        return torch.cuda.get_device_name().replace(" ", "_")
+    return "cpu"
+
+
+def profile_key(flags, device):
+    """Profiles are keyed by device type, batch size and patch size."""
+    patch = "x".join(str(s) for s in flags.input_shape)
+    return f"{device_type(device)}/bs{flags.batch_size}/patch{patch}"
+
+
+class PhaseRecorder:
+    """
+    Records the time of every training phase per step. The device is
+    synchronized around each phase so that asynchronous kernels are charged
+    to the phase that launched them; this slows training down a little, so
+    it only runs while recording a profile. The first `warmup` steps
+    (cudnn autotuning, allocator growth) are dropped.
+
+    The phases are `PHASES`. DDP reduces the gradients in buckets during
+    backward, so gradient communication is part of the backward time, and
+    `loss_reduce` only covers the all-reduce of the loss.
+    """
+
+    def __init__(self, device, enabled=False, warmup=5):
+        self.device = device
+        self.enabled = enabled
+        self.warmup = warmup
+        self.steps = []
+        self._current = {}
+        self._seen = 0
+
+    def _sync(self):
+        if torch.device(self.device).type == "cuda":
+            torch.cuda.synchronize()
+
+    @contextmanager
+    def phase(self, name):
+        if not self.enabled:
+            yield
+            return
+        self._sync()
+        t0 = time.perf_counter()
+        yield
+        self._sync()
+        self._current[name] = time.perf_counter() - t0
+
+    def end_step(self):
+        if not self.enabled:
+            return
+        if self._seen >= self.warmup and len(self._current) == len(PHASES):
+            self.steps.append([self._current[p] for p in PHASES])
+        self._current = {}
+        self._seen += 1
+
+    def save(self, path, key, max_steps=4096):
+        """Merges the steps of all ranks into the profile stored at `path`."""
+        steps = MPIUtils.comm_world().gather(self.steps, root=0)
+        if MPIUtils.rank() != 0:
+            return
+        steps = [s for rank_steps in steps for s in rank_steps]
+        if len(steps) > max_steps:
+            keep = np.random.default_rng(0).choice(len(steps), max_steps, replace=False)
+            steps = [steps[i] for i in sorted(keep)]
+        profiles = load_profiles(path)
+        profiles[key] = {"phases": PHASES, "steps": steps, "timestamp": time.time()}
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(f"{path}.tmp", "w") as f:
+            json.dump(profiles, f)
+        os.replace(f"{path}.tmp", path)
+        means = np.mean(steps, axis=0) * 1000 if steps else [0.0] * len(PHASES)
+        log0(
+            f"Compute profile {key}: {len(steps)} steps, mean "
+            + ", ".join(f"{p} {m:.1f} ms" for p, m in zip(PHASES, means))
+            + f", saved to {path}"
+        )
+
+
+class DeviceDelay:
+    """
+    Keeps the current CUDA stream busy for a given time with a one-thread
+    numba kernel that loops over `nanosleep`. Kernels queued behind it and
+    collectives waiting on the stream are delayed as if compute ran, which a
+    host-side sleep cannot do since it leaves the stream idle. `nanosleep`
+    only approximates the requested time, so the loop is calibrated against
+    CUDA events once.
+    """
+
+    def __init__(self, device, chunk_ns=100_000, calibration_iterations=200):
+        from numba import cuda
+
+        @cuda.jit
+        def sleep_kernel(iterations, ns):
+            for _ in range(iterations):
+                cuda.nanosleep(ns)
+
+        self.cuda = cuda
+        self.kernel = sleep_kernel
+        self.device = device
+        self.chunk_ns = chunk_ns
+        self._launch(1)  # compiles the kernel
+        start = torch.cuda.Event(enable_timing=True)
+        end = torch.cuda.Event(enable_timing=True)
+        start.record()
+        self._launch(calibration_iterations)
+        end.record()
+        end.synchronize()
+        self.iteration_time = start.elapsed_time(end) / 1000 / calibration_iterations
+
+    def _launch(self, iterations):
+        stream = torch.cuda.current_stream(self.device).cuda_stream
+        self.kernel[1, 1, self.cuda.external_stream(stream)](iterations, self.chunk_ns)
+
+    def __call__(self, seconds):
+        iterations = round(seconds / self.iteration_time)
+        if iterations > 0:
+            self._launch(iterations)
+
+
+_device_delays = {}
+
+
+def device_delay(device):
+    """The calibrated `DeviceDelay` of a CUDA device, created on first use."""
+    device = torch.device(device)
+    index = device.index if device.index is not None else torch.cuda.current_device()
+    if index not in _device_delays:
+        _device_delays[index] = DeviceDelay(torch.device("cuda", index))
+    return _device_delays[index]
+
+
+def load_profiles(path):
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+class ComputeEmulator:
+    """
+    Replaces the model step with phase times drawn from a recorded profile.
+    Each step replays the (forward, backward, loss_reduce) times of one
+    recorded step picked at random, which keeps the correlation between the
+    phases and the run-to-run variance.
+
+    With torch.distributed initialized, the loss_reduce phase runs a real
+    one-element all-reduce, so the ranks stay coupled on every step as in
+    training, and only the rest of the recorded time is slept.
+
+    With `grad_numel` set and torch.distributed initialized, a gradient-sized
+    all-reduce is issued at the start of the backward phase and waited for at
+    its end, like DDP overlaps its bucketed reductions with backward.
+
+    On CUDA the phases occupy the stream through `DeviceDelay` and the host
+    waits for the device at the end of each phase, as `PhaseRecorder` did
+    when the times were recorded. On the host they are plain sleeps.
+    """
+
+    def __init__(self, profile, device, grad_numel=0, seed=0):
+        self.steps = np.asarray(profile["steps"], dtype=np.float64)
+        assert len(self.steps) > 0, "Compute profile has no steps"
+        self.device = device
+        self.delay = None
+        if torch.device(device).type == "cuda":
+            self.delay = device_delay(device)
+        self.rng = np.random.default_rng(seed)
+        self.grad_buffer = None
+        self.loss_buffer = None
+        if dist.is_available() and dist.is_initialized():
+            self.loss_buffer = torch.zeros(1, device=device)
+            if grad_numel > 0:
+                self.grad_buffer = torch.zeros(grad_numel, device=device)
+
+    @staticmethod
+    def from_flags(flags, model, device):
+        profiles = load_profiles(flags.emulate_compute)
+        key = flags.compute_profile_key or profile_key(flags, device)
+        if key not in profiles:
+            raise ValueError(
+                f"No compute profile for {key} in {flags.emulate_compute}. "
+                f"Recorded profiles: {', '.join(profiles) or 'none'}"
+            )
+        grad_numel = 0
+        if flags.emulate_allreduce:
+            grad_numel = sum(p.numel() for p in model.parameters() if p.requires_grad)
+        log0(
+            f"Emulating compute from profile {key} "
+            f"({len(profiles[key]['steps'])} steps"
+            f"{f', all-reduce of {grad_numel} parameters' if grad_numel else ''})"
+        )
+        return ComputeEmulator(
+            profiles[key], device, grad_numel=grad_numel, seed=flags.seed
+        )
+
+    def _sleep(self, seconds):
+        if seconds <= 0:
+            return
+        if self.delay is not None:
+            self.delay(seconds)
+        else:
+            time.sleep(seconds)
+
+    def _sync(self):
+        if self.delay is not None:
+            torch.cuda.synchronize()
+
+    def step(self):
+        forward, backward, loss_reduce = self.steps[self.rng.integers(len(self.steps))]
+        with ai.compute.forward:
+            self._sleep(forward)
+            self._sync()
+        with ai.compute.backward:
+            if self.grad_buffer is not None:
+                t0 = time.perf_counter()
+                work = dist.all_reduce(self.grad_buffer, async_op=True)
+                self._sleep(backward - (time.perf_counter() - t0))
+                work.wait()
+            else:
+                self._sleep(backward)
+            self._sync()
+        with ai.comm.all_reduce:
+            t0 = time.perf_counter()
+            if self.loss_buffer is not None:
+                dist.all_reduce(self.loss_buffer)
+                self._sync()
+            self._sleep(loss_reduce - (time.perf_counter() - t0))
+            self._sync()
@@ -0,0 +1,280 @@
+import os
+import time
+import queue
+import logging
+import threading
+
+import numpy as np
+import torch
+
+from dftracer.python import ai
+
+from apps.unet3d.unet3d.model.layers import memory_formats
+from apps.unet3d.unet3d.data_loading.data_loader import eval_costs, lpt_assignment
+from apps.unet3d.unet3d.runtime.compilation import compiled_inference
+from apps.unet3d.unet3d.runtime.precision import Precision
+from apps.unet3d.unet3d.runtime.inference import (
+    WindowStats,
+    axis_crop,
+    plan_cache,
+    plan_windows,
+    sliding_window_inference_batch,
+    window_strides,
+)
+
+from src.mpi_utils import MPIUtils
+from src.logging import log0
+
+log = logging.getLogger(__name__)
+
+# queue marker of a finished reader or of the end of the writes
+_DONE = object()
+
+
+def mask_path(path, mask_dir, mask_format):
+    """<mask_dir>/case_00000_pred.npz for .../case_00000_x.npz."""
+    stem = os.path.basename(path).split(".")[0].removesuffix("_x")
+    return os.path.join(mask_dir, f"{stem}_pred.{mask_format}")
+
+
+def save_mask(path, mask, mask_format):
+    with open(f"{path}.tmp", "wb") as f:
+        if mask_format == "npz":
+            np.savez_compressed(f, data=mask)
+        else:
+            np.save(f, mask)
+    os.replace(f"{path}.tmp", path)
+
+
+def uncrop(mask, shape, strides):
+    """
+    Places the (1, D, H, W) mask of a volume that sliding-window inference
+    cropped back into the full spatial `shape`, as background.
+    """
+    full = torch.zeros((1, *shape), dtype=mask.dtype, device=mask.device)
+    source, target = [slice(None)], [slice(None)]
+    for length, stride, size in zip(shape, strides, mask.shape[1:]):
+        offset = axis_crop(length, stride) // 2
+        size = min(size, length - offset)
+        source.append(slice(0, size))
+        target.append(slice(offset, offset + size))
+    full[tuple(target)] = mask[tuple(source)]
+    return full
+
+
+def shard_files(flags, paths, storage):
+    """This rank's share of `paths`, balanced by the estimated windows."""
+    costs = eval_costs(
+        paths,
+        flags.val_input_shape,
+        flags.overlap,
+        storage,
+        plan=flags.sw_plan_windows,
+    )
+    shards, _ = lpt_assignment(costs, MPIUtils.size())
+    return [paths[i] for i in shards[MPIUtils.rank()]]
+
+
+class InferenceEngine:
+    """
+    Writes argmax masks for a list of volumes in three overlapped stages
+    connected by bounded queues of `queue_size` volumes:
+
+    - `readers` threads load and decode the volumes through `storage`,
+    - the calling thread runs sliding-window inference under
+      `torch.inference_mode`, configured by the --sw_* flags,
+    - `writers` threads save the masks as npy or npz files.
+
+    The stage time of each thread is kept so that `run` can report which
+    stage bounds the throughput.
+    """
+
+    def __init__(
+        self,
+        flags,
+        model,
+        device,
+        storage,
+        mask_dir,
+        mask_format="npz",
+        queue_size=2,
+        readers=2,
+        writers=2,
+    ):
+        self.flags = flags
+        self.model = model.to(device).eval()
+        self.device = device
+        self.storage = storage
+        self.mask_dir = mask_dir
+        self.mask_format = mask_format
+        self.queue_size = queue_size
+        self.readers = readers
+        self.writers = writers
+        self.predict = compiled_inference(flags, self.model)
+        self.precision = Precision.from_flags(flags, device)
+        plan_cache.set_capacity(int(flags.sw_plan_cache_mb * 2**20))
+        self.windows = WindowStats()
+        self.stage_time = {"read": 0.0, "infer": 0.0, "write": 0.0}
+        self._lock = threading.Lock()
+        self._errors = []
+
+    def _add_time(self, stage, seconds):
+        with self._lock:
+            self.stage_time[stage] += seconds
+
+    def _read(self, paths, volumes):
+        try:
+            while True:
+                try:
+                    path = paths.get_nowait()
+                except queue.Empty:
+                    break
+                t0 = time.perf_counter()
+                image = self.storage.load(path)
+                self._add_time("read", time.perf_counter() - t0)
+                volumes.put((path, image))
+        except Exception as e:  # re-raised on the main thread in run()
+            self._errors.append(e)
+        finally:
+            volumes.put(_DONE)
+
+    def _write(self, masks):
+        while True:
+            item = masks.get()
+            if item is _DONE:
+                masks.put(_DONE)
+                return
+            path, mask = item
+            try:
+                t0 = time.perf_counter()
+                save_mask(
+                    mask_path(path, self.mask_dir, self.mask_format),
+                    mask,
+                    self.mask_format,
+                )
+                self._add_time("write", time.perf_counter() - t0)
+            except Exception as e:  # re-raised on the main thread in run()
+                self._errors.append(e)
+
+    def segment(self, image):
+        """(C, D, H, W) volume -> (1, D, H, W) uint8 argmax mask on the host."""
+        flags = self.flags
+        inputs = torch.from_numpy(np.ascontiguousarray(image)).unsqueeze(0)
+        inputs = inputs.to(self.device, dtype=torch.float32, non_blocking=True)
+        inputs = inputs.contiguous(memory_format=memory_formats[flags.layout])
+        shape = list(inputs.shape[2:])
+        if flags.sw_plan_windows:
+            _, strides = plan_windows(shape, flags.val_input_shape, flags.overlap)
+        else:
+            strides = window_strides(flags.val_input_shape, flags.overlap)
+        with ai.compute.forward:
+            output, _ = sliding_window_inference_batch(
+                [(inputs, None)],
+                roi_shape=flags.val_input_shape,
+                model=self.predict,
+                overlap=flags.overlap,
+                mode="gaussian",
+                padding_val=-2.2,
+                memory_format=memory_formats[flags.layout],
+                sw_batch_size=flags.sw_batch_size,
+                pad_batches=flags.compile,
+                stream="host" if flags.sw_stream == "host" else None,
+                skip_threshold=flags.sw_skip_threshold,
+                stats=self.windows,
+                plan=flags.sw_plan_windows,
+            )[0]
+            mask = output.argmax(dim=1).to(torch.uint8)
+        return uncrop(mask, shape, strides).cpu().numpy()
+
+    def run(self, paths):
+        """Segments `paths` and returns this rank's throughput statistics."""
+        os.makedirs(self.mask_dir, exist_ok=True)
+        pending = queue.Queue()
+        for path in paths:
+            pending.put(path)
+        volumes = queue.Queue(maxsize=self.queue_size)
+        masks = queue.Queue(maxsize=self.queue_size)
+        threads = [
+            threading.Thread(
+                target=self._read,
+                args=(pending, volumes),
+                name=f"infer-reader-{i}",
+                daemon=True,
+            )
+            for i in range(self.readers)
+        ] + [
+            threading.Thread(
+                target=self._write,
+                args=(masks,),
+                name=f"infer-writer-{i}",
+                daemon=True,
+            )
+            for i in range(self.writers)
+        ]
+
+        t0 = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        done, count, voxels, wait = 0, 0, 0, 0.0
+        with torch.inference_mode(), self.precision.autocast():
+            while done < self.readers:
+                t1 = time.perf_counter()
+                item = volumes.get()
+                wait += time.perf_counter() - t1
+                if item is _DONE:
+                    done += 1
+                    continue
+                path, image = item
+                t1 = time.perf_counter()
+                mask = self.segment(image)
+                self._add_time("infer", time.perf_counter() - t1)
+                masks.put((path, mask))
+                count += 1
+                voxels += int(np.prod(image.shape[1:]))
+        masks.put(_DONE)
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - t0
+        if self._errors:
+            raise self._errors[0]
+
+        return {
+            "volumes": count,
+            "voxels": voxels,
+            "elapsed": elapsed,
+            "volumes_per_sec": count / elapsed if elapsed > 0 else 0.0,
+            "voxels_per_sec": voxels / elapsed if elapsed > 0 else 0.0,
+            "input_wait": wait,
+            "windows": self.windows.windows,
+            "skipped_windows": self.windows.skipped,
+            **{f"{stage}_time": t for stage, t in self.stage_time.items()},
+        }
+
+
+def report_throughput(stats):
+    """Logs the per-rank and the aggregate throughput of all ranks."""
+    log.info(
+        f"Rank {MPIUtils.rank()}: {stats['volumes']} volumes in "
+        f"{stats['elapsed']:.2f} s, {stats['volumes_per_sec']:.3f} volumes/s, "
+        f"{stats['voxels_per_sec'] / 1e6:.2f} Mvoxels/s (read "
+        f"{stats['read_time']:.2f} s, infer {stats['infer_time']:.2f} s, write "
+        f"{stats['write_time']:.2f} s, waited for input {stats['input_wait']:.2f} s)"
+    )
+    ranks = MPIUtils.comm_world().allgather(stats)
+    elapsed = max(r["elapsed"] for r in ranks)
+    volumes = sum(r["volumes"] for r in ranks)
+    voxels = sum(r["voxels"] for r in ranks)
+    log0(
+        f"Inference of {volumes} volumes on {len(ranks)} ranks in {elapsed:.2f} s: "
+        f"{volumes / max(elapsed, 1e-9):.3f} volumes/s, "
+        f"{voxels / max(elapsed, 1e-9) / 1e6:.2f} Mvoxels/s"
+    )
+    return {
+        "ranks": len(ranks),
+        "volumes": volumes,
+        "voxels": voxels,
+        "elapsed": elapsed,
+        "volumes_per_sec": volumes / max(elapsed, 1e-9),
+        "voxels_per_sec": voxels / max(elapsed, 1e-9),
+        "per_rank": ranks,
+    }
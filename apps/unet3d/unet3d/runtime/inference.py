@@ -1,25 +1,40 @@
+import itertools
 import numpy as np
 from time import time
+from collections import OrderedDict
 from scipy.signal.windows import gaussian as signal_gaussian
 
 from tqdm import tqdm
 
 import torch
+import torch.distributed as dist
 import torch.nn.functional as F
-from torch.amp import autocast
 
 from dftracer.python import ai
 
+from apps.unet3d.unet3d.model.layers import channels_first, memory_formats
+from apps.unet3d.unet3d.model.losses import ConfusionMatrix, DiceCEStats
 from apps.unet3d.unet3d.runtime.distributed_utils import (
     reduce_tensor,
 )
+from apps.unet3d.unet3d.runtime.compilation import compiled_inference
+from apps.unet3d.unet3d.runtime.precision import Precision
 
 from src.mpi_utils import MPIUtils
+from src.logging import log0
 
 
 @ai.pipeline.test
 def evaluate(
-    flags, model, loader, loss_fn, score_fn, device, epoch=0, is_distributed=False
+    flags,
+    model,
+    loader,
+    loss_fn,
+    score_fn,
+    device,
+    epoch=0,
+    is_distributed=False,
+    predict=None,
 ):
     rank = MPIUtils.rank()
     world_size = MPIUtils.size()
@@ -35,40 +50,73 @@ def evaluate(
             )
 
     model.eval()
+    if predict is None:
+        predict = compiled_inference(flags, model)
+    precision = Precision.from_flags(flags, device)
+    plan_cache.set_capacity(int(flags.sw_plan_cache_mb * 2**20))
 
-    eval_loss = []
-    scores = []
+    results = []
+    cases = []
+    stats = WindowStats()
+    skip_deltas = []
+    eval_start = time()
     with torch.no_grad():
-        t0 = time()
         for i, batch in enumerate(
             tqdm(loader, disable=(rank != 0) or not flags.verbose)
         ):
-            t1 = time()
             image, label = batch
             with ai.device.transfer:
                 image, label = image.to(device), label.to(device)
             if image.numel() == 0:
                 continue
-            t0 = time()
-            with autocast(enabled=flags.amp, device_type="cuda"):
-                output, label = sliding_window_inference(
-                    inputs=image,
-                    labels=label,
-                    roi_shape=flags.val_input_shape,
-                    model=model,
-                    overlap=flags.overlap,
-                    mode="gaussian",
-                    padding_val=-2.2,
+            image = channels_first(image, flags.layout)
+            label = channels_first(label, flags.layout)
+            cases.append((image, label))
+            if len(cases) < flags.sw_volumes:
+                continue
+            evaluate_cases(
+                flags,
+                cases,
+                predict,
+                loss_fn,
+                score_fn,
+                precision,
+                results,
+                stats,
+                skip_deltas,
+            )
+            cases = []
+        if cases:
+            evaluate_cases(
+                flags,
+                cases,
+                predict,
+                loss_fn,
+                score_fn,
+                precision,
+                results,
+                stats,
+                skip_deltas,
+            )
+    if flags.sw_skip_threshold is not None:
+        message = (
+            f"Skipped {stats.skipped} of {stats.windows} sliding windows "
+            f"below {flags.sw_skip_threshold}"
+        )
+        if flags.sw_skip_check > 0:
+            deltas = [
+                d for r in MPIUtils.comm_world().allgather(skip_deltas) for d in r
+            ]
+            if deltas:
+                message += (
+                    f", Dice difference to running all windows over {len(deltas)} "
+                    "cases: " + ", ".join(f"{d:+.4f}" for d in np.mean(deltas, axis=0))
                 )
-                eval_loss_value = loss_fn(output, label)
-                scores.append(score_fn(output, label))
-            eval_loss.append(eval_loss_value)
-            del output
-            del label
-            t1 = time()
-            print(f"evaluation time: {t1 - t0} (s) \t {time()} (ms)")
-            t0 = time()
+        log0(message)
+    eval_loss = [loss for loss, _ in results]
+    scores = [score for _, score in results]
 
+    report_eval_balance(time() - eval_start, len(scores))
     scores = reduce_tensor(torch.mean(torch.stack(scores, dim=0), dim=0), world_size)
     eval_loss = reduce_tensor(
         torch.mean(torch.stack(eval_loss, dim=0), dim=0), world_size
@@ -88,6 +136,85 @@ def evaluate(
     return eval_metrics
 
 
+def evaluate_cases(
+    flags,
+    cases,
+    predict,
+    loss_fn,
+    score_fn,
+    precision,
+    results,
+    stats=None,
+    skip_deltas=None,
+):
+    """
+    Sliding-window inference over `cases`, sharing window batches. With
+    --sw_stream host the loss and score run on the host output, with
+    --sw_stream reduce or --sw_distributed stats they come from the streamed
+    reductions. Until `skip_deltas` holds --sw_skip_check entries, cases are
+    also run without skipping and the score differences are appended to it.
+    """
+    t0 = time()
+    stream = None if flags.sw_stream == "none" else flags.sw_stream
+    distributed = None if flags.sw_distributed == "none" else flags.sw_distributed
+    device = cases[0][0].device
+
+    def run(cases, skip_threshold, stats):
+        outputs = sliding_window_inference_batch(
+            cases,
+            roi_shape=flags.val_input_shape,
+            model=predict,
+            overlap=flags.overlap,
+            mode="gaussian",
+            padding_val=-2.2,
+            memory_format=memory_formats[flags.layout],
+            sw_batch_size=flags.sw_batch_size,
+            pad_batches=flags.compile,
+            stream=stream,
+            first_class=0 if flags.include_background else 1,
+            skip_threshold=skip_threshold,
+            stats=stats,
+            plan=flags.sw_plan_windows,
+            distributed=distributed,
+        )
+        scored = []
+        for output in outputs:
+            if stream == "reduce" or distributed == "stats":
+                loss, score = output
+            else:
+                loss, score = loss_fn(*output), score_fn(*output)
+            scored.append((loss.to(device), score.to(device)))
+        return scored
+
+    with precision.autocast():
+        scored = run(cases, flags.sw_skip_threshold, stats)
+        results.extend(scored)
+        check = 0
+        if skip_deltas is not None and flags.sw_skip_threshold is not None:
+            check = max(0, min(len(cases), flags.sw_skip_check - len(skip_deltas)))
+        if check:
+            full = run(cases[:check], None, None)
+            for (_, skipped), (_, score) in zip(scored, full):
+                skip_deltas.append((skipped - score).cpu().numpy())
+    t1 = time()
+    print(f"evaluation time: {t1 - t0} (s) \t {time()} (ms)")
+
+
+def report_eval_balance(eval_time, num_cases):
+    """
+    Logs the spread of per-rank evaluation time. Every rank waits for the
+    slowest one in the following reduction, so max/mean is the lost fraction.
+    """
+    times = MPIUtils.comm_world().allgather((eval_time, num_cases))
+    eval_times = np.array([t for t, _ in times])
+    log0(
+        f"Per-rank eval time: min {eval_times.min():.2f} s, "
+        f"mean {eval_times.mean():.2f} s, max {eval_times.max():.2f} s "
+        f"(imbalance {eval_times.max() / max(eval_times.mean(), 1e-9):.2f}, "
+        f"cases per rank {[n for _, n in times]})"
+    )
+
+
 def pad_input(volume, roi_shape, strides, padding_mode, padding_val, dim=3):
     """
     mode: constant, reflect, replicate, circular
@@ -117,101 +244,659 @@ def pad_input(volume, roi_shape, strides, padding_mode, padding_val, dim=3):
     return F.pad(volume, paddings, mode=padding_mode, value=padding_val), paddings
 
 
-def gaussian_kernel(n, std):
-    gaussian1D = signal_gaussian(n, std)
-    gaussian2D = np.outer(gaussian1D, gaussian1D)
-    gaussian3D = np.outer(gaussian2D, gaussian1D)
-    gaussian3D = gaussian3D.reshape(n, n, n)
-    gaussian3D = np.cbrt(gaussian3D)
-    gaussian3D /= gaussian3D.max()
-    return torch.from_numpy(gaussian3D)
+def per_axis(overlap, dim=3):
+    """`overlap` as one value per axis, from one value or a list of one."""
+    if not isinstance(overlap, (list, tuple)):
+        overlap = [overlap]
+    return list(overlap) * dim if len(overlap) == 1 else list(overlap)
 
 
-def sliding_window_inference(
-    inputs,
-    labels,
+def window_strides(roi_shape, overlap):
+    overlap = per_axis(overlap, len(roi_shape))
+    return [int(roi_shape[i] * (1 - overlap[i])) for i in range(len(roi_shape))]
+
+
+def axis_crop(length, stride):
+    """Voxels the crop rule removes from one axis."""
+    bound = length % stride
+    return bound if bound < stride // 2 else 0
+
+
+def axis_extent(length, roi, stride):
+    """Length of one axis after the crop and pad rules."""
+    cropped = length - axis_crop(length, stride)
+    pad = (stride - cropped % stride) % stride
+    if cropped + pad < roi:
+        pad += stride
+    return cropped + pad
+
+
+def axis_windows(length, roi, stride):
+    return (axis_extent(length, roi, stride) - roi) // stride + 1
+
+
+def count_windows(image_shape, roi_shape, overlap, plan=False):
+    """
+    Number of model calls `sliding_window_inference` makes for a volume of
+    spatial shape `image_shape`, following the same crop and pad rules. With
+    `plan` the ROI and strides come from `plan_windows`.
+    """
+    if plan:
+        roi_shape, strides = plan_windows(image_shape, roi_shape, overlap)
+    else:
+        strides = window_strides(roi_shape, overlap)
+    count = 1
+    for length, roi, stride in zip(image_shape, roi_shape, strides):
+        count *= axis_windows(length, roi, stride)
+    return count
+
+
+def plan_windows(image_shape, roi_shape, overlap, multiple=32, min_roi=64):
+    """
+    ROI shape and strides with the fewest windows for a volume of spatial
+    shape `image_shape`. ROI sides are multiples of `multiple` (the five
+    Unet3D downsamplings) of at least `min_roi`, the ROI has at most the
+    voxels of `roi_shape`, and every axis overlaps by at least `overlap`.
+    Each axis takes the smallest stride whose windows reach its fewest
+    windows and tile the padded axis exactly, which spreads them evenly,
+    and crops no more than `roi_shape` and `overlap` would. Ties go to fewer
+    voxels through the model.
+    """
+    dim = len(image_shape)
+    overlap = per_axis(overlap, dim)
+    crops = [
+        axis_crop(length, stride)
+        for length, stride in zip(image_shape, window_strides(roi_shape, overlap))
+    ]
+    budget = int(np.prod(roi_shape))
+    longest = budget // min_roi ** (dim - 1)
+    # per axis: ROI side -> (windows, stride)
+    axes = []
+    for length, axis_overlap, crop in zip(image_shape, overlap, crops):
+        sides = range(
+            min_roi, min(-(-length // multiple) * multiple, longest) + 1, multiple
+        )
+        options = {}
+        for roi in sides or [min_roi]:
+            max_stride = max(1, window_strides([roi], axis_overlap)[0])
+            strides = [
+                stride
+                for stride in range(1, max_stride + 1)
+                if (axis_extent(length, roi, stride) - roi) % stride == 0
+                and axis_extent(length, roi, stride) >= roi
+                and axis_crop(length, stride) <= crop
+            ]
+            if strides:
+                stride = min(strides, key=lambda s: (axis_windows(length, roi, s), s))
+                options[roi] = (axis_windows(length, roi, stride), stride)
+        axes.append(options)
+
+    best = None
+    for rois in itertools.product(*axes):
+        voxels = int(np.prod(rois))
+        if voxels > budget:
+            continue
+        windows = int(np.prod([axes[i][roi][0] for i, roi in enumerate(rois)]))
+        if best is None or (windows, voxels) < best[0]:
+            best = ((windows, voxels), list(rois))
+    if best is None:
+        return list(roi_shape), window_strides(roi_shape, overlap)
+    rois = best[1]
+    return rois, [axes[i][roi][1] for i, roi in enumerate(rois)]
+
+
+def gaussian_profiles(roi_shape, sigma_scale=0.125):
+    """
+    Per-axis factors of the importance map: the cube root of a Gaussian with
+    a standard deviation of `sigma_scale` of the ROI side, scaled to 1.
+    """
+    profiles = []
+    for n in roi_shape:
+        profile = np.cbrt(signal_gaussian(n, sigma_scale * n))
+        profiles.append(torch.from_numpy(profile / profile.max()))
+    return profiles
+
+
+def outer3d(profiles):
+    return profiles[0][:, None, None] * profiles[1][None, :, None] * profiles[2]
+
+
+def gaussian_kernel(roi_shape, sigma_scale=0.125):
+    """
+    Importance map of a window: the cube root of a separable Gaussian with
+    a standard deviation of `sigma_scale` of the ROI side, per axis.
+    """
+    return outer3d(gaussian_profiles(roi_shape, sigma_scale))
+
+
+class InferencePlan:
+    """
+    Window origins and reciprocal normalization of one padded volume shape.
+    The importance map is separable and the origins form a grid, so the
+    normalization map, the sum of the importance map over all windows, is
+    the outer product of one profile per axis. Only the reciprocals of these
+    profiles are kept, and `normalize` applies them axis by axis instead of
+    every volume accumulating its own full-size map.
+    """
+
+    def __init__(self, padded_shape, roi_shape, strides, norm_patch, profiles):
+        dim = len(padded_shape)
+        size = [(padded_shape[i] - roi_shape[i]) // strides[i] + 1 for i in range(dim)]
+        starts = [range(0, strides[i] * size[i], strides[i]) for i in range(dim)]
+        self.origins = list(itertools.product(*starts))
+        self.norm_patch = norm_patch
+        self.inv_norm = []
+        for i in range(dim):
+            norm = torch.zeros(
+                padded_shape[i], dtype=norm_patch.dtype, device=norm_patch.device
+            )
+            profile = profiles[i].to(norm)
+            for start in starts[i]:
+                norm[start : start + roi_shape[i]] += profile
+            self.inv_norm.append(norm.reciprocal_())
+        self.nbytes = sum(t.numel() * t.element_size() for t in self.inv_norm)
+
+    def normalize(self, tensor, region=(slice(None),) * 3):
+        """
+        Divides `tensor`, the accumulated outputs of the padded `region`, by
+        the normalization map in place.
+        """
+        for axis, (inv_norm, index) in enumerate(zip(self.inv_norm, region)):
+            shape = [1] * tensor.dim()
+            shape[tensor.dim() - 3 + axis] = -1
+            tensor.mul_(inv_norm[index].view(shape))
+        return tensor
+
+
+class PlanCache:
+    """
+    LRU cache of `InferencePlan`s, keyed by padded shape, ROI, strides,
+    mode, dtype and device, and of the device-resident importance maps they
+    share. Plans only hold per-axis profiles, so the importance maps make up
+    most of the cache. Holds at most `capacity` bytes, 0 disables it.
+    """
+
+    def __init__(self, capacity=256 * 2**20):
+        self.capacity = capacity
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+
+    def set_capacity(self, capacity):
+        self.capacity = capacity
+        self._evict()
+
+    def _evict(self):
+        while self.nbytes > self.capacity:
+            _, (_, nbytes) = self._entries.popitem(last=False)
+            self.nbytes -= nbytes
+
+    def _get(self, key, build):
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return self._entries[key][0]
+        self.misses += 1
+        value, nbytes = build()
+        if nbytes <= self.capacity:
+            self._entries[key] = (value, nbytes)
+            self.nbytes += nbytes
+            self._evict()
+        return value
+
+    @staticmethod
+    def profiles(roi_shape, mode):
+        if mode == "constant":
+            return [torch.ones(n, dtype=torch.float64) for n in roi_shape]
+        if mode == "gaussian":
+            return gaussian_profiles(roi_shape)
+        raise ValueError("Unknown mode. Available modes are {constant, gaussian}.")
+
+    def kernel(self, roi_shape, mode, dtype, device):
+        def build():
+            kernel = outer3d(self.profiles(roi_shape, mode)).type(dtype).to(device)
+            return kernel, kernel.numel() * kernel.element_size()
+
+        return self._get(("kernel", tuple(roi_shape), mode, dtype, device), build)
+
+    def plan(self, padded_shape, roi_shape, strides, mode, dtype, device):
+        def build():
+            norm_patch = self.kernel(roi_shape, mode, dtype, device)
+            profiles = self.profiles(roi_shape, mode)
+            plan = InferencePlan(padded_shape, roi_shape, strides, norm_patch, profiles)
+            return plan, plan.nbytes
+
+        key = (
+            "plan",
+            tuple(padded_shape),
+            tuple(roi_shape),
+            tuple(strides),
+            mode,
+            dtype,
+            device,
+        )
+        return self._get(key, build)
+
+    def clear(self):
+        self._entries.clear()
+        self.nbytes = 0
+
+
+plan_cache = PlanCache()
+
+# logits of a skipped window, softmax gives background with p > 0.9999
+BACKGROUND_LOGIT = 10.0
+
+
+class WindowStats:
+    """Windows seen and skipped by `sliding_window_inference_batch`."""
+
+    def __init__(self):
+        self.windows = 0
+        self.skipped = 0
+
+
+class HostSink:
+    """Copies flushed slabs into a host tensor of the whole output."""
+
+    def __init__(self, shape, dtype, labels):
+        self.output = torch.empty(shape, dtype=dtype)
+        self.labels = labels.cpu() if labels is not None else None
+
+    def write(self, start, slab, labels):
+        self.output[:, :, start : start + slab.shape[2]].copy_(slab)
+
+    def result(self):
+        return self.output, self.labels
+
+
+class ReduceSink:
+    """
+    Reduces flushed slabs straight to the `DiceCELoss` value and the
+    `DiceScore` of the volume, without keeping the output.
+    """
+
+    def __init__(self, first_class, num_classes=3):
+        self.first_class = first_class
+        self.loss = DiceCEStats(first_class)
+        self.confusion = ConfusionMatrix(num_classes)
+
+    def write(self, start, slab, labels):
+        self.loss.update(slab, labels)
+        self.confusion.update(slab, labels)
+
+    def all_reduce(self, device):
+        """Sums the statistics of all ranks, each of which reduced its own rows."""
+        loss, num_classes = self.loss, self.confusion.num_classes
+        if loss.intersection is None:
+            loss.intersection = torch.zeros(
+                1, num_classes - self.first_class, dtype=torch.float64, device=device
+            )
+            loss.total = torch.zeros_like(loss.intersection)
+        if self.confusion.counts is None:
+            self.confusion.counts = torch.zeros(
+                1, num_classes, num_classes, dtype=torch.int64, device=device
+            )
+        sums = torch.tensor(
+            [float(loss.cross_entropy), float(loss.voxels)],
+            dtype=torch.float64,
+            device=device,
+        )
+        for tensor in (loss.intersection, loss.total, self.confusion.counts, sums):
+            dist.all_reduce(tensor)
+        loss.cross_entropy, loss.voxels = sums[0], sums[1]
+
+    def result(self):
+        score = torch.mean(self.confusion.dice(self.first_class), dim=0)
+        return self.loss.value(), score
+
+
+class _Volume:
+    """
+    Padded input, accumulator and inference plan of one volume. With a
+    `sink` the accumulator is a rolling buffer of one window depth along the
+    first spatial axis. Windows arrive in slab order, so once a window
+    starts further down, the rows above it are final and are normalized,
+    cropped and written to the sink.
+
+    `distributed` splits the windows across the ranks of torch.distributed.
+    With "reduce" every rank runs a contiguous share of the windows into a
+    full accumulator, which is then all-reduced. With "stats" every rank
+    owns a share of the output rows, runs the windows that touch them and
+    reduces only those rows to Dice + cross-entropy statistics, which are
+    all-reduced.
+    """
+
+    def __init__(
+        self,
+        inputs,
+        labels,
+        roi_shape,
+        strides,
+        padding_mode,
+        padding_val,
+        memory_format,
+        mode,
+        plans,
+        stream=None,
+        first_class=1,
+        skip_threshold=None,
+        distributed=None,
+    ):
+        image_shape = list(inputs.shape[2:])
+        dim = len(image_shape)
+
+        bounds = [image_shape[i] % strides[i] for i in range(dim)]
+        bounds = [bounds[i] if bounds[i] < strides[i] // 2 else 0 for i in range(dim)]
+        inputs = inputs[
+            ...,
+            bounds[0] // 2 : image_shape[0] - (bounds[0] - bounds[0] // 2),
+            bounds[1] // 2 : image_shape[1] - (bounds[1] - bounds[1] // 2),
+            bounds[2] // 2 : image_shape[2] - (bounds[2] - bounds[2] // 2),
+        ]
+        self.labels = None
+        if labels is not None:
+            self.labels = labels[
+                ...,
+                bounds[0] // 2 : image_shape[0] - (bounds[0] - bounds[0] // 2),
+                bounds[1] // 2 : image_shape[1] - (bounds[1] - bounds[1] // 2),
+                bounds[2] // 2 : image_shape[2] - (bounds[2] - bounds[2] // 2),
+            ]
+
+        self.inputs, self.paddings = pad_input(
+            inputs, roi_shape, strides, padding_mode, padding_val
+        )
+        self.image_shape = image_shape
+        self.roi_shape = roi_shape
+        padded_shape = self.inputs.shape[2:]
+        self.plan = plans.plan(
+            padded_shape,
+            roi_shape,
+            strides,
+            mode,
+            self.inputs.dtype,
+            self.inputs.device,
+        )
+        paddings = self.paddings
+        self.crop = (
+            slice(paddings[4], image_shape[0] + paddings[4]),
+            slice(paddings[2], image_shape[1] + paddings[2]),
+            slice(paddings[0], image_shape[2] + paddings[0]),
+        )
+        self.distributed = distributed
+        self.rows = (0, padded_shape[0])
+        origins = self.plan.origins
+        rank, size = 0, 1
+        if distributed is not None and dist.is_available() and dist.is_initialized():
+            rank, size = dist.get_rank(), dist.get_world_size()
+        # without a process group, or on one rank, the collectives are skipped
+        self.world = size
+        if distributed == "reduce":
+            origins = origins[
+                len(origins) * rank // size : len(origins) * (rank + 1) // size
+            ]
+        elif distributed == "stats":
+            first = self.crop[0].start
+            rows = min(self.crop[0].stop, padded_shape[0]) - first
+            self.rows = (
+                first + rows * rank // size,
+                first + rows * (rank + 1) // size,
+            )
+            origins = [
+                origin
+                for origin in origins
+                if origin[0] < self.rows[1] and origin[0] + roi_shape[0] > self.rows[0]
+            ]
+        elif distributed is not None:
+            raise ValueError(
+                "Unknown distributed mode. Available modes are {reduce, stats}."
+            )
+        self.origins = origins
+        self.skipped = set()
+        if skip_threshold is not None:
+            # the input maximum of every window, in the order of the origins
+            window_max = F.max_pool3d(self.inputs, roi_shape, strides)
+            own = set(origins)
+            self.skipped = {
+                origin
+                for origin, value in zip(
+                    self.plan.origins, window_max.flatten().tolist()
+                )
+                if value <= skip_threshold and origin in own
+            }
+        self._next = 0
+        self.sink = None
+        if stream == "host":
+            shape = [len(range(padded_shape[i])[self.crop[i]]) for i in range(dim)]
+            self.sink = HostSink((1, 3, *shape), self.inputs.dtype, self.labels)
+        elif stream == "reduce":
+            self.sink = ReduceSink(first_class)
+        elif stream is not None:
+            raise ValueError("Unknown stream. Available streams are {host, reduce}.")
+        self.base = 0
+        # the all-reduce needs the full accumulator
+        self.rolling = self.sink is not None and distributed != "reduce"
+        depth = roi_shape[0] if self.rolling else padded_shape[0]
+        # accumulate in the memory format the model produces its outputs in
+        self.result = torch.empty(
+            size=(1, 3, depth, *padded_shape[1:]),
+            dtype=self.inputs.dtype,
+            device=self.inputs.device,
+            memory_format=memory_format,
+        ).zero_()
+
+    def window(self, origin):
+        i, j, k = origin
+        return (
+            ...,
+            slice(i, i + self.roi_shape[0]),
+            slice(j, j + self.roi_shape[1]),
+            slice(k, k + self.roi_shape[2]),
+        )
+
+    def add(self, origin, output):
+        """Adds the model output of `origin` and the skipped windows before it."""
+        while self.origins[self._next] != origin:
+            self._accumulate(self.origins[self._next], self._background())
+            self._next += 1
+        self._accumulate(origin, output)
+        self._next += 1
+
+    def _background(self):
+        logits = torch.zeros(3, dtype=self.result.dtype, device=self.result.device)
+        logits[0] = BACKGROUND_LOGIT
+        return logits.view(1, 3, 1, 1, 1)
+
+    def _accumulate(self, origin, output):
+        if self.rolling and origin[0] > self.base:
+            self._flush(origin[0])
+        i, j, k = origin
+        window = self.window((i - self.base, j, k))
+        self.result[window] += output * self.plan.norm_patch
+
+    def _flush(self, end):
+        """Writes the padded rows [base, end) to the sink and rolls the buffer."""
+        while end - self.base > self.result.shape[2]:
+            self._flush(self.base + self.result.shape[2])
+        crop = self.crop
+        start = max(self.base, crop[0].start, self.rows[0])
+        stop = min(end, crop[0].stop, self.rows[1])
+        if start < stop:
+            rows = slice(start - self.base, stop - self.base)
+            slab = self.result[:, :, rows, crop[1], crop[2]].clone()
+            self.plan.normalize(slab, (slice(start, stop), crop[1], crop[2]))
+            labels = None
+            if self.labels is not None:
+                labels = self.labels[:, :, start - crop[0].start : stop - crop[0].start]
+            self.sink.write(start - crop[0].start, slab, labels)
+        shift = end - self.base
+        keep = self.result.shape[2] - shift
+        if keep > 0:
+            self.result[:, :, :keep] = self.result[:, :, shift:].clone()
+            self.result[:, :, keep:].zero_()
+        else:
+            self.result.zero_()
+        self.base = end
+
+    def finish(self):
+        for origin in self.origins[self._next :]:
+            self._accumulate(origin, self._background())
+        if self.distributed == "reduce" and self.world > 1:
+            dist.all_reduce(self.result)
+        if self.sink is not None:
+            self._flush(self.inputs.shape[2])
+            if self.distributed == "stats" and self.world > 1:
+                self.sink.all_reduce(self.result.device)
+            return self.sink.result()
+        # account for any overlapping sections
+        self.plan.normalize(self.result)
+        return self.result[(..., *self.crop)], self.labels
+
+
+def sliding_window_inference_batch(
+    volumes,
     roi_shape,
     model,
     overlap=0.5,
     mode="gaussian",
     padding_mode="constant",
     padding_val=0.0,
-    **kwargs,
+    memory_format=torch.contiguous_format,
+    sw_batch_size=1,
+    pad_batches=False,
+    plans=None,
+    stream=None,
+    first_class=1,
+    skip_threshold=None,
+    stats=None,
+    plan=False,
+    distributed=None,
 ):
-    image_shape = list(inputs.shape[2:])
-    dim = len(image_shape)
-    strides = [int(roi_shape[i] * (1 - overlap)) for i in range(dim)]
-
-    bounds = [image_shape[i] % strides[i] for i in range(dim)]
-    bounds = [bounds[i] if bounds[i] < strides[i] // 2 else 0 for i in range(dim)]
-    inputs = inputs[
-        ...,
-        bounds[0] // 2 : image_shape[0] - (bounds[0] - bounds[0] // 2),
-        bounds[1] // 2 : image_shape[1] - (bounds[1] - bounds[1] // 2),
-        bounds[2] // 2 : image_shape[2] - (bounds[2] - bounds[2] // 2),
+    """
+    `sliding_window_inference` over a list of (inputs, labels) volumes. The
+    windows of all volumes are run through `model` `sw_batch_size` at a time,
+    so one batch can hold windows of several volumes. With `pad_batches` the
+    last batch is filled up to `sw_batch_size` (e.g. to keep a compiled model
+    at one shape). Importance and normalization maps come from `plans`, the
+    module-wide `plan_cache` by default. Returns the (output, labels) of
+    every volume; labels may be None for volumes without them.
+
+    `stream` bounds the device memory of the output to one window depth:
+    "host" flushes finished slabs into a host tensor and returns the host
+    (output, labels), "reduce" feeds them to the Dice + cross-entropy and
+    Dice score reductions (excluding classes below `first_class`) and
+    returns (loss, score) instead.
+
+    Windows whose input never exceeds `skip_threshold` (air and padding)
+    are not run through `model`, they count as confident background.
+    `stats`, a `WindowStats`, counts the run and skipped windows.
+
+    `roi_shape` may differ per axis and `overlap` may be given per axis.
+    With `plan` every volume gets the ROI and strides of `plan_windows`,
+    with `roi_shape` as the voxel budget and `overlap` as the minimum.
+
+    `distributed` ("reduce" or "stats", see `_Volume`) splits the windows
+    of every volume across the ranks, which all have to pass the same
+    volumes. "stats" returns (loss, score) like `stream` "reduce".
+    """
+    plans = plan_cache if plans is None else plans
+    if distributed == "stats":
+        if stream == "host":
+            raise ValueError("Distributed stats reduce the output, it cannot stream")
+        stream = "reduce"
+    windows = [
+        plan_windows(inputs.shape[2:], roi_shape, overlap)
+        if plan
+        else (roi_shape, window_strides(roi_shape, overlap))
+        for inputs, _ in volumes
     ]
-    labels = labels[
-        ...,
-        bounds[0] // 2 : image_shape[0] - (bounds[0] - bounds[0] // 2),
-        bounds[1] // 2 : image_shape[1] - (bounds[1] - bounds[1] // 2),
-        bounds[2] // 2 : image_shape[2] - (bounds[2] - bounds[2] // 2),
+    volumes = [
+        _Volume(
+            inputs,
+            labels,
+            roi,
+            strides,
+            padding_mode,
+            padding_val,
+            memory_format,
+            mode,
+            plans,
+            stream,
+            first_class,
+            skip_threshold,
+            distributed,
+        )
+        for (inputs, labels), (roi, strides) in zip(volumes, windows)
     ]
 
-    inputs, paddings = pad_input(inputs, roi_shape, strides, padding_mode, padding_val)
+    windows = [
+        (volume, origin)
+        for volume in volumes
+        for origin in volume.origins
+        if origin not in volume.skipped
+    ]
+    if stats is not None:
+        stats.windows += sum(len(volume.origins) for volume in volumes)
+        stats.skipped += sum(len(volume.skipped) for volume in volumes)
+    # a batch only holds windows of one ROI shape
+    batches = []
+    for volume, origin in windows:
+        if (
+            not batches
+            or len(batches[-1]) == sw_batch_size
+            or batches[-1][0][0].roi_shape != volume.roi_shape
+        ):
+            batches.append([])
+        batches[-1].append((volume, origin))
+    for batch in batches:
+        inputs = [volume.inputs[volume.window(origin)] for volume, origin in batch]
+        if pad_batches:
+            inputs += [inputs[-1]] * (sw_batch_size - len(inputs))
+        outputs = model(torch.cat(inputs, dim=0))
+        for b, (volume, origin) in enumerate(batch):
+            volume.add(origin, outputs[b : b + 1])
 
-    padded_shape = inputs.shape[2:]
-    size = [(inputs.shape[2:][i] - roi_shape[i]) // strides[i] + 1 for i in range(dim)]
-    result = torch.zeros(
-        size=(1, 3, *padded_shape), dtype=inputs.dtype, device=inputs.device
-    )
-    norm_map = torch.zeros_like(result)
-    if mode == "constant":
-        norm_patch = torch.ones(
-            size=roi_shape, dtype=norm_map.dtype, device=norm_map.device
-        )
-    elif mode == "gaussian":
-        norm_patch = (
-            gaussian_kernel(roi_shape[0], 0.125 * roi_shape[0])
-            .type(norm_map.dtype)
-            .to(norm_map.device)
-        )
+    return [volume.finish() for volume in volumes]
 
-    else:
-        raise ValueError("Unknown mode. Available modes are {constant, gaussian}.")
 
-    for i in range(0, strides[0] * size[0], strides[0]):
-        for j in range(0, strides[1] * size[1], strides[1]):
-            for k in range(0, strides[2] * size[2], strides[2]):
-                result[
-                    ...,
-                    i : (roi_shape[0] + i),
-                    j : (roi_shape[1] + j),
-                    k : (roi_shape[2] + k),
-                ] += (
-                    model(
-                        inputs[
-                            ...,
-                            i : (roi_shape[0] + i),
-                            j : (roi_shape[1] + j),
-                            k : (roi_shape[2] + k),
-                        ]
-                    )
-                    * norm_patch
-                )
-                norm_map[
-                    ...,
-                    i : (roi_shape[0] + i),
-                    j : (roi_shape[1] + j),
-                    k : (roi_shape[2] + k),
-                ] += norm_patch
-
-    # account for any overlapping sections
-    # norm_map[norm_map == 0] = norm_map[norm_map > 0].min()
-    result /= norm_map
-
-    return result[
-        ...,
-        paddings[4] : image_shape[0] + paddings[4],
-        paddings[2] : image_shape[1] + paddings[2],
-        paddings[0] : image_shape[2] + paddings[0],
-    ], labels
+def sliding_window_inference(
+    inputs,
+    labels,
+    roi_shape,
+    model,
+    overlap=0.5,
+    mode="gaussian",
+    padding_mode="constant",
+    padding_val=0.0,
+    memory_format=torch.contiguous_format,
+    sw_batch_size=1,
+    pad_batches=False,
+    plans=None,
+    stream=None,
+    first_class=1,
+    skip_threshold=None,
+    stats=None,
+    plan=False,
+    distributed=None,
+    **kwargs,
+):
+    return sliding_window_inference_batch(
+        [(inputs, labels)],
+        roi_shape,
+        model,
+        overlap=overlap,
+        mode=mode,
+        padding_mode=padding_mode,
+        padding_val=padding_val,
+        memory_format=memory_format,
+        sw_batch_size=sw_batch_size,
+        pad_batches=pad_batches,
+        plans=plans,
+        stream=stream,
+        first_class=first_class,
+        skip_threshold=skip_threshold,
+        stats=stats,
+        plan=plan,
+        distributed=distributed,
+    )[0]
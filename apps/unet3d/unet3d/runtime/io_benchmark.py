@@ -0,0 +1,184 @@
+import os
+import json
+import time
+import logging
+
+import numpy as np
+from torch.utils.data import DataLoader, Dataset
+
+from dftracer.python import ai
+
+from apps.unet3d.unet3d.data_loading.storage import LatencyHistogram
+
+from src.mpi_utils import MPIUtils
+from src.logging import log0
+
+log = logging.getLogger(__name__)
+
+
+class StagedDataset(Dataset):
+    """
+    Runs the per-sample pipeline of `dataset` (a `PytTrain`) up to `stage`
+    and returns per-sample measurements instead of the sample:
+    [latency s, bytes read, metadata ops].
+
+    - read: raw bytes of image and label, no decoding
+    - decode: decoded volumes
+    - crop: decoded and cropped (crop-aware if the dataset is)
+    - full: the unmodified `__getitem__`, including augmentation
+
+    Datasets without files to stage (e.g. the synthetic loader) always run
+    the full pipeline.
+    """
+
+    def __init__(self, dataset, stage="full"):
+        self.dataset = dataset
+        self.stage = stage if hasattr(dataset, "images") else "full"
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def worker_init(self, worker_id):
+        self.dataset.worker_init(worker_id)
+
+    def _run(self, idx):
+        if self.stage == "full":
+            self.dataset[idx]
+            return
+        ds = self.dataset
+        image_path, label_path = ds.images[idx], ds.labels[idx]
+        if self.stage == "read":
+            ds.storage.read(image_path)
+            ds.storage.read(label_path)
+        elif self.stage == "crop" and ds.crop_aware:
+            ds.rand_crop.load_cropped(ds.storage, image_path, label_path)
+        else:
+            data = {
+                "image": ds.storage.load(image_path),
+                "label": ds.storage.load(label_path),
+            }
+            if self.stage == "crop":
+                ds.rand_crop(data)
+
+    @ai.data.item
+    def __getitem__(self, idx):
+        storage = getattr(self.dataset, "storage", None)
+        bytes0 = storage.bytes_read if storage is not None else 0
+        meta0 = storage.meta_ops if storage is not None else 0
+        t0 = time.perf_counter()
+        self._run(idx)
+        latency = time.perf_counter() - t0
+        if storage is None:
+            return np.array([latency, 0.0, 0.0])
+        return np.array(
+            [latency, storage.bytes_read - bytes0, storage.meta_ops - meta0]
+        )
+
+
+def _benchmark_loader(loader, dataset):
+    """DataLoader over `dataset` configured like the training `loader`."""
+    return DataLoader(
+        dataset,
+        batch_size=loader.batch_size,
+        sampler=loader.sampler,
+        num_workers=loader.num_workers,
+        pin_memory=loader.pin_memory,
+        prefetch_factor=loader.prefetch_factor if loader.num_workers > 0 else None,
+        persistent_workers=loader.num_workers > 0,
+        drop_last=loader.drop_last,
+        worker_init_fn=dataset.worker_init,
+    )
+
+
+def io_benchmark(flags, train_loader):
+    """
+    Drives the training loader for `flags.epochs` epochs without a model and
+    reports bytes read, samples/s, per-sample latency percentiles and
+    metadata operations per rank and aggregated over all ranks. The summary
+    is written to <output_dir>/io-benchmark.json on rank 0.
+    """
+    loader = getattr(train_loader, "loader", train_loader)
+    dataset = StagedDataset(loader.dataset, stage=flags.io_stage)
+    if dataset.stage != flags.io_stage:
+        log0(f"I/O benchmark: {type(loader.dataset).__name__} only runs stage full")
+    bench_loader = _benchmark_loader(loader, dataset)
+    log0(
+        f"I/O benchmark: stage {dataset.stage}, {flags.epochs} epochs of "
+        f"{len(bench_loader)} batches per rank, {loader.num_workers} workers"
+    )
+
+    histogram = LatencyHistogram()
+    samples, nbytes, meta_ops = 0, 0.0, 0.0
+    epoch_times = []
+    for epoch in range(flags.epochs):
+        if hasattr(bench_loader.sampler, "set_epoch"):
+            bench_loader.sampler.set_epoch(epoch)
+        MPIUtils.barrier()
+        t0 = time.perf_counter()
+        for batch in bench_loader:
+            batch = batch.numpy()
+            for latency in batch[:, 0]:
+                histogram.add(latency)
+            samples += len(batch)
+            nbytes += batch[:, 1].sum()
+            meta_ops += batch[:, 2].sum()
+        epoch_times.append(time.perf_counter() - t0)
+        log0(f"I/O benchmark: epoch {epoch} took {epoch_times[-1]:.2f} s on rank 0")
+
+    elapsed = sum(epoch_times)
+    rank_stats = {
+        "rank": MPIUtils.rank(),
+        "samples": samples,
+        "bytes_read": int(nbytes),
+        "meta_ops": int(meta_ops),
+        "elapsed": elapsed,
+        "samples_per_sec": samples / elapsed if elapsed > 0 else 0.0,
+        "p50_ms": histogram.percentile(50),
+        "p99_ms": histogram.percentile(99),
+        "histogram": histogram.to_dict(),
+    }
+    all_stats = MPIUtils.comm_world().gather(rank_stats, root=0)
+    if MPIUtils.rank() != 0:
+        return None
+
+    total = LatencyHistogram()
+    for stats in all_stats:
+        total.merge(LatencyHistogram.from_dict(stats["histogram"]))
+        log0(
+            f"I/O benchmark rank {stats['rank']}: {stats['samples']} samples, "
+            f"{stats['samples_per_sec']:.2f} samples/s, "
+            f"{stats['bytes_read'] / 2**20:.1f} MiB read, "
+            f"{stats['meta_ops']} metadata ops, p50 {stats['p50_ms']:.2f} ms, "
+            f"p99 {stats['p99_ms']:.2f} ms"
+        )
+    # ranks run concurrently, so the slowest one bounds the aggregate rate
+    wall = max(stats["elapsed"] for stats in all_stats)
+    summary = {
+        "stage": dataset.stage,
+        "storage": flags.storage,
+        "ranks": len(all_stats),
+        "epochs": flags.epochs,
+        "num_workers": loader.num_workers,
+        "samples": sum(stats["samples"] for stats in all_stats),
+        "bytes_read": sum(stats["bytes_read"] for stats in all_stats),
+        "meta_ops": sum(stats["meta_ops"] for stats in all_stats),
+        "elapsed": wall,
+        "p50_ms": total.percentile(50),
+        "p90_ms": total.percentile(90),
+        "p99_ms": total.percentile(99),
+        "p999_ms": total.percentile(99.9),
+        "per_rank": [
+            {k: v for k, v in stats.items() if k != "histogram"} for stats in all_stats
+        ],
+    }
+    summary["samples_per_sec"] = summary["samples"] / wall if wall > 0 else 0.0
+    summary["mib_per_sec"] = summary["bytes_read"] / 2**20 / wall if wall > 0 else 0.0
+    log0(
+        f"I/O benchmark total: {summary['samples_per_sec']:.2f} samples/s, "
+        f"{summary['mib_per_sec']:.1f} MiB/s, {summary['meta_ops']} metadata ops, "
+        f"latency p50 {summary['p50_ms']:.2f} ms, p99 {summary['p99_ms']:.2f} ms, "
+        f"p99.9 {summary['p999_ms']:.2f} ms"
+    )
+    with open(os.path.join(flags.output_dir, "io-benchmark.json"), "w") as f:
+        json.dump(summary, f, indent=2)
+    return summary
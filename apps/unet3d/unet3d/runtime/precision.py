@@ -0,0 +1,56 @@
+import logging
+
+import torch
+from torch.amp import autocast, GradScaler
+
+from src.logging import log0
+
+log = logging.getLogger(__name__)
+
+PRECISIONS = ["fp32", "fp16", "bf16"]
+DTYPES = {"fp16": torch.float16, "bf16": torch.bfloat16}
+
+
+class Precision:
+    """
+    Mixed precision for one device. `autocast()` runs the eligible ops in
+    `precision` on the device the tensors live on, and `scaler()` only scales
+    the loss for fp16 on CUDA, where small gradients would underflow. bf16
+    has the exponent range of fp32 and needs no scaling.
+    """
+
+    def __init__(self, precision, device):
+        self.device_type = torch.device(device).type
+        if self.device_type != "cuda" and precision == "fp16":
+            log0("fp16 autocast is CUDA only, using bf16 on the host")
+            precision = "bf16"
+        self.precision = precision
+        self.dtype = DTYPES.get(precision, torch.float32)
+
+    @staticmethod
+    def from_flags(flags, device):
+        """--precision, or --amp as fp16 on CUDA and bf16 on the host."""
+        precision = flags.precision
+        if precision is None:
+            if not flags.amp:
+                precision = "fp32"
+            elif torch.device(device).type == "cuda":
+                precision = "fp16"
+            else:
+                precision = "bf16"
+        return Precision(precision, device)
+
+    @property
+    def enabled(self):
+        return self.precision != "fp32"
+
+    def autocast(self):
+        return autocast(
+            device_type=self.device_type, dtype=self.dtype, enabled=self.enabled
+        )
+
+    def scaler(self):
+        return GradScaler(
+            self.device_type,
+            enabled=self.precision == "fp16" and self.device_type == "cuda",
+        )
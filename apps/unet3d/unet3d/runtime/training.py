@@ -4,13 +4,23 @@ import logging
 
 import torch
 from torch.optim import Adam, SGD
-from torch.amp import autocast, GradScaler
-import numba
 
 from apps.unet3d.unet3d.runtime.distributed_utils import (
     reduce_tensor,
 )
+from apps.unet3d.unet3d.model.layers import channels_first
 from apps.unet3d.unet3d.runtime.inference import evaluate
+from apps.unet3d.unet3d.runtime.precision import Precision
+from apps.unet3d.unet3d.runtime.compilation import (
+    compiled_inference,
+    compiled_train_step,
+)
+from apps.unet3d.unet3d.runtime.compute_emulation import (
+    ComputeEmulator,
+    PhaseRecorder,
+    device_delay,
+    profile_key,
+)
 
 from src.mpi_utils import MPIUtils
 from src.progress import ProgressTracker
@@ -30,9 +40,10 @@ except Exception:
 
 
 def emulate_compute(device, sec):
-    if str(device).find("GPU") != -1:
+    if torch.device(device).type == "cuda":
         print("Putting GPU into sleep for %10.5f sec" % sec)
-        numba.cuda.nanosleep(sec * 1000000000)
+        device_delay(device)(sec)
+        torch.cuda.synchronize()
     else:
         time.sleep(sec)
 
@@ -89,14 +100,21 @@ def train(
         scheduler = torch.optim.lr_scheduler.MultiStepLR(
             optimizer, milestones=flags.lr_decay_epochs, gamma=flags.lr_decay_factor
         )
-    scaler = GradScaler()
+    precision = Precision.from_flags(flags, device)
+    scaler = precision.scaler()
 
     model.to(device)
     loss_fn.to(device)
+    emulator = None
+    if flags.emulate_compute:
+        emulator = ComputeEmulator.from_flags(flags, model, device)
+    recorder = PhaseRecorder(device, enabled=bool(flags.record_compute_profile))
     if is_distributed:
         model = torch.nn.parallel.DistributedDataParallel(
             model, device_ids=[flags.local_rank], output_device=flags.local_rank
         )
+    train_step = compiled_train_step(flags, model, loss_fn)
+    predict = compiled_inference(flags, model)
 
     # @ray: turn these on if we want to do early stopping based on the quality threshold
     # is_successful = False
@@ -124,11 +142,11 @@ def train(
                 flags.lr_warmup_epochs,
             )
 
-        if is_distributed:
-            train_loader.sampler.set_epoch(epoch)
+        train_loader.set_epoch(epoch)
 
         pbar.start_epoch(epoch - 1, total_batches=len(train_loader))
         loss_value = None
+        output = None
         optimizer.zero_grad()
         for iteration, batch in ai.dataloader.fetch.iter(enumerate(train_loader)):
             if flags.max_training_step != -1 and iteration >= flags.max_training_step:
@@ -138,32 +156,43 @@ def train(
             ai.compute.start()
             with ai.device.transfer:
                 image, label = image.to(device), label.to(device)
-            with ai.compute.forward:
+            image = channels_first(image, flags.layout)
+            label = channels_first(label, flags.layout)
+            if emulator is not None:
+                for callback in callbacks:
+                    callback.on_batch_start()
+                emulator.step()
+                ai.compute.stop()
+                pbar.update_batch(iteration, metrics={})
+                continue
+            with ai.compute.forward, recorder.phase("forward"):
                 for callback in callbacks:
                     callback.on_batch_start()
                 if sleep >= 0:
                     emulate_compute(device, sleep)
                     continue
 
-                with autocast(enabled=flags.amp, device_type="cuda"):
-                    output = model(image)
-                    loss_value = loss_fn(output, label)
+                with precision.autocast():
+                    output, loss_value = train_step(image, label)
                     loss_value /= flags.ga_steps
-            with ai.compute.backward:
-                if flags.amp:
+                if train_step.compiled_last_call:
+                    for callback in callbacks:
+                        callback.on_compile()
+            with ai.compute.backward, recorder.phase("backward"):
+                if scaler.is_enabled():
                     scaler.scale(loss_value).backward()
                 else:
                     loss_value.backward()
 
                 if (iteration + 1) % flags.ga_steps == 0:
-                    if flags.amp:
+                    if scaler.is_enabled():
                         scaler.step(optimizer)
                         scaler.update()
                     else:
                         optimizer.step()
 
                     optimizer.zero_grad()
-            with ai.comm.all_reduce:
+            with ai.comm.all_reduce, recorder.phase("loss_reduce"):
                 if not skip_reduce:
                     loss_value = (
                         reduce_tensor(loss_value, world_size).detach().cpu().numpy()
@@ -172,9 +201,16 @@ def train(
                 else:
                     loss_value = 0.0
             ai.compute.stop()
+            recorder.end_step()
 
             pbar.update_batch(iteration, metrics={"loss": loss_value})
 
+        if train_loader.startup_stalls:
+            log0(
+                f"Epoch {epoch} loader startup stall: "
+                f"{train_loader.startup_stalls[-1] * 1000:.2f} ms"
+            )
+
         if flags.lr_decay_epochs:
             scheduler.step()
 
@@ -184,9 +220,16 @@ def train(
             del output
 
             eval_metrics = evaluate(
-                flags, model, val_loader, loss_fn, score_fn, device, epoch
+                flags,
+                model,
+                val_loader,
+                loss_fn,
+                score_fn,
+                device,
+                epoch,
+                predict=predict,
             )
-            if skip_reduce:
+            if skip_reduce or emulator is not None:
                 eval_metrics["train_loss"] = 0.15
             else:
                 eval_metrics["train_loss"] = sum(cumulative_loss) / len(cumulative_loss)
@@ -214,4 +257,15 @@ def train(
     for callback in callbacks:
         callback.on_fit_end()
 
+    if recorder.enabled:
+        recorder.save(flags.record_compute_profile, profile_key(flags, device))
+
+    if train_loader.startup_stalls:
+        stalls = train_loader.startup_stalls
+        log0(
+            f"Loader startup stall (epoch_prefetch={flags.epoch_prefetch}): "
+            f"first {stalls[0] * 1000:.2f} ms, "
+            f"mean of later epochs {sum(stalls[1:]) / max(1, len(stalls) - 1) * 1000:.2f} ms"
+        )
+
     pbar.end_training()